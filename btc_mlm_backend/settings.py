@@ -32,6 +32,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'mlm_users.middleware.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -68,7 +69,53 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+    },
+    # Read replica for safe list/team actions, used when MLM_READ_REPLICA names it. Locally a copy of
+    # db.sqlite3 stands in for it; tests point it at the default test database
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'db_replica.sqlite3',
+        'TEST': {'MIRROR': 'default'},
+    },
+}
+
+DATABASE_ROUTERS = ['mlm_users.db_routers.ReplicaRouter']
+
+# Cache invalidation (version tokens, cached JWT users, replica stickiness) has to reach every web
+# worker and the process_commissions workers, so the default cache is shared between processes:
+# Redis when MLM_REDIS_URL is set, else the mlm_cache table in the default database (created by
+# migration 0010). Tests swap in a local cache through TEST_RUNNER
+if os.environ.get('MLM_REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ['MLM_REDIS_URL'],
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+            'LOCATION': 'mlm_cache',
+            'OPTIONS': {'MAX_ENTRIES': 50000},
+        }
     }
+
+TEST_RUNNER = 'btc_mlm_backend.test_runner.TestRunner'
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        # One JSON line per request from RequestMetricsMiddleware when DEBUG is off; set
+        # MLM_REQUEST_LOG_LEVEL=INFO to turn it on
+        'mlm_users.requests': {
+            'handlers': ['console'], 'level': os.environ.get('MLM_REQUEST_LOG_LEVEL', 'WARNING'), 'propagate': False,
+        },
+    },
 }
 
 # Password validation
@@ -118,7 +165,7 @@ AUTH_USER_MODEL = 'mlm_users.User'
 # Rest Framework settings
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'mlm_users.authentication.CachedJWTAuthentication',
     ),
     'DEFAULT_PERMISSION_CLASSES': (
         'rest_framework.permissions.IsAuthenticated',
@@ -152,4 +199,29 @@ SIMPLE_JWT = {
     'SLIDING_TOKEN_REFRESH_EXP_CLAIM': 'refresh_exp',
     'SLIDING_TOKEN_LIFETIME': timedelta(minutes=5),
     'SLIDING_TOKEN_REFRESH_LIFETIME': timedelta(days=1),
-}
\ No newline at end of file
+}
+
+# MLM settings
+MLM_TEAM_MAX_DEPTH = 10
+# Percent of the purchase profit paid per upline level, nearest first, for packages without a plan
+MLM_COMMISSION_RATES = ['30', '10']
+# Queue commission payouts for the process_commissions worker instead of paying them inside the purchase request
+MLM_ASYNC_COMMISSIONS = True
+MLM_COMMISSION_MAX_ATTEMPTS = 3
+MLM_COMMISSION_CLAIM_TIMEOUT = 300  # seconds before a claimed job is handed to another worker
+MLM_HISTORY_PAGE_SIZE = 50
+MLM_HISTORY_MAX_PAGE_SIZE = 500
+# Versioned cache for the package list and user profiles; versions are bumped on every write
+MLM_RESPONSE_CACHE_TIMEOUT = 600
+MLM_VERSION_TIMEOUT = 86400  # seconds a cache version token lives; expiring only invalidates
+MLM_AUTH_CACHE_TIMEOUT = 30  # seconds a resolved JWT user is reused across requests
+MLM_METRICS_WINDOW = 300  # seconds of traffic behind /api/metrics/
+MLM_METRICS_SLOW_QUERIES = 3  # slowest statements kept per request
+MLM_READ_REPLICA = os.environ.get('MLM_READ_REPLICA')  # database alias for safe read-only actions, e.g. "replica"
+MLM_REPLICA_STICKY_SECONDS = 5  # reads stay on default this long after a user's write; keep above replication lag
+MLM_EVENTS_BACKEND = 'mlm_users.events.LocalBackend'  # wakes /api/users/events/ streams on writes in the same process
+MLM_EVENTS_POLL_SECONDS = 2  # how often a stream checks the user's cache version for writes by other processes
+MLM_EVENTS_QUEUE_SIZE = 100  # messages buffered per stream before the oldest are dropped
+MLM_EVENTS_KEEPALIVE = 15  # seconds between comment lines on an idle stream
+MLM_EVENTS_RETRY_MS = 3000  # reconnect delay sent to EventSource clients
+MLM_EXPORT_CHUNK_SIZE = 2000  # rows fetched and written per chunk by the streaming exports
@@ -0,0 +1,25 @@
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+# The suite runs in one process, so a process-local cache is shared by everything under test, and
+# it never reads or clobbers the cache of a server running on the same host
+TEST_SETTINGS = {
+    'CACHES': {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'mlm',
+        }
+    },
+    'SILENCED_SYSTEM_CHECKS': ['mlm_users.W001'],
+}
+
+
+class TestRunner(DiscoverRunner):
+    def setup_test_environment(self, **kwargs):
+        self.test_settings = override_settings(**TEST_SETTINGS)
+        self.test_settings.enable()
+        super().setup_test_environment(**kwargs)
+
+    def teardown_test_environment(self, **kwargs):
+        super().teardown_test_environment(**kwargs)
+        self.test_settings.disable()
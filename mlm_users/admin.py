@@ -2,15 +2,17 @@
 
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
-from .models import User, Earning, Withdrawal, Package, Purchase
+from .models import User, Earning, Withdrawal, Package, Purchase, CommissionPlan, CommissionJob, LedgerEntry
 
 @admin.register(User)
 class CustomUserAdmin(UserAdmin):
-    list_display = ('username', 'email', 'sponsor', 'level', 'total_earnings', 'available_balance')
+    list_display = ('username', 'email', 'sponsor', 'level', 'team_size', 'total_earnings', 'available_balance')
     list_filter = ('level',)
     search_fields = ('username', 'email', 'sponsor__username')
+    readonly_fields = ('level', 'total_earnings', 'available_balance', 'direct_team_size', 'team_size', 'direct_team_volume', 'team_volume')
     fieldsets = UserAdmin.fieldsets + (
         ('MLM Info', {'fields': ('sponsor', 'sponsor_address', 'level', 'total_earnings', 'available_balance', 'wallet_address')}),
+        ('Team', {'fields': ('direct_team_size', 'team_size', 'direct_team_volume', 'team_volume')}),
     )
 
 @admin.register(Earning)
@@ -24,14 +26,53 @@ class WithdrawalAdmin(admin.ModelAdmin):
     list_display = ('user', 'amount', 'status', 'timestamp')
     list_filter = ('status', 'timestamp')
     search_fields = ('user__username',)
+    actions = ['process_withdrawals']
+
+    @admin.action(description='Process selected pending withdrawals')
+    def process_withdrawals(self, request, queryset):
+        ids = list(queryset.filter(status=Withdrawal.PENDING).values_list('id', flat=True))
+        completed = rejected = 0
+        for start in range(0, len(ids), 1000):
+            # A contended chunk is rolled back whole, so it is retried until none of it is left pending
+            claimed = True
+            while claimed:
+                claimed, batch_completed, batch_rejected = Withdrawal.process_batch(1000, ids=ids[start:start + 1000])
+                completed += batch_completed
+                rejected += batch_rejected
+        self.message_user(request, f"{completed} withdrawals completed, {rejected} rejected.")
+
+@admin.register(CommissionPlan)
+class CommissionPlanAdmin(admin.ModelAdmin):
+    list_display = ('name', 'rates', 'compression')
+    search_fields = ('name',)
 
 @admin.register(Package)
 class PackageAdmin(admin.ModelAdmin):
-    list_display = ('name', 'price', 'profit_percentage')
+    list_display = ('name', 'price', 'profit_percentage', 'commission_plan')
     search_fields = ('name',)
 
 @admin.register(Purchase)
 class PurchaseAdmin(admin.ModelAdmin):
     list_display = ('user', 'package', 'timestamp')
     list_filter = ('timestamp',)
-    search_fields = ('user__username', 'package__name')
\ No newline at end of file
+    search_fields = ('user__username', 'package__name')
+
+@admin.register(CommissionJob)
+class CommissionJobAdmin(admin.ModelAdmin):
+    list_display = ('purchase', 'status', 'attempts', 'created_at', 'completed_at')
+    list_filter = ('status', 'created_at')
+    search_fields = ('purchase__user__username',)
+    raw_id_fields = ('purchase',)
+
+@admin.register(LedgerEntry)
+class LedgerEntryAdmin(admin.ModelAdmin):
+    list_display = ('user', 'kind', 'amount', 'timestamp')
+    list_filter = ('kind', 'timestamp')
+    search_fields = ('user__username',)
+    raw_id_fields = ('user', 'earning', 'withdrawal')
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
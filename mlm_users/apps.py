@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class MlmUsersConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'mlm_users'
+
+    def ready(self):
+        # Registers the system checks, and the query recorder before any connection is opened
+        from . import checks, middleware  # noqa: F401
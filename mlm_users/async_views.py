@@ -0,0 +1,222 @@
+import asyncio
+import json
+import time
+from collections import Counter
+from functools import wraps
+
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.views.decorators.http import require_GET
+from rest_framework import serializers, status
+from rest_framework.request import Request
+from rest_framework.utils.encoders import JSONEncoder
+from rest_framework_simplejwt.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.settings import api_settings
+
+from .authentication import CachedJWTAuthentication
+from .caching import PACKAGES, TREE, acached_response, aget_versions, make_etag, not_modified, user_scope
+from .events import BALANCE, EARNING, get_hub, user_channel
+from .models import Earning, Package, User
+from .pagination import HistoryCursorPagination
+from .serializers import EarningSerializer, PackageSerializer, TeamMemberSerializer, TeamQuerySerializer, UserSerializer, WithdrawalSerializer
+
+# Async counterparts of the read-heavy viewset actions. DRF views are sync only, so under ASGI each
+# of those holds a thread for the whole request; these await the async ORM instead and return the
+# same payloads
+
+authenticator = CachedJWTAuthentication()
+
+
+def json_response(data, status=status.HTTP_200_OK, headers=None):
+    return JsonResponse(data, status=status, headers=headers, encoder=JSONEncoder, safe=False)
+
+
+def async_read(name, query_token=False):
+    # Authentication and the error envelope the viewsets get from DRF and their try/except blocks.
+    # query_token also accepts ?token=, for clients such as EventSource that can't set headers
+    def decorator(view):
+        @require_GET
+        @wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            if query_token and request.GET.get('token') and not authenticator.get_header(request):
+                request.META[api_settings.AUTH_HEADER_NAME] = f"{api_settings.AUTH_HEADER_TYPES[0]} {request.GET['token']}"
+            try:
+                authenticated = await authenticator.aauthenticate(request)
+            except AuthenticationFailed as e:
+                detail = e.detail if isinstance(e.detail, dict) else {'detail': e.detail}
+                return json_response(detail, status=e.status_code, headers={'WWW-Authenticate': authenticator.authenticate_header(request)})
+            if authenticated is None:
+                return json_response(
+                    {'detail': 'Authentication credentials were not provided.'}, status=status.HTTP_401_UNAUTHORIZED,
+                    headers={'WWW-Authenticate': authenticator.authenticate_header(request)},
+                )
+            request.user, request.auth = authenticated
+            try:
+                return await view(request, *args, **kwargs)
+            except serializers.ValidationError as e:
+                return json_response({'error': 'Validation Error', 'details': e.detail}, status=status.HTTP_400_BAD_REQUEST)
+            except Exception as e:
+                return json_response({'error': f'Failed to retrieve {name}', 'details': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        return wrapper
+    return decorator
+
+
+def not_modified_response(etag):
+    return HttpResponse(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+
+@async_read('profile')
+async def profile(request):
+    versions = await aget_versions(user_scope(request.user.pk), TREE)
+    etag = make_etag(request, 'profile', versions)
+    if not_modified(request, etag):
+        return not_modified_response(etag)
+
+    async def build():
+        # request.user is already loaded, so serializing it never touches the database
+        return UserSerializer(request.user).data
+
+    data = await acached_response('profile', versions, build)
+    return json_response(data, headers={'ETag': etag})
+
+
+@async_read('team')
+async def team(request):
+    user = request.user
+    etag = make_etag(request, 'team', await aget_versions(user_scope(user.pk), TREE))
+    if not_modified(request, etag):
+        return not_modified_response(etag)
+    query = TeamQuerySerializer(data=request.GET)
+    query.is_valid(raise_exception=True)
+    depth = query.validated_data['depth']
+    members = [member async for member in user.get_team(levels=depth).aiterator(chunk_size=500)]
+    level_counts = Counter(member.level - user.level for member in members)
+    return json_response({
+        'depth': depth,
+        'total': len(members),
+        'level_counts': {level: level_counts[level] for level in range(1, depth + 1)},
+        'members': TeamMemberSerializer(members, many=True).data,
+    }, headers={'ETag': etag})
+
+
+async def history_page(request, queryset, serializer_class):
+    paginator = HistoryCursorPagination()
+    page = await paginator.apaginate_queryset(queryset, Request(request))
+    return json_response(paginator.get_paginated_data(serializer_class(page, many=True).data))
+
+
+@async_read('earnings')
+async def earnings(request):
+    return await history_page(request, request.user.earnings.all(), EarningSerializer)
+
+
+@async_read('withdrawals')
+async def withdrawals(request):
+    return await history_page(request, request.user.withdrawals.all(), WithdrawalSerializer)
+
+
+@async_read('packages')
+async def packages(request):
+    versions = await aget_versions(PACKAGES)
+    etag = make_etag(request, 'packages', versions)
+    if not_modified(request, etag):
+        return not_modified_response(etag)
+
+    async def build():
+        return PackageSerializer([package async for package in Package.objects.all()], many=True).data
+
+    data = await acached_response('packages', versions, build)
+    return json_response(data, headers={'ETag': etag})
+
+
+def sse(event, data, event_id=None):
+    lines = [f'event: {event}']
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.append(f'data: {json.dumps(data, cls=JSONEncoder)}')
+    return '\n'.join(lines) + '\n\n'
+
+
+async def balance_event(user_id):
+    row = await User.objects.filter(pk=user_id).values('available_balance', 'total_earnings').afirst()
+    return row and sse(BALANCE, {'available_balance': str(row['available_balance']), 'total_earnings': str(row['total_earnings'])})
+
+
+async def earnings_after(user_id, earning_id):
+    missed = Earning.objects.filter(user_id=user_id, id__gt=earning_id).order_by('id')[:settings.MLM_HISTORY_MAX_PAGE_SIZE]
+    return [earning async for earning in missed]
+
+
+async def event_stream(user_id, last_event_id):
+    # Earnings and the balance are always read from the database, after Last-Event-ID or the last
+    # earning sent. A hub message makes the stream read now, but the hub reaches subscribers in this
+    # process alone, so writes made elsewhere, such as by the process_commissions workers, are found
+    # through the user's cache version: every write to their earnings or balance replaces it, and it
+    # is checked every MLM_EVENTS_POLL_SECONDS, so an idle stream never queries the database.
+    # Subscribed before anything is read, so no change can fall between the snapshot and the stream
+    subscription = get_hub().subscribe(user_channel(user_id))
+    try:
+        yield f'retry: {settings.MLM_EVENTS_RETRY_MS}\n\n'
+        if last_event_id is None:
+            sent = await Earning.objects.filter(user_id=user_id).order_by('-id').values_list('id', flat=True).afirst() or 0
+        else:
+            # A reconnecting client gets the earnings it missed
+            sent = last_event_id
+        balance = None
+        version = None
+        idle_since = time.monotonic()
+        messages = None
+
+        while True:
+            # Taken before the reads, so a write landing during them still changes it for the next poll
+            current, = await aget_versions(user_scope(user_id))
+            if messages is None and current == version:
+                messages = []
+            version = current
+            events = []
+            if messages is None or any(message['event'] == EARNING for message in messages):
+                for earning in await earnings_after(user_id, sent):
+                    sent = earning.pk
+                    events.append(sse(EARNING, EarningSerializer(earning).data, earning.pk))
+            if messages is None or any(message['event'] == BALANCE for message in messages):
+                event = await balance_event(user_id)
+                if event is None:
+                    return
+                if event != balance:
+                    balance = event
+                    events.append(event)
+            for event in events:
+                yield event
+                idle_since = time.monotonic()
+            if not events and time.monotonic() - idle_since >= settings.MLM_EVENTS_KEEPALIVE:
+                yield ': keepalive\n\n'
+                idle_since = time.monotonic()
+
+            try:
+                message = await asyncio.wait_for(subscription.get(), settings.MLM_EVENTS_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                messages = None  # nothing pushed, so read everything if the version changed
+            else:
+                # Everything already queued is handled together, with at most one read of each kind
+                messages = [message, *subscription.pending()]
+    finally:
+        subscription.close()
+
+
+@async_read('events', query_token=True)
+async def events(request):
+    if not isinstance(request, ASGIRequest):
+        # A WSGI worker would have to buffer the endless stream before sending any of it
+        return json_response(
+            {'error': 'Event stream unavailable', 'details': 'Serve btc_mlm_backend.asgi:application to use this endpoint.'},
+            status=status.HTTP_501_NOT_IMPLEMENTED,
+        )
+    try:
+        last_event_id = int(request.headers['Last-Event-ID'])
+    except (KeyError, ValueError):
+        last_event_id = None
+    return StreamingHttpResponse(
+        event_stream(request.user.pk, last_event_id), content_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
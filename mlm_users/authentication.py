@@ -0,0 +1,76 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+from .caching import TREE, aget_versions, get_versions, stats, user_scope
+
+AUTH_USER_PREFIX = 'mlm:auth-user:'
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    # Resolves the token's user from the cache, keyed by the user's version token and the tree's:
+    # any write to the user's row bumps the first, and sponsor moves, which rewrite the path and
+    # level of a whole subtree with one UPDATE, bump the second, so a cached user is never stale
+    def get_user(self, validated_token):
+        user_id = validated_token.get(api_settings.USER_ID_CLAIM)
+        if user_id is None:
+            return super().get_user(validated_token)
+
+        key = self.cache_key(user_id)
+        user = cache.get(key)
+        if user is None:
+            stats['auth_misses'] += 1
+            user = super().get_user(validated_token)
+            cache.set(key, user, settings.MLM_AUTH_CACHE_TIMEOUT)
+            return user
+
+        stats['auth_hits'] += 1
+        return self.check_user(user, validated_token)
+
+    async def aauthenticate(self, request):
+        # authenticate() for async views, which can't go through DRF's request wrapper
+        header = self.get_header(request)
+        if header is None:
+            return None
+        raw_token = self.get_raw_token(header)
+        if raw_token is None:
+            return None
+        validated_token = self.get_validated_token(raw_token)
+        return await self.aget_user(validated_token), validated_token
+
+    async def aget_user(self, validated_token):
+        user_id = validated_token.get(api_settings.USER_ID_CLAIM)
+        if user_id is None:
+            raise InvalidToken(_("Token contained no recognizable user identification"))
+
+        key = await self.acache_key(user_id)
+        user = await cache.aget(key)
+        if user is None:
+            stats['auth_misses'] += 1
+            try:
+                user = await self.user_model.objects.aget(**{api_settings.USER_ID_FIELD: user_id})
+            except self.user_model.DoesNotExist:
+                raise AuthenticationFailed(_("User not found"), code="user_not_found")
+            self.check_user(user, validated_token)
+            await cache.aset(key, user, settings.MLM_AUTH_CACHE_TIMEOUT)
+            return user
+
+        stats['auth_hits'] += 1
+        return self.check_user(user, validated_token)
+
+    def cache_key(self, user_id):
+        return AUTH_USER_PREFIX + ':'.join([str(user_id), *get_versions(user_scope(user_id), TREE)])
+
+    async def acache_key(self, user_id):
+        return AUTH_USER_PREFIX + ':'.join([str(user_id), *await aget_versions(user_scope(user_id), TREE)])
+
+    def check_user(self, user, validated_token):
+        if not user.is_active:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+        if api_settings.CHECK_REVOKE_TOKEN and validated_token.get(api_settings.REVOKE_TOKEN_CLAIM) != get_md5_hash_password(user.password):
+            raise AuthenticationFailed(_("The user's password has been changed."), code="password_changed")
+        return user
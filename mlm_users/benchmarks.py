@@ -0,0 +1,172 @@
+import asyncio
+import statistics
+import time
+import tracemalloc
+from io import StringIO
+from itertools import count
+
+from asgiref.sync import async_to_sync
+from django.core.asgi import get_asgi_application
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from .models import Package, User
+
+# Per-endpoint ceilings: most queries, slowest wall time and highest Python heap peak over all iterations
+DEFAULT_BUDGETS = {
+    'team': {'queries': 2, 'wall_ms': 500, 'peak_kb': 20000},
+    'purchase_create': {'queries': 8, 'wall_ms': 200, 'peak_kb': 2000},
+    'earnings_list': {'queries': 2, 'wall_ms': 200, 'peak_kb': 2000},
+    'registration': {'queries': 9, 'wall_ms': 3000, 'peak_kb': 2000},  # dominated by password hashing
+}
+
+# Sync viewset action and its async counterpart, compared for throughput under concurrent load
+ASGI_ENDPOINTS = {
+    'profile': ('/api/users/profile/', '/api/async/users/profile/'),
+    'team': ('/api/users/team/?depth=10', '/api/async/users/team/?depth=10'),
+    'earnings': ('/api/users/earnings/', '/api/async/users/earnings/'),
+    'withdrawals': ('/api/users/withdrawals/', '/api/async/users/withdrawals/'),
+    'packages': ('/api/packages/', '/api/async/packages/'),
+}
+
+
+def build_network(users=1000, branching='3-5', depth=10, purchase_rate=1.5, seed=0):
+    call_command(
+        'generate_network', '--users', str(users), '--branching', branching, '--depth', str(depth),
+        '--purchase-rate', str(purchase_rate), '--seed', str(seed), '--prefix', 'bench', stdout=StringIO(),
+    )
+
+
+def client_for(user):
+    client = APIClient()
+    client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(user)}')
+    return client
+
+
+def scenarios():
+    # Each scenario returns a callable making one request, run against the generated network
+    root = User.objects.filter(level=0).order_by('-team_size', 'id').first()
+    leaf = User.objects.order_by('-level', 'id').first()
+    package = Package.objects.order_by('id').first()
+    root_client, leaf_client = client_for(root), client_for(leaf)
+    serial = count()
+
+    def register():
+        n = next(serial)
+        return root_client.post('/api/users/', {
+            'username': f'bench-new-{n}', 'email': f'bench-new-{n}@example.com', 'password': 'password123',
+            'sponsor_address': leaf.email,
+        })
+
+    return {
+        'team': lambda: root_client.get('/api/users/team/', {'depth': 10}),
+        'purchase_create': lambda: leaf_client.post('/api/purchases/', {'package': package.pk}),
+        'earnings_list': lambda: root_client.get('/api/earnings/'),
+        'registration': register,
+    }
+
+
+def measure(request, iterations):
+    queries, wall_ms, statuses = [], [], set()
+    for _ in range(iterations):
+        with CaptureQueriesContext(connection) as captured:
+            start = time.perf_counter()
+            response = request()
+            wall_ms.append((time.perf_counter() - start) * 1000)
+        queries.append(len(captured))
+        statuses.add(response.status_code)
+    # Memory gets its own run, since tracing allocations would skew the timings
+    tracemalloc.start()
+    try:
+        statuses.add(request().status_code)
+        peak_kb = tracemalloc.get_traced_memory()[1] / 1024
+    finally:
+        tracemalloc.stop()
+    return {
+        'queries': max(queries),
+        'wall_ms': {'median': round(statistics.median(wall_ms), 2), 'max': round(max(wall_ms), 2)},
+        'peak_kb': round(peak_kb, 1),
+        'statuses': sorted(statuses),
+    }
+
+
+def run_benchmarks(iterations=5, budgets=None, only=None):
+    budgets = {**DEFAULT_BUDGETS, **(budgets or {})}
+    results = {}
+    for name, request in scenarios().items():
+        if only and name not in only:
+            continue
+        result = measure(request, iterations)
+        budget = budgets.get(name, {})
+        observed = {'queries': result['queries'], 'wall_ms': result['wall_ms']['max'], 'peak_kb': result['peak_kb']}
+        result['budget'] = budget
+        result['over_budget'] = sorted(metric for metric, limit in budget.items() if observed[metric] > limit)
+        result['passed'] = not result['over_budget'] and all(code < 400 for code in result['statuses'])
+        results[name] = result
+    return {'passed': all(result['passed'] for result in results.values()), 'results': results}
+
+
+async def asgi_get(app, url, token):
+    # Drives the ASGI application the way a server would, one scope per request
+    path, _, query = url.partition('?')
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+        'path': path, 'raw_path': path.encode(), 'query_string': query.encode(), 'root_path': '',
+        'headers': [(b'host', b'testserver'), (b'authorization', f'Bearer {token}'.encode())],
+        'server': ('testserver', 80), 'client': ('127.0.0.1', 0),
+    }
+    messages = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+    started = {}
+
+    async def receive():
+        if messages:
+            return messages.pop()
+        await asyncio.Event().wait()  # no disconnect; cancelled once the response is sent
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            started['status'] = message['status']
+
+    await app(scope, receive, send)
+    return started['status']
+
+
+async def throughput(app, url, token, concurrency, total):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            return await asgi_get(app, url, token)
+
+    start = time.perf_counter()
+    statuses = await asyncio.gather(*(one() for _ in range(total)))
+    elapsed = time.perf_counter() - start
+    return {'requests_per_second': round(total / elapsed, 1), 'statuses': sorted(set(statuses))}
+
+
+def run_concurrency_benchmark(concurrency=20, total=200, only=None):
+    app = get_asgi_application()
+    root = User.objects.filter(level=0).order_by('-team_size', 'id').first()
+    token = str(AccessToken.for_user(root))
+
+    async def run():
+        results = {}
+        for name, (sync_url, async_url) in ASGI_ENDPOINTS.items():
+            if only and name not in only:
+                continue
+            # One warm-up request each, so both paths start from a populated auth and response cache
+            await asgi_get(app, sync_url, token)
+            await asgi_get(app, async_url, token)
+            sync_result = await throughput(app, sync_url, token, concurrency, total)
+            async_result = await throughput(app, async_url, token, concurrency, total)
+            results[name] = {
+                'sync': sync_result,
+                'async': async_result,
+                'speedup': round(async_result['requests_per_second'] / sync_result['requests_per_second'], 2),
+            }
+        return results
+
+    return {'concurrency': concurrency, 'requests': total, 'results': async_to_sync(run)()}
@@ -0,0 +1,106 @@
+import hashlib
+import uuid
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from .db_routers import reading_from_replica
+
+VERSION_PREFIX = 'mlm:version:'
+RESPONSE_PREFIX = 'mlm:response:'
+PACKAGES = 'packages'
+TREE = 'tree'
+
+# Per-process hit/miss counters, keyed like "profile_hits"
+stats = Counter()
+
+
+def user_scope(user_id):
+    return f'user:{user_id}'
+
+
+def get_versions(*scopes):
+    # A scope's version is an opaque token; invalidating deletes it, so entries cached under the
+    # old token are never read again and simply expire. A token expiring is just an invalidation,
+    # so tokens get a timeout too and the cache never fills up with ones for idle users
+    keys = [VERSION_PREFIX + scope for scope in scopes]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, uuid.uuid4().hex[:12], settings.MLM_VERSION_TIMEOUT)
+            versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+
+async def aget_versions(*scopes):
+    # get_versions() for the event loop
+    keys = [VERSION_PREFIX + scope for scope in scopes]
+    versions = await cache.aget_many(keys)
+    for key in keys:
+        if key not in versions:
+            await cache.aadd(key, uuid.uuid4().hex[:12], settings.MLM_VERSION_TIMEOUT)
+            versions[key] = await cache.aget(key)
+    return [versions[key] for key in keys]
+
+
+def invalidate(*scopes):
+    keys = [VERSION_PREFIX + scope for scope in scopes]
+    if not keys:
+        return
+    cache.delete_many(keys)
+    # Again once the writing transaction commits, dropping anything a reader cached from the old rows meanwhile
+    transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+def invalidate_users(user_ids):
+    invalidate(*(user_scope(user_id) for user_id in user_ids))
+
+
+def cached_response(name, versions, build):
+    key = RESPONSE_PREFIX + ':'.join([name, *versions])
+    data = cache.get(key)
+    if data is None:
+        stats[f'{name}_misses'] += 1
+        data = build()
+        # A replica may still be behind the versions in the key, so only primary reads are stored
+        if not reading_from_replica():
+            cache.set(key, data, settings.MLM_RESPONSE_CACHE_TIMEOUT)
+    else:
+        stats[f'{name}_hits'] += 1
+    return data
+
+
+async def acached_response(name, versions, build):
+    # cached_response() for async views, where building the data means awaiting the async ORM
+    key = RESPONSE_PREFIX + ':'.join([name, *versions])
+    data = await cache.aget(key)
+    if data is None:
+        stats[f'{name}_misses'] += 1
+        data = await build()
+        if not reading_from_replica():
+            await cache.aset(key, data, settings.MLM_RESPONSE_CACHE_TIMEOUT)
+    else:
+        stats[f'{name}_hits'] += 1
+    return data
+
+
+def make_etag(request, name, versions):
+    # Built from version tokens alone, so a client can be answered before any query or serialization
+    tag = ':'.join([name, *versions])
+    if request.GET:
+        tag += ':' + hashlib.md5(request.GET.urlencode().encode()).hexdigest()[:12]
+    return f'"{tag}"'
+
+
+def not_modified(request, etag):
+    header = request.headers.get('If-None-Match')
+    if not header:
+        return False
+    tags = [tag.strip().removeprefix('W/') for tag in header.split(',')]
+    return '*' in tags or etag in tags
+
+
+def cache_stats():
+    return dict(stats)
@@ -0,0 +1,22 @@
+from django.conf import settings
+from django.core.checks import Tags, Warning, register
+
+PROCESS_LOCAL_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+@register(Tags.caches)
+def check_shared_cache(app_configs, **kwargs):
+    # Cached responses, JWT users and replica stickiness are all invalidated through the default
+    # cache; a per-process cache keeps serving stale entries in every process but the writer's
+    backend = settings.CACHES.get('default', {}).get('BACKEND')
+    if backend in PROCESS_LOCAL_CACHES:
+        return [Warning(
+            f'The default cache ({backend}) is not shared between processes.',
+            hint='Invalidations made by other web workers or by process_commissions will not be seen. '
+                 'Use Redis (MLM_REDIS_URL), memcached or the database cache.',
+            id='mlm_users.W001',
+        )]
+    return []
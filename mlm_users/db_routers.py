@@ -0,0 +1,54 @@
+import contextvars
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+
+STICKY_PREFIX = 'mlm:sticky:'
+
+# Alias reads are sent to for the current request; None leaves them on default
+_read_alias = contextvars.ContextVar('mlm_read_alias', default=None)
+
+
+def replica_alias():
+    alias = settings.MLM_READ_REPLICA
+    return alias if alias and alias in settings.DATABASES else None
+
+
+def mark_write(user_id):
+    cache.set(STICKY_PREFIX + str(user_id), True, settings.MLM_REPLICA_STICKY_SECONDS)
+
+
+def recently_wrote(user_id):
+    return cache.get(STICKY_PREFIX + str(user_id)) is not None
+
+
+def route_reads(alias):
+    return _read_alias.set(alias)
+
+
+def reset_reads(token):
+    _read_alias.reset(token)
+
+
+def reading_from_replica():
+    return _read_alias.get() is not None
+
+
+class ReplicaRouter:
+    # Reads follow whatever the view routed them to, writes always hit the primary, and only the
+    # primary is migrated since replicas get their schema through replication
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label == 'django_cache':
+            # The database cache holds invalidations, which a lagging replica would hide
+            return DEFAULT_DB_ALIAS
+        return _read_alias.get()
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
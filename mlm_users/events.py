@@ -0,0 +1,119 @@
+import asyncio
+import threading
+from collections import defaultdict
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+BALANCE = 'balance'
+EARNING = 'earning'
+
+
+def user_channel(user_id):
+    return f'user:{user_id}'
+
+
+class EventBackend:
+    # Interface for the pub/sub hub behind the event stream. publish() is called from sync code
+    # after the writing transaction commits; subscribe() is called from the event loop serving the
+    # stream and returns a Subscription, whose close() hands it back to unsubscribe(). Messages are
+    # plain JSON-able dicts, so a multi-process backend can relay them through a broker (Redis
+    # pub/sub, Postgres LISTEN/NOTIFY) with the same three methods
+    def publish(self, channel, message):
+        raise NotImplementedError
+
+    def subscribe(self, channel):
+        raise NotImplementedError
+
+    def unsubscribe(self, subscription):
+        raise NotImplementedError
+
+
+class Subscription:
+    def __init__(self, backend, channel, maxsize):
+        self.backend = backend
+        self.channel = channel
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize)
+
+    def put(self, message):
+        # Called from whichever thread published; the queue is only touched on its own loop
+        try:
+            self.loop.call_soon_threadsafe(self.deliver, message)
+        except RuntimeError:
+            pass  # loop already closed, the stream is gone
+
+    def deliver(self, message):
+        if self.queue.full():
+            self.queue.get_nowait()  # a slow client loses the oldest message, never blocks publishers
+        self.queue.put_nowait(message)
+
+    async def get(self):
+        return await self.queue.get()
+
+    def pending(self):
+        messages = []
+        while not self.queue.empty():
+            messages.append(self.queue.get_nowait())
+        return messages
+
+    def close(self):
+        self.backend.unsubscribe(self)
+
+
+class LocalBackend(EventBackend):
+    # Fans messages out to subscribers in this process only; streams find other processes' writes
+    # by polling the user's cache version
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = defaultdict(set)
+
+    def publish(self, channel, message):
+        with self.lock:
+            subscribers = list(self.subscribers.get(channel, ()))
+        for subscription in subscribers:
+            subscription.put(message)
+
+    def subscribe(self, channel):
+        subscription = Subscription(self, channel, settings.MLM_EVENTS_QUEUE_SIZE)
+        with self.lock:
+            self.subscribers[channel].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscribers = self.subscribers.get(subscription.channel)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self.subscribers[subscription.channel]
+
+
+@lru_cache
+def load_backend(path):
+    return import_string(path)()
+
+
+def get_hub():
+    return load_backend(settings.MLM_EVENTS_BACKEND)
+
+
+def publish_on_commit(messages):
+    # {user_id: [message, ...]}; nothing goes out unless the write that caused it is kept
+    if messages:
+        transaction.on_commit(lambda: [
+            get_hub().publish(user_channel(user_id), message)
+            for user_id, user_messages in messages.items() for message in user_messages
+        ])
+
+
+def balance_changed(user_ids):
+    # The stream reads the balance itself, so the message only says which user to re-read
+    publish_on_commit({user_id: [{'event': BALANCE}] for user_id in set(user_ids)})
+
+
+def earnings_created(earnings):
+    # Like balances, the stream reads the earnings itself, after the last one it sent
+    publish_on_commit({earning.user_id: [{'event': EARNING}] for earning in earnings})
@@ -0,0 +1,109 @@
+import csv
+import json
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+
+EARNING_COLUMNS = {'id': 'id', 'amount': 'amount', 'description': 'description', 'timestamp': 'timestamp'}
+PURCHASE_COLUMNS = {
+    'id': 'id', 'package': 'package_id', 'package_name': 'package__name', 'price': 'package__price', 'timestamp': 'timestamp',
+}
+
+
+class ExportRenderer(BaseRenderer):
+    # Selected with ?format= or Accept; exports stream their own body, so this only renders errors
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return JSONRenderer().render(data)
+
+
+class CSVExportRenderer(ExportRenderer):
+    media_type = 'text/csv'
+    format = 'csv'
+
+
+class NDJSONExportRenderer(ExportRenderer):
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+
+
+EXPORT_RENDERERS = [CSVExportRenderer, NDJSONExportRenderer]
+
+
+class Echo:
+    # csv.writer target that hands back each formatted row instead of buffering it
+    def write(self, value):
+        return value
+
+
+def filter_dates(queryset, start=None, end=None):
+    # Whole local days, as a half-open timestamp range so the (user, timestamp) index is used
+    if start is not None:
+        queryset = queryset.filter(timestamp__gte=timezone.make_aware(datetime.combine(start, time.min)))
+    if end is not None:
+        queryset = queryset.filter(timestamp__lt=timezone.make_aware(datetime.combine(end + timedelta(days=1), time.min)))
+    return queryset
+
+
+def line_encoder(columns, fmt):
+    # Timestamps come out as DRF's DateTimeField renders them, without its per-value timezone lookups
+    tz = timezone.get_current_timezone()
+
+    def cell(value):
+        if isinstance(value, datetime):
+            text = value.astimezone(tz).isoformat()
+            return text[:-6] + 'Z' if text.endswith('+00:00') else text
+        if isinstance(value, Decimal):
+            return str(value)
+        return value
+
+    if fmt == 'csv':
+        writer = csv.writer(Echo())
+        return writer.writerow(columns), lambda row: writer.writerow([cell(value) for value in row])
+    return '', lambda row: json.dumps(dict(zip(columns, map(cell, row)))) + '\n'
+
+
+def encode_rows(rows, columns, fmt, batch_size):
+    # Rows are joined into one chunk per batch, so the response is neither one write per row nor
+    # ever more than a batch in memory
+    header, encode = line_encoder(columns, fmt)
+    batch = [header]
+    for row in rows:
+        batch.append(encode(row))
+        if len(batch) >= batch_size:
+            yield ''.join(batch)
+            batch = []
+    if batch:
+        yield ''.join(batch)
+
+
+async def astream(chunks):
+    # Each chunk is fetched and encoded on a worker thread; the event loop only forwards it
+    try:
+        while (chunk := await sync_to_async(next)(chunks, None)) is not None:
+            yield chunk
+    finally:
+        await sync_to_async(chunks.close)()
+
+
+def export_response(request, queryset, columns, name, fmt):
+    chunk_size = settings.MLM_EXPORT_CHUNK_SIZE
+    # Pinned now: the body is read after the view returns, when per-request read routing is gone
+    rows = queryset.using(queryset.db).order_by('timestamp', 'id').values_list(*columns.values())
+    content = encode_rows(rows.iterator(chunk_size=chunk_size), list(columns), fmt, chunk_size)
+    if isinstance(request._request, ASGIRequest):
+        # ASGI serves async iterators natively but would buffer a sync one whole
+        content = astream(content)
+    content_type = CSVExportRenderer.media_type if fmt == 'csv' else NDJSONExportRenderer.media_type
+    filename = f'{name}-{timezone.localdate().isoformat()}.{fmt}'
+    return StreamingHttpResponse(
+        content, content_type=f'{content_type}; charset=utf-8',
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'},
+    )
@@ -0,0 +1,217 @@
+import csv
+import json
+from itertools import islice
+
+from django.contrib.auth.hashers import identify_hasher, make_password
+from django.db import transaction
+from django.db.models import Q
+
+from .models import Package, Purchase, User, increment_columns, path_ids, record_earnings, upline_increments
+
+FORMATS = ('csv', 'ndjson')
+MAX_REPORTED_ERRORS = 100
+USER_COLUMNS = ('username', 'email', 'password', 'sponsor', 'wallet_address', 'sponsor_address')
+
+
+def detect_format(filename, default='csv'):
+    if filename.endswith(('.ndjson', '.jsonl')):
+        return 'ndjson'
+    if filename.endswith('.csv'):
+        return 'csv'
+    return default
+
+
+def read_rows(stream, fmt):
+    # Lazily yield dict rows from a text stream so imports never hold the whole file
+    if fmt == 'csv':
+        for row in csv.DictReader(stream):
+            yield row
+    elif fmt == 'ndjson':
+        for number, line in enumerate(stream, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                raise ValueError(f'Line {number}: {e}')
+            if not isinstance(row, dict):
+                raise ValueError(f'Line {number}: expected a JSON object')
+            yield row
+    else:
+        raise ValueError(f"Unsupported format '{fmt}', expected one of {', '.join(FORMATS)}")
+
+
+class ImportInterrupted(Exception):
+    # A chunk failed after earlier ones were committed; stats counts only the committed chunks
+    def __init__(self, stats):
+        super().__init__(stats)
+        self.stats = stats
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def import_purchases(rows, chunk_size=1000):
+    """
+    Import purchase rows of the form {"user": <username, email or wallet address>,
+    "package": <id or name>} and pay their commissions, one transaction per chunk.
+    If a chunk fails after others were committed, ImportInterrupted carries their counts.
+    """
+    packages = {}
+    plans = {}
+    for package in Package.objects.select_related('commission_plan'):
+        packages[str(package.pk)] = package
+        packages.setdefault(package.name, package)
+        plans[package.pk] = package.get_commission_plan()
+
+    stats = {'rows': 0, 'imported': 0, 'earnings': 0, 'errors': []}
+    reported = 0
+    try:
+        for chunk in chunked(enumerate(rows, start=1), chunk_size):
+            _import_purchase_chunk(chunk, packages, plans, stats)
+            stats['rows'] += len(chunk)
+            reported = len(stats['errors'])
+    except Exception as e:
+        if not stats['rows']:
+            raise
+        del stats['errors'][reported:]
+        raise ImportInterrupted(stats) from e
+    return stats
+
+
+def _import_purchase_chunk(chunk, packages, plans, stats):
+    keys = {str(row.get('user') or '').strip() for _, row in chunk}
+    users = {}
+    for user in User.objects.filter(
+        Q(username__in=keys) | Q(email__in=keys) | Q(wallet_address__in=keys)
+    ).only('id', 'username', 'email', 'wallet_address', 'path'):
+        for key in (user.username, user.email, user.wallet_address):
+            if key in keys:
+                users[key] = user
+
+    purchases = []
+    for line, row in chunk:
+        user = users.get(str(row.get('user') or '').strip())
+        package = packages.get(str(row.get('package') or '').strip())
+        if user is None or package is None:
+            if len(stats['errors']) < MAX_REPORTED_ERRORS:
+                stats['errors'].append({'row': line, 'error': 'Unknown user' if user is None else 'Unknown package'})
+            continue
+        purchases.append(Purchase(user=user, package=package))
+    if not purchases:
+        return
+
+    active_ids = None
+    if any(plans[purchase.package_id].compression for purchase in purchases):
+        upline_ids = {pk for purchase in purchases for pk in path_ids(purchase.user.path)}
+        active_ids = set(User.objects.filter(pk__in=upline_ids, is_active=True).values_list('id', flat=True))
+
+    with transaction.atomic():
+        Purchase.objects.bulk_create(purchases)
+        team_increments = None
+        for purchase in purchases:
+            volume = purchase.package.price
+            team_increments = upline_increments(purchase.user.path, volume=volume, direct_volume=volume, increments=team_increments)
+        increment_columns(User.objects.all(), team_increments)
+        earnings = []
+        for purchase in purchases:
+            plan = plans[purchase.package_id]
+            earnings.extend(purchase.build_earnings(plan, plan.select_uplines(purchase.user.path, active_ids)))
+        record_earnings(earnings)
+
+    stats['imported'] += len(purchases)
+    stats['earnings'] += len(earnings)
+
+
+def import_network(rows, chunk_size=1000):
+    """
+    Import user rows of the form {"username", "email", "password": <Django password hash or
+    empty for an unusable password>, "sponsor": <username or empty>, "wallet_address",
+    "sponsor_address"}. Sponsors must come before their recruits, either earlier in the
+    file or already in the database. Each chunk is inserted one generation at a time.
+    """
+    stats = {'rows': 0, 'imported': 0, 'errors': []}
+    for chunk in chunked(enumerate(rows, start=1), chunk_size):
+        stats['rows'] += len(chunk)
+        _import_user_chunk(chunk, stats)
+    return stats
+
+
+def _import_user_chunk(chunk, stats):
+    def error(line, message):
+        if len(stats['errors']) < MAX_REPORTED_ERRORS:
+            stats['errors'].append({'row': line, 'error': message})
+
+    rows = [(line, {key: str(row.get(key) or '').strip() for key in USER_COLUMNS}) for line, row in chunk]
+    # Sponsors from earlier chunks are already committed, so only this chunk's are ever held:
+    # those in the database up front, then each generation as it is inserted
+    sponsors = {
+        username: (pk, path) for pk, username, path in User.objects.filter(
+            username__in={row['sponsor'] for _, row in rows if row['sponsor']},
+        ).values_list('id', 'username', 'path')
+    }
+    taken = set()
+    for values in User.objects.filter(
+        Q(username__in=[row['username'] for _, row in rows]) | Q(email__in=[row['email'] for _, row in rows])
+        | Q(wallet_address__in=[row['wallet_address'] for _, row in rows if row['wallet_address']])
+    ).values_list('username', 'email', 'wallet_address'):
+        taken.update(values)
+
+    # Rows without a password share one unusable hash instead of drawing a fresh random one each
+    unusable_password = make_password(None)
+    # Rows whose sponsor is in this very chunk wait for its primary key, so users are inserted one
+    # generation at a time: a chunk costs one INSERT per level it spans, whatever the row order
+    generations = []
+    depth = {}  # username -> generation of each accepted row
+    for line, row in rows:
+        if not row['username'] or not row['email']:
+            error(line, 'Missing username or email')
+            continue
+        keys = {row['username'], row['email'], row['wallet_address']} - {''}
+        if not taken.isdisjoint(keys):
+            error(line, 'Duplicate username, email or wallet address')
+            continue
+        if row['password']:
+            try:
+                identify_hasher(row['password'])
+            except ValueError:
+                error(line, 'Password is not a recognised hash')
+                continue
+        if row['sponsor'] in depth:
+            generation = depth[row['sponsor']] + 1
+        elif not row['sponsor'] or row['sponsor'] in sponsors:
+            generation = 0
+        else:
+            error(line, 'Unknown sponsor')
+            continue
+        depth[row['username']] = generation
+        if generation == len(generations):
+            generations.append([])
+        generations[generation].append(row)
+        taken.update(keys)
+
+    with transaction.atomic():
+        team_increments = None
+        for generation in generations:
+            users = []
+            for row in generation:
+                sponsor_id, path = None, '/'
+                if row['sponsor']:
+                    sponsor = sponsors[row['sponsor']]
+                    sponsor_id, path = sponsor[0], f"{sponsor[1]}{sponsor[0]}/"
+                    team_increments = upline_increments(path, size=1, direct_size=1, increments=team_increments)
+                users.append(User(
+                    username=row['username'], email=row['email'], password=row['password'] or unusable_password,
+                    sponsor_id=sponsor_id, sponsor_address=row['sponsor_address'],
+                    wallet_address=row['wallet_address'] or None, path=path, level=path.count('/') - 1,
+                ))
+            User.objects.bulk_create(users)
+            for user in users:
+                sponsors[user.username] = (user.pk, user.path)
+            stats['imported'] += len(users)
+        if team_increments:
+            increment_columns(User.objects.all(), team_increments)
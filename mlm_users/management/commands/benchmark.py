@@ -0,0 +1,77 @@
+import json
+import platform
+import time
+
+import django
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+
+from mlm_users.benchmarks import DEFAULT_BUDGETS, build_network, run_benchmarks, run_concurrency_benchmark
+
+# The benchmark's throwaway users and responses must not land in the shared cache
+BENCHMARK_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'mlm-benchmark'}}
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the hot API endpoints against a generated network in a throwaway test database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--branching', default='3-5')
+        parser.add_argument('--depth', type=int, default=10)
+        parser.add_argument('--purchase-rate', type=float, default=1.5)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--iterations', type=int, default=5)
+        parser.add_argument('--only', nargs='+', choices=sorted(DEFAULT_BUDGETS), help='Run only these endpoints')
+        parser.add_argument('--budgets', help='JSON file of {"endpoint": {"queries": n, "wall_ms": n, "peak_kb": n}} overrides')
+        parser.add_argument(
+            '--asgi-concurrency', type=int, default=0,
+            help='Also compare sync and async read endpoints through the ASGI app with this many requests in flight',
+        )
+        parser.add_argument('--asgi-requests', type=int, default=200, help='Requests per endpoint and path for --asgi-concurrency')
+        parser.add_argument('--output', help='Write the JSON report here instead of stdout')
+
+    def handle(self, *args, **options):
+        budgets = None
+        if options['budgets']:
+            try:
+                with open(options['budgets']) as f:
+                    budgets = json.load(f)
+            except (OSError, ValueError) as e:
+                raise CommandError(f"Could not read budgets: {e}")
+
+        network = {key: options[key] for key in ('users', 'branching', 'depth', 'purchase_rate', 'seed')}
+        setup_test_environment()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            with override_settings(CACHES=BENCHMARK_CACHES):
+                cache.clear()
+                start = time.monotonic()
+                build_network(**network)
+                network['build_seconds'] = round(time.monotonic() - start, 2)
+                report = run_benchmarks(options['iterations'], budgets, options['only'])
+                if options['asgi_concurrency'] > 0:
+                    report['asgi'] = run_concurrency_benchmark(options['asgi_concurrency'], options['asgi_requests'])
+                cache.clear()
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        report = {
+            'environment': {'python': platform.python_version(), 'django': django.get_version(), 'database': connection.vendor},
+            'network': network,
+            'iterations': options['iterations'],
+            **report,
+        }
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        else:
+            self.stdout.write(output)
+        if not report['passed']:
+            failed = [name for name, result in report['results'].items() if not result['passed']]
+            raise CommandError(f"Over budget: {', '.join(failed)}")
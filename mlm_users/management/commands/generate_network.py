@@ -0,0 +1,179 @@
+import hashlib
+import random
+import time
+from array import array
+from decimal import Decimal
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from mlm_users.models import Earning, EarningDailyRollup, LedgerEntry, Package, Purchase, User, path_ids
+
+DEFAULT_PACKAGES = [
+    ('Bronze Package', Decimal('99.99'), Decimal('20.00')),
+    ('Silver Package', Decimal('299.99'), Decimal('30.00')),
+    ('Gold Package', Decimal('599.99'), Decimal('40.00')),
+    ('Platinum Package', Decimal('999.99'), Decimal('50.00')),
+    ('Diamond Package', Decimal('1999.99'), Decimal('60.00')),
+]
+
+
+def parse_branching(value):
+    low, _, high = value.partition('-')
+    low, high = int(low), int(high or low)
+    if low < 0 or high < low:
+        raise ValueError
+    return low, high
+
+
+def build_network(rng, users, roots, branching, depth, purchase_rate, package_count):
+    # Sponsors always precede their recruits (breadth first), so every level is one contiguous index range
+    sponsors = array('l', [-1] * min(roots, users))
+    levels = [(0, len(sponsors))]
+    while len(sponsors) < users and len(levels) <= depth:
+        start, end = levels[-1]
+        for sponsor in range(start, end):
+            for _ in range(rng.randint(*branching)):
+                if len(sponsors) >= users:
+                    break
+                sponsors.append(sponsor)
+        if len(sponsors) == end:
+            break
+        levels.append((end, len(sponsors)))
+
+    whole, fraction = divmod(purchase_rate, 1)
+    purchases = [
+        [rng.randrange(package_count) for _ in range(int(whole) + (rng.random() < fraction))]
+        for _ in range(len(sponsors))
+    ]
+    return sponsors, levels, purchases
+
+
+def team_counters(sponsors, own_volume):
+    # Recruits have higher indexes than their sponsors, so one reverse pass folds every subtree up
+    direct_size, size = array('l', [0] * len(sponsors)), array('l', [0] * len(sponsors))
+    direct_volume, volume = [Decimal('0.00')] * len(sponsors), [Decimal('0.00')] * len(sponsors)
+    for index in range(len(sponsors) - 1, -1, -1):
+        sponsor = sponsors[index]
+        if sponsor < 0:
+            continue
+        direct_size[sponsor] += 1
+        size[sponsor] += 1 + size[index]
+        direct_volume[sponsor] += own_volume[index]
+        volume[sponsor] += own_volume[index] + volume[index]
+    return direct_size, size, direct_volume, volume
+
+
+def commission_totals(sponsors, purchases, packages, plans):
+    # What every user is paid by their downline's purchases, summed up front so balances and
+    # rollups are inserted with the users instead of incremented as each earning is written
+    payouts = [
+        [amount for _, amount in plans[package.pk].compute_payouts(package.get_profit(), range(len(plans[package.pk].rates)))]
+        for package in packages
+    ]
+    earned, count = [Decimal('0.00')] * len(sponsors), array('l', [0] * len(sponsors))
+    for index in range(len(sponsors) - 1, -1, -1):
+        for package in purchases[index]:
+            # Every generated user is active, so compression never skips anyone
+            upline = sponsors[index]
+            for amount in payouts[package]:
+                if upline < 0:
+                    break
+                earned[upline] += amount
+                count[upline] += 1
+                upline = sponsors[upline]
+    return earned, count
+
+
+class Command(BaseCommand):
+    help = 'Generate a deterministic synthetic network of users, purchases and earnings for load testing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--users', type=int, default=1000, help='Target number of users')
+        parser.add_argument('--roots', type=int, default=1, help='Users without a sponsor')
+        parser.add_argument('--branching', default='3-5', help='Recruits per user, "N" or "MIN-MAX" drawn uniformly')
+        parser.add_argument('--depth', type=int, default=10, help='Deepest level below the roots')
+        parser.add_argument('--purchase-rate', type=float, default=1.5, help='Average purchases per user')
+        parser.add_argument('--prefix', default='user', help='Usernames are "<prefix>-<n>"')
+        parser.add_argument('--password', default='password123')
+        parser.add_argument('--chunk-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        try:
+            branching = parse_branching(options['branching'])
+        except ValueError:
+            raise CommandError(f"Invalid --branching '{options['branching']}', expected N or MIN-MAX")
+        prefix = options['prefix']
+        if User.objects.filter(username__startswith=f'{prefix}-').exists():
+            raise CommandError(f"Users named '{prefix}-*' already exist, pick another --prefix")
+
+        start = time.monotonic()
+        rng = random.Random(options['seed'])
+        packages = list(Package.objects.select_related('commission_plan').order_by('id'))
+        if not packages:
+            packages = Package.objects.bulk_create(
+                [Package(name=name, price=price, profit_percentage=profit) for name, price, profit in DEFAULT_PACKAGES]
+            )
+        plans = {package.pk: package.get_commission_plan() for package in packages}
+
+        sponsors, levels, purchases = build_network(
+            rng, options['users'], options['roots'], branching, options['depth'], options['purchase_rate'], len(packages),
+        )
+        own_volume = [sum((packages[package].price for package in bought), Decimal('0.00')) for bought in purchases]
+        direct_size, size, direct_volume, volume = team_counters(sponsors, own_volume)
+        earned, earning_counts = commission_totals(sponsors, purchases, packages, plans)
+        password = make_password(options['password'])
+        today = timezone.localdate()
+
+        pks = array('q', [0] * len(sponsors))
+        paths = {}
+        purchase_count = earning_count = 0
+        for level, (level_start, level_end) in enumerate(levels):
+            level_paths = {}
+            # Chunks never cross a level, so every sponsor already has its primary key
+            for chunk_start in range(level_start, level_end, options['chunk_size']):
+                indexes = range(chunk_start, min(chunk_start + options['chunk_size'], level_end))
+                users = []
+                for index in indexes:
+                    sponsor = sponsors[index]
+                    path = f"{paths[sponsor]}{pks[sponsor]}/" if sponsor >= 0 else '/'
+                    level_paths[index] = path
+                    username = f'{prefix}-{index}'
+                    users.append(User(
+                        username=username, email=f'{username}@example.com', password=password,
+                        wallet_address=f'0x{hashlib.sha1(username.encode()).hexdigest()}',
+                        sponsor_id=pks[sponsor] if sponsor >= 0 else None, path=path, level=level, direct_team_size=direct_size[index], team_size=size[index],
+                        direct_team_volume=direct_volume[index], team_volume=volume[index],
+                        total_earnings=earned[index], available_balance=earned[index],
+                    ))
+                with transaction.atomic():
+                    User.objects.bulk_create(users)
+                    chunk_purchases = []
+                    rollups = []
+                    for index, user in zip(indexes, users):
+                        pks[index] = user.pk
+                        chunk_purchases.extend(Purchase(user=user, package=packages[package]) for package in purchases[index])
+                        if earning_counts[index]:
+                            rollups.append(EarningDailyRollup(user=user, date=today, amount=earned[index], count=earning_counts[index]))
+                    Purchase.objects.bulk_create(chunk_purchases)
+                    EarningDailyRollup.objects.bulk_create(rollups)
+                    earnings = []
+                    for purchase in chunk_purchases:
+                        plan = plans[purchase.package_id]
+                        active_ids = set(path_ids(purchase.user.path)) if plan.compression else None
+                        earnings.extend(purchase.build_earnings(plan, plan.select_uplines(purchase.user.path, active_ids)))
+                    # The uplines were inserted already credited, so the rows go straight in, past record_earnings()
+                    Earning.objects.bulk_create(earnings)
+                    LedgerEntry.objects.bulk_create([LedgerEntry.for_earning(earning) for earning in earnings])
+                purchase_count += len(chunk_purchases)
+                earning_count += len(earnings)
+            paths = level_paths
+
+        elapsed = time.monotonic() - start
+        self.stdout.write(self.style.SUCCESS(
+            f"Generated {len(sponsors)} users over {len(levels)} levels, {purchase_count} purchases and "
+            f"{earning_count} earnings in {elapsed:.2f}s ({len(sponsors) / elapsed if elapsed else 0:.0f} users/s)"
+        ))
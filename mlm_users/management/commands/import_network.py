@@ -0,0 +1,35 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from mlm_users.imports import FORMATS, detect_format, import_network, read_rows
+
+
+class Command(BaseCommand):
+    help = 'Stream users from a CSV or NDJSON file in sponsor-first order and bulk insert them with their tree fields'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="File to import, or '-' for stdin")
+        parser.add_argument('--format', choices=FORMATS, help='Defaults to the file extension, else csv')
+        parser.add_argument('--chunk-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        fmt = options['format'] or detect_format(options['path'])
+        start = time.monotonic()
+        try:
+            if options['path'] == '-':
+                stats = import_network(read_rows(sys.stdin, fmt), options['chunk_size'])
+            else:
+                with open(options['path'], newline='', encoding='utf-8') as stream:
+                    stats = import_network(read_rows(stream, fmt), options['chunk_size'])
+        except (OSError, ValueError) as e:
+            raise CommandError(str(e))
+        elapsed = time.monotonic() - start
+
+        for error in stats['errors']:
+            self.stderr.write(f"Row {error['row']}: {error['error']}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {stats['imported']} of {stats['rows']} users "
+            f"in {elapsed:.2f}s ({stats['rows'] / elapsed if elapsed else 0:.0f} rows/s)"
+        ))
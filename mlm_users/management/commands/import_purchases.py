@@ -0,0 +1,40 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from mlm_users.imports import FORMATS, ImportInterrupted, detect_format, import_purchases, read_rows
+
+
+class Command(BaseCommand):
+    help = 'Stream purchases from a CSV or NDJSON file (user, package columns) and pay their commissions in bulk'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="File to import, or '-' for stdin")
+        parser.add_argument('--format', choices=FORMATS, help='Defaults to the file extension, else csv')
+        parser.add_argument('--chunk-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        fmt = options['format'] or detect_format(options['path'])
+        start = time.monotonic()
+        try:
+            if options['path'] == '-':
+                stats = import_purchases(read_rows(sys.stdin, fmt), options['chunk_size'])
+            else:
+                with open(options['path'], newline='', encoding='utf-8') as stream:
+                    stats = import_purchases(read_rows(stream, fmt), options['chunk_size'])
+        except ImportInterrupted as e:
+            raise CommandError(
+                f"{e.__cause__} (the first {e.stats['rows']} rows were committed: "
+                f"{e.stats['imported']} purchases, {e.stats['earnings']} earnings)"
+            )
+        except (OSError, ValueError) as e:
+            raise CommandError(str(e))
+        elapsed = time.monotonic() - start
+
+        for error in stats['errors']:
+            self.stderr.write(f"Row {error['row']}: {error['error']}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {stats['imported']} of {stats['rows']} purchases with {stats['earnings']} earnings "
+            f"in {elapsed:.2f}s ({stats['rows'] / elapsed if elapsed else 0:.0f} rows/s)"
+        ))
@@ -0,0 +1,46 @@
+import multiprocessing
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from mlm_users.models import CommissionJob
+
+
+def drain(batch_size, once, poll_interval):
+    claimed = completed = 0
+    while True:
+        batch_claimed, batch_completed = CommissionJob.process_batch(batch_size)
+        claimed += batch_claimed
+        completed += batch_completed
+        if not batch_claimed:
+            if once:
+                return claimed, completed
+            time.sleep(poll_interval)
+
+
+class Command(BaseCommand):
+    help = 'Drain the commission job queue, paying out queued purchases in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--processes', type=int, default=1)
+        parser.add_argument('--once', action='store_true', help='Exit once the queue is empty instead of polling')
+        parser.add_argument('--poll-interval', type=float, default=1.0)
+
+    def handle(self, *args, **options):
+        worker_args = (options['batch_size'], options['once'], options['poll_interval'])
+        start = time.monotonic()
+        if options['processes'] > 1:
+            # Never share the parent's database connections across forked workers
+            with multiprocessing.Pool(options['processes'], initializer=connections.close_all) as pool:
+                results = pool.starmap(drain, [worker_args] * options['processes'])
+        else:
+            results = [drain(*worker_args)]
+        claimed = sum(result[0] for result in results)
+        completed = sum(result[1] for result in results)
+        elapsed = time.monotonic() - start
+        self.stdout.write(self.style.SUCCESS(
+            f"Processed {claimed} jobs ({completed} paid, {claimed - completed} failed or retried) "
+            f"in {elapsed:.2f}s ({claimed / elapsed if elapsed else 0:.0f} jobs/s)"
+        ))
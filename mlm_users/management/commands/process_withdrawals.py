@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from mlm_users.models import Withdrawal
+
+
+class Command(BaseCommand):
+    help = 'Settle pending withdrawals in chunks, completing payable ones and refunding the rest'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        start = time.monotonic()
+        completed = rejected = 0
+        while True:
+            claimed, batch_completed, batch_rejected = Withdrawal.process_batch(options['batch_size'])
+            if not claimed:
+                break
+            completed += batch_completed
+            rejected += batch_rejected
+        processed = completed + rejected
+        elapsed = time.monotonic() - start
+        self.stdout.write(self.style.SUCCESS(
+            f"Processed {processed} withdrawals ({completed} completed, {rejected} rejected) "
+            f"in {elapsed:.2f}s ({processed / elapsed if elapsed else 0:.0f} withdrawals/s)"
+        ))
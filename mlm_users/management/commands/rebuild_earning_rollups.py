@@ -0,0 +1,35 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDate
+
+from mlm_users.models import Earning, EarningDailyRollup
+
+
+class Command(BaseCommand):
+    help = 'Recompute the daily earnings rollup table from the raw Earning rows'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        start = time.monotonic()
+        totals = (
+            Earning.objects.annotate(date=TruncDate('timestamp'))
+            .values('user_id', 'date')
+            .annotate(amount=Sum('amount'), count=Count('id'))
+            .order_by()
+        )
+        created = 0
+        with transaction.atomic():
+            EarningDailyRollup.objects.all().delete()
+            batch = []
+            for row in totals.iterator(chunk_size=options['chunk_size']):
+                batch.append(EarningDailyRollup(**row))
+                if len(batch) >= options['chunk_size']:
+                    created += len(EarningDailyRollup.objects.bulk_create(batch))
+                    batch = []
+            created += len(EarningDailyRollup.objects.bulk_create(batch))
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {created} daily rollups in {time.monotonic() - start:.2f}s"))
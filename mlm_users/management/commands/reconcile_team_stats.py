@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Sum
+
+from mlm_users.caching import TREE, invalidate
+from mlm_users.models import Purchase, User, team_stats
+
+
+class Command(BaseCommand):
+    help = 'Recompute team size and volume counters for every user in one bottom-up pass'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        start = time.monotonic()
+        own_volume = dict(Purchase.objects.values('user_id').annotate(volume=Sum('package__price')).values_list('user_id', 'volume').order_by())
+        users = list(User.objects.values_list('id', 'sponsor_id', 'level', 'direct_team_size', 'team_size', 'direct_team_volume', 'team_volume'))
+
+        stats = team_stats([(pk, sponsor_id, level) for pk, sponsor_id, level, *_ in users], own_volume)
+
+        changed = [
+            User(pk=pk, direct_team_size=stats[pk][0], team_size=stats[pk][1], direct_team_volume=stats[pk][2], team_volume=stats[pk][3])
+            for pk, _, _, *current in users
+            if list(current) != stats[pk]
+        ]
+        with transaction.atomic():
+            User.objects.bulk_update(
+                changed, ['direct_team_size', 'team_size', 'direct_team_volume', 'team_volume'], batch_size=options['batch_size'],
+            )
+            invalidate(TREE)
+        self.stdout.write(self.style.SUCCESS(
+            f"Reconciled {len(users)} users ({len(changed)} corrected) in {time.monotonic() - start:.2f}s"
+        ))
@@ -0,0 +1,18 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from mlm_users.models import BalanceSnapshot
+
+
+class Command(BaseCommand):
+    help = 'Snapshot user balances from the ledger so balance lookups only replay recent entries'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-entries', type=int, default=1, help='Skip users with fewer new ledger entries than this')
+        parser.add_argument('--chunk-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        start = time.monotonic()
+        created = BalanceSnapshot.capture(min_entries=options['min_entries'], chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(f"Created {created} balance snapshots in {time.monotonic() - start:.2f}s"))
@@ -0,0 +1,182 @@
+import bisect
+import heapq
+import json
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+logger = logging.getLogger('mlm_users.requests')
+
+# Upper bounds in milliseconds; anything slower lands in the final overflow bucket
+LATENCY_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+class LatencyHistogram:
+    # Per-endpoint latency buckets over a rolling window, kept as one slot per `slot` seconds
+    # so old traffic ages out without a background thread
+    def __init__(self, window=300, slot=10):
+        self.window = window
+        self.slot = slot
+        self.slots = defaultdict(deque)
+        self.lock = threading.Lock()
+
+    def record(self, endpoint, wall_ms, queries, now=None):
+        now = time.time() if now is None else now
+        start = int(now // self.slot) * self.slot
+        with self.lock:
+            slots = self.slots[endpoint]
+            if not slots or slots[-1]['start'] != start:
+                slots.append({'start': start, 'buckets': [0] * (len(LATENCY_BUCKETS) + 1), 'count': 0, 'total_ms': 0.0, 'queries': 0})
+            current = slots[-1]
+            current['buckets'][bisect.bisect_left(LATENCY_BUCKETS, wall_ms)] += 1
+            current['count'] += 1
+            current['total_ms'] += wall_ms
+            current['queries'] += queries
+            self.prune(slots, now)
+
+    def prune(self, slots, now):
+        while slots and slots[0]['start'] + self.slot <= now - self.window:
+            slots.popleft()
+
+    def snapshot(self, now=None):
+        now = time.time() if now is None else now
+        endpoints = {}
+        with self.lock:
+            for endpoint, slots in self.slots.items():
+                self.prune(slots, now)
+                if not slots:
+                    continue
+                buckets = [sum(slot['buckets'][i] for slot in slots) for i in range(len(LATENCY_BUCKETS) + 1)]
+                count = sum(slot['count'] for slot in slots)
+                endpoints[endpoint] = {
+                    'count': count,
+                    'mean_ms': round(sum(slot['total_ms'] for slot in slots) / count, 2),
+                    'mean_queries': round(sum(slot['queries'] for slot in slots) / count, 2),
+                    'p50_ms': self.percentile(buckets, count, 0.50),
+                    'p95_ms': self.percentile(buckets, count, 0.95),
+                    'p99_ms': self.percentile(buckets, count, 0.99),
+                    'buckets': {str(bound): n for bound, n in zip([*LATENCY_BUCKETS, '+Inf'], buckets)},
+                }
+        return {'window_seconds': self.window, 'endpoints': endpoints}
+
+    @staticmethod
+    def percentile(buckets, count, quantile):
+        # Reported as the upper bound of the bucket holding the quantile, None past the last bound
+        seen = 0
+        for bound, n in zip(LATENCY_BUCKETS, buckets):
+            seen += n
+            if seen >= quantile * count:
+                return bound
+        return None
+
+
+histogram = LatencyHistogram(settings.MLM_METRICS_WINDOW)
+
+
+class QueryRecorder:
+    def __init__(self, keep):
+        self.keep = keep
+        self.count = 0
+        self.total_ms = 0.0
+        self.slowest = []  # min-heap of (ms, sql) holding the `keep` slowest statements
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            ms = (time.perf_counter() - start) * 1000
+            self.count += 1
+            self.total_ms += ms
+            entry = (ms, sql)
+            if len(self.slowest) < self.keep:
+                heapq.heappush(self.slowest, entry)
+            elif entry > self.slowest[0]:
+                heapq.heapreplace(self.slowest, entry)
+
+
+# The recorder of the request being served. Context variables follow a request into the
+# sync_to_async threads its ORM calls run on, where thread-local connection wrappers would not
+current_recorder = ContextVar('mlm_query_recorder', default=None)
+
+
+def record_query(execute, sql, params, many, context):
+    recorder = current_recorder.get()
+    if recorder is None:
+        return execute(sql, params, many, context)
+    return recorder(execute, sql, params, many, context)
+
+
+@receiver(connection_created)
+def install_query_recorder(sender, connection, **kwargs):
+    # Connections are per thread, so every one of them gets the wrapper as it first connects. It goes
+    # outermost, below any execute_wrapper() block that was open when the connection was made
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, record_query)
+
+
+class RequestMetricsMiddleware:
+    # Times every request and its SQL; debug responses carry the numbers as headers, otherwise
+    # they go out as one JSON log line per request. Runs natively on both sides of an ASGI stack
+    # so async views are not pushed back onto a thread
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        recorder = QueryRecorder(settings.MLM_METRICS_SLOW_QUERIES)
+        start = time.perf_counter()
+        token = current_recorder.set(recorder)
+        try:
+            response = self.get_response(request)
+        finally:
+            current_recorder.reset(token)
+        return self.report(request, response, recorder, start)
+
+    async def __acall__(self, request):
+        recorder = QueryRecorder(settings.MLM_METRICS_SLOW_QUERIES)
+        start = time.perf_counter()
+        token = current_recorder.set(recorder)
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_recorder.reset(token)
+        return self.report(request, response, recorder, start)
+
+    def report(self, request, response, recorder, start):
+        wall_ms = (time.perf_counter() - start) * 1000
+        match = getattr(request, 'resolver_match', None)
+        endpoint = f"{request.method} {match.view_name if match else 'unresolved'}"
+        histogram.record(endpoint, wall_ms, recorder.count)
+        slowest = [{'ms': round(ms, 2), 'sql': sql[:500]} for ms, sql in sorted(recorder.slowest, reverse=True)]
+
+        if settings.DEBUG:
+            response['X-Request-Time-ms'] = f'{wall_ms:.2f}'
+            response['X-Query-Count'] = str(recorder.count)
+            response['X-SQL-Time-ms'] = f'{recorder.total_ms:.2f}'
+            if slowest:
+                response['X-Slowest-Query-ms'] = f"{slowest[0]['ms']:.2f}"
+        elif logger.isEnabledFor(logging.INFO):
+            logger.info(json.dumps({
+                'endpoint': endpoint,
+                'path': request.path,
+                'status': response.status_code,
+                'wall_ms': round(wall_ms, 2),
+                'queries': recorder.count,
+                'sql_ms': round(recorder.total_ms, 2),
+                'slowest': slowest,
+            }))
+        return response
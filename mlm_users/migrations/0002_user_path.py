@@ -0,0 +1,52 @@
+# Generated by Django 5.0.6 on 2026-10-18 09:01
+
+from django.db import migrations, models
+
+
+def backfill_paths(apps, schema_editor):
+    User = apps.get_model('mlm_users', 'User')
+    sponsors = dict(User.objects.values_list('id', 'sponsor_id'))
+    paths = {}
+
+    def resolve(user_id):
+        chain = []
+        seen = set()
+        while user_id is not None and user_id not in paths and user_id not in seen:
+            seen.add(user_id)
+            chain.append(user_id)
+            user_id = sponsors.get(user_id)
+        # Users caught in a sponsor cycle are re-rooted rather than looping forever
+        path = f"{paths[user_id]}{user_id}/" if user_id in paths else '/'
+        for pk in reversed(chain):
+            paths[pk] = path
+            path = f"{path}{pk}/"
+
+    for user_id in sponsors:
+        resolve(user_id)
+
+    batch = []
+    for user in User.objects.only('id').iterator(chunk_size=2000):
+        user.path = paths[user.id]
+        user.level = user.path.count('/') - 1
+        batch.append(user)
+        if len(batch) >= 2000:
+            User.objects.bulk_update(batch, ['path', 'level'])
+            batch = []
+    if batch:
+        User.objects.bulk_update(batch, ['path', 'level'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mlm_users', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='path',
+            field=models.TextField(db_index=True, default='/', editable=False),
+        ),
+        migrations.RunPython(backfill_paths, migrations.RunPython.noop),
+    ]
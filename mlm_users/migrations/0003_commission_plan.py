@@ -0,0 +1,28 @@
+# Generated by Django 5.0.6 on 2026-10-18 09:07
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mlm_users', '0002_user_path'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CommissionPlan',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('rates', models.JSONField(default=list, help_text='Percent of the purchase profit paid per upline level, nearest first, e.g. ["30", "10"].')),
+                ('compression', models.BooleanField(default=False, help_text='Skip inactive uplines so the next active one takes their level.')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='package',
+            name='commission_plan',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='packages', to='mlm_users.commissionplan'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.0.6 on 2026-10-18 09:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mlm_users', '0004_commission_job'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='user',
+            name='level',
+            field=models.PositiveIntegerField(db_index=True, default=0),
+        ),
+        migrations.AddIndex(
+            model_name='earning',
+            index=models.Index(fields=['user', 'timestamp'], name='earning_user_timestamp_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='purchase',
+            index=models.Index(fields=['user', 'timestamp'], name='purchase_user_timestamp_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='withdrawal',
+            index=models.Index(fields=['user', 'timestamp'], name='withdrawal_user_timestamp_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='withdrawal',
+            index=models.Index(fields=['user', 'status'], name='withdrawal_user_status_idx'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.0.6 on 2026-10-18 09:18
+
+import django.db.models.deletion
+from decimal import Decimal
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mlm_users', '0005_history_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EarningDailyRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('amount', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=10)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='earning_rollups', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='earningdailyrollup',
+            constraint=models.UniqueConstraint(fields=('user', 'date'), name='earning_rollup_user_date_uniq'),
+        ),
+    ]
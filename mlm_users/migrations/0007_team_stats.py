@@ -0,0 +1,56 @@
+# Generated by Django 5.0.6 on 2026-10-18 09:21
+
+from decimal import Decimal
+from django.db import migrations, models
+from django.db.models import Sum
+
+from mlm_users.models import team_stats
+
+
+def backfill_team_stats(apps, schema_editor):
+    # Without this, existing sponsors start at zero and the next move or delete
+    # decrements them below zero, which the positive integer CHECK rejects
+    User = apps.get_model('mlm_users', 'User')
+    Purchase = apps.get_model('mlm_users', 'Purchase')
+    own_volume = dict(Purchase.objects.values('user_id').annotate(volume=Sum('package__price')).values_list('user_id', 'volume').order_by())
+    stats = team_stats(list(User.objects.values_list('id', 'sponsor_id', 'level')), own_volume)
+    batch = []
+    for pk, (direct_size, size, direct_volume, volume) in stats.items():
+        if size:
+            batch.append(User(pk=pk, direct_team_size=direct_size, team_size=size, direct_team_volume=direct_volume, team_volume=volume))
+        if len(batch) >= 2000:
+            User.objects.bulk_update(batch, ['direct_team_size', 'team_size', 'direct_team_volume', 'team_volume'])
+            batch = []
+    if batch:
+        User.objects.bulk_update(batch, ['direct_team_size', 'team_size', 'direct_team_volume', 'team_volume'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mlm_users', '0006_earning_daily_rollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='direct_team_size',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='direct_team_volume',
+            field=models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=14),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='team_size',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='team_volume',
+            field=models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=14),
+        ),
+        migrations.RunPython(backfill_team_stats, migrations.RunPython.noop),
+    ]
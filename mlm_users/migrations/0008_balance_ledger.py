@@ -0,0 +1,73 @@
+# Generated by Django 5.0.6 on 2026-10-18 09:40
+
+import heapq
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_ledger(apps, schema_editor):
+    Earning = apps.get_model('mlm_users', 'Earning')
+    Withdrawal = apps.get_model('mlm_users', 'Withdrawal')
+    LedgerEntry = apps.get_model('mlm_users', 'LedgerEntry')
+
+    # Entries are written in timestamp order so ledger ids stay chronological
+    credits = (
+        (timestamp, LedgerEntry(user_id=user_id, amount=amount, kind='earning', earning_id=pk, timestamp=timestamp))
+        for pk, user_id, amount, timestamp in Earning.objects.order_by('timestamp', 'id')
+        .values_list('id', 'user_id', 'amount', 'timestamp').iterator(chunk_size=2000)
+    )
+    debits = (
+        (timestamp, LedgerEntry(user_id=user_id, amount=-amount, kind='withdrawal', withdrawal_id=pk, timestamp=timestamp))
+        for pk, user_id, amount, timestamp in Withdrawal.objects.exclude(status='rejected').order_by('timestamp', 'id')
+        .values_list('id', 'user_id', 'amount', 'timestamp').iterator(chunk_size=2000)
+    )
+    batch = []
+    for _, entry in heapq.merge(credits, debits, key=lambda item: item[0]):
+        batch.append(entry)
+        if len(batch) >= 2000:
+            LedgerEntry.objects.bulk_create(batch)
+            batch = []
+    if batch:
+        LedgerEntry.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mlm_users', '0007_team_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BalanceSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('balance', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('last_entry_id', models.BigIntegerField()),
+                ('timestamp', models.DateTimeField()),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='balance_snapshots', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'last_entry_id'], name='snapshot_user_entry_idx'), models.Index(fields=['user', 'timestamp'], name='snapshot_user_timestamp_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='LedgerEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('kind', models.CharField(choices=[('earning', 'Earning'), ('withdrawal', 'Withdrawal'), ('withdrawal_reversal', 'Withdrawal reversal')], max_length=20)),
+                ('timestamp', models.DateTimeField(default=django.utils.timezone.now)),
+                ('earning', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='mlm_users.earning')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ledger_entries', to=settings.AUTH_USER_MODEL)),
+                ('withdrawal', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='mlm_users.withdrawal')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'id'], name='ledger_user_id_idx'), models.Index(fields=['user', 'timestamp'], name='ledger_user_timestamp_idx')],
+            },
+        ),
+        migrations.RunPython(backfill_ledger, migrations.RunPython.noop),
+    ]
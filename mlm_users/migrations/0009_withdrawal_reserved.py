@@ -0,0 +1,26 @@
+# Generated by Django 5.0.6 on 2026-10-18 14:05
+
+from django.db import migrations, models
+
+
+def mark_unreserved(apps, schema_editor):
+    # Withdrawals requested before funds were reserved never debited available_balance, so
+    # rejecting one must not refund it
+    Withdrawal = apps.get_model('mlm_users', 'Withdrawal')
+    Withdrawal.objects.update(reserved=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mlm_users', '0008_balance_ledger'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='withdrawal',
+            name='reserved',
+            field=models.BooleanField(default=True, editable=False),
+        ),
+        migrations.RunPython(mark_unreserved, migrations.RunPython.noop),
+    ]
@@ -1,23 +1,68 @@
+from django.conf import settings
 from django.contrib.auth.models import AbstractUser
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Case, F, Max, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Concat, Length, Replace, Substr
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save, pre_delete
 from django.dispatch import receiver
 from django.core.exceptions import ValidationError
+from collections import defaultdict
+from datetime import timedelta
 from decimal import Decimal
+import uuid
+
+from .caching import PACKAGES, TREE, invalidate, invalidate_users
+from .events import balance_changed, earnings_created
+
+CENT = Decimal('0.01')
+
+def path_ids(path):
+    return [int(pk) for pk in path.split('/') if pk]
+
+def subtree_filter(subtree_path):
+    # Paths under subtree_path sort between it and the same string ending in '0' instead of '/',
+    # a range the path index can seek, where LIKE 'prefix%' would scan the whole table
+    return Q(path__gte=subtree_path, path__lt=subtree_path[:-1] + '0')
 
 class User(AbstractUser):
     sponsor = models.ForeignKey('self', on_delete=models.SET_NULL, null=True, blank=True, related_name='sponsored_users')
     sponsor_address = models.CharField(_("Sponsor's Address"), max_length=255, blank=True)
-    level = models.PositiveIntegerField(default=0)
+    level = models.PositiveIntegerField(default=0, db_index=True)
+    # Materialized path of upline ids, e.g. "/1/5/" for a user sponsored by 5 who was sponsored by 1
+    path = models.TextField(default='/', db_index=True, editable=False)
     total_earnings = models.DecimalField(max_digits=10, decimal_places=2, default=Decimal('0.00'))
     available_balance = models.DecimalField(max_digits=10, decimal_places=2, default=Decimal('0.00'))
     email = models.EmailField(unique=True)
     wallet_address = models.CharField(max_length=255, unique=True, blank=True, null=True)
+    # Downline counters, kept current by set-based UPDATEs along the upline path
+    direct_team_size = models.PositiveIntegerField(default=0)
+    team_size = models.PositiveIntegerField(default=0)
+    direct_team_volume = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal('0.00'))
+    team_volume = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal('0.00'))
+
+    TREE_FIELDS = ('path', 'level', 'direct_team_size', 'team_size', 'direct_team_volume', 'team_volume')
+    # Only ever changed by F() increments, so full saves leave them alone; name them in update_fields to set them
+    BALANCE_FIELDS = ('total_earnings', 'available_balance')
 
     def __str__(self):
         return self.username
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_sponsor_id = instance.__dict__.get('sponsor_id')
+        return instance
+
+    @property
+    def subtree_path(self):
+        return f"{self.path}{self.pk}/"
+
+    @property
+    def ancestor_ids(self):
+        return path_ids(self.path)
+
     def clean(self):
         if self.sponsor:
             if self.sponsor == self:
@@ -26,80 +71,335 @@ class User(AbstractUser):
                 raise ValidationError("Circular sponsorship is not allowed.")
 
     def save(self, *args, **kwargs):
-        if self.sponsor:
+        if self._state.adding:
+            self.path = '/'
+            if self.sponsor_id is not None:
+                self.path = f"{User.objects.values_list('path', flat=True).get(pk=self.sponsor_id)}{self.sponsor_id}/"
+            self.level = self.path.count('/') - 1
+            with transaction.atomic():
+                super().save(*args, **kwargs)
+                if self.sponsor_id is not None:
+                    increment_columns(User.objects.all(), upline_increments(self.path, size=1, direct_size=1))
+            self._loaded_sponsor_id = self.sponsor_id
+            return
+
+        if self.sponsor_id != getattr(self, '_loaded_sponsor_id', None):
             try:
-                self.clean()
-                self.level = self.sponsor.level + 1
+                self.move_to(self.sponsor)
             except ValidationError:
-                if self.pk:
-                    self.sponsor = User.objects.get(pk=self.pk).sponsor
-                else:
-                    self.sponsor = None
-                self.level = 0 if self.sponsor is None else self.sponsor.level + 1
+                self.sponsor_id = getattr(self, '_loaded_sponsor_id', None)
+        # path/level are maintained by move_to, so never write back possibly stale values
+        if kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                f.name for f in self._meta.concrete_fields
+                if not f.primary_key and f.name not in self.TREE_FIELDS and f.name not in self.BALANCE_FIELDS
+            ]
+        else:
+            kwargs['update_fields'] = set(kwargs['update_fields']) - set(self.TREE_FIELDS)
         super().save(*args, **kwargs)
 
+    def move_to(self, sponsor):
+        # Constant query count however deep the subtree is; returns the number of rows changed
+        with transaction.atomic():
+            current = User.objects.select_for_update().only('path', 'level', 'team_size', 'team_volume').get(pk=self.pk)
+            if sponsor is None:
+                path = '/'
+            else:
+                sponsor_path = User.objects.select_for_update().values_list('path', flat=True).get(pk=sponsor.pk)
+                if sponsor.pk == self.pk or f"/{self.pk}/" in sponsor_path:
+                    raise ValidationError("Circular sponsorship is not allowed.")
+                path = f"{sponsor_path}{sponsor.pk}/"
+            level = path.count('/') - 1
+
+            User.objects.filter(pk=self.pk).update(sponsor=sponsor, path=path, level=level)
+            old_subtree_path = current.subtree_path
+            new_subtree_path = f"{path}{self.pk}/"
+            changed = 1
+            if new_subtree_path != old_subtree_path:
+                changed += User.objects.filter(subtree_filter(old_subtree_path)).update(
+                    path=Concat(Value(new_subtree_path), Substr('path', len(old_subtree_path) + 1)),
+                    level=F('level') + (level - current.level),
+                )
+
+            # Take the subtree's counters off the old upline and add them to the new one in one UPDATE
+            own_volume = self.get_own_volume()
+            moved_size = 1 + current.team_size
+            moved_volume = own_volume + current.team_volume
+            increments = upline_increments(current.path, -moved_size, -moved_volume, -1, -own_volume)
+            upline_increments(path, moved_size, moved_volume, 1, own_volume, increments=increments)
+            increment_columns(User.objects.all(), increments)
+            invalidate(TREE)
+
+        self.sponsor, self.path, self.level = sponsor, path, level
+        self._loaded_sponsor_id = self.sponsor_id
+        return changed
+
+    def get_balance(self, at=None):
+        # Nearest snapshot plus the ledger entries written after it; the entries scanned are
+        # bounded by the snapshot interval, however long the history is
+        snapshots = self.balance_snapshots.all()
+        entries = self.ledger_entries.all()
+        if at is not None:
+            later = snapshots.filter(timestamp__gt=at).order_by('last_entry_id').first()
+            if later is not None:
+                entries = entries.filter(id__lte=later.last_entry_id)
+            snapshots = snapshots.filter(timestamp__lte=at)
+            entries = entries.filter(timestamp__lte=at)
+        snapshot = snapshots.order_by('-last_entry_id').first()
+        if snapshot is not None:
+            entries = entries.filter(id__gt=snapshot.last_entry_id)
+        delta = entries.aggregate(total=Sum('amount'))['total'] or Decimal('0.00')
+        return (snapshot.balance if snapshot else Decimal('0.00')) + delta
+
+    def get_own_volume(self):
+        return Purchase.objects.filter(user_id=self.pk).aggregate(volume=Sum('package__price'))['volume'] or Decimal('0.00')
+
     def is_ancestor(self, user):
         if not user:
             return False
-        if user == self:
-            return True
-        return self.is_ancestor(user.sponsor)
+        return user.pk == self.pk or self.pk in user.ancestor_ids
+
+    def get_ancestors(self):
+        return User.objects.filter(pk__in=self.ancestor_ids)
+
+    def get_descendants(self):
+        return User.objects.filter(subtree_filter(self.subtree_path))
 
     def update_levels(self):
-        for user in self.sponsored_users.all():
-            user.level = self.level + 1
-            user.save()
-            user.update_levels()
+        depth = Length('path') - Length(Replace('path', Value('/'), Value(''))) - 1
+        updated = self.get_descendants().update(level=depth)
+        invalidate(TREE)
+        return updated
 
     def get_team(self, levels=2):
-        team = []
-        queue = [(self, 0)]
-        while queue:
-            user, current_level = queue.pop(0)
-            if current_level < levels:
-                sponsored = user.sponsored_users.all()
-                team.extend(sponsored)
-                queue.extend((sponsored_user, current_level + 1) for sponsored_user in sponsored)
-        return team
+        return self.get_descendants().filter(level__lte=self.level + levels).order_by('level', 'id')
 
 @receiver(post_save, sender=User)
-def user_post_save(sender, instance, created, **kwargs):
-    if created and instance.sponsor:
-        instance.update_levels()
+@receiver(post_delete, sender=User)
+def user_changed(sender, instance, **kwargs):
+    # The user's row also appears in the team listings of their upline
+    invalidate_users([instance.pk, *path_ids(instance.path)])
+
+@receiver(pre_delete, sender=User)
+def user_pre_delete(sender, instance, **kwargs):
+    # Sponsored users become roots (sponsor is SET_NULL), so re-root their subtrees too
+    for user in instance.sponsored_users.all():
+        user.move_to(None)
+    path = User.objects.values_list('path', flat=True).get(pk=instance.pk)
+    own_volume = instance.get_own_volume()
+    increment_columns(User.objects.all(), upline_increments(path, -1, -own_volume, -1, -own_volume))
+
+def increment_columns(queryset, increments, key='pk', batch_size=500):
+    # Apply {key value: {column: delta}} with one UPDATE per batch of keys; conditional F()
+    # increments keep concurrent writers exact without locking or reading the rows first
+    items = list(increments.items())
+    columns = {column for _, deltas in items for column in deltas}
+    updated = 0
+    for start in range(0, len(items), batch_size):
+        batch = items[start:start + batch_size]
+        changes = {}
+        for column in columns:
+            # Keys are grouped by delta, one WHEN per distinct delta, and the most common delta
+            # becomes the CASE default, so uniform upline increments need no WHENs at all
+            by_delta = defaultdict(list)
+            for value, deltas in batch:
+                by_delta[deltas.get(column, 0)].append(value)
+            common = max(by_delta, key=lambda delta: len(by_delta[delta]))
+            whens = [
+                When(**{f'{key}__in': values}, then=Value(delta))
+                for delta, values in by_delta.items() if delta != common
+            ]
+            if whens or common:
+                changes[column] = F(column) + Case(
+                    *whens, default=Value(common), output_field=queryset.model._meta.get_field(column),
+                )
+        if changes:
+            updated += queryset.filter(**{f'{key}__in': [value for value, _ in batch]}).update(**changes)
+    if queryset.model is User and key == 'pk':
+        invalidate_users(increments)
+    return updated
+
+def upline_increments(path, size=0, volume=0, direct_size=0, direct_volume=0, increments=None):
+    # Accumulate team counter deltas for every upline in path; the direct sponsor also gets direct_*
+    if increments is None:
+        increments = defaultdict(lambda: defaultdict(int))
+    ids = path_ids(path)
+    for pk in ids:
+        increments[pk]['team_size'] += size
+        increments[pk]['team_volume'] += volume
+    if ids:
+        increments[ids[-1]]['direct_team_size'] += direct_size
+        increments[ids[-1]]['direct_team_volume'] += direct_volume
+    return increments
+
+def team_stats(users, own_volume):
+    # Recompute every team counter from scratch, given (pk, sponsor_id, level) rows and each user's own purchase volume
+    stats = {pk: [0, 0, Decimal('0.00'), Decimal('0.00')] for pk, _, _ in users}
+    # Deepest users first, so every child is complete before it is folded into its sponsor
+    for pk, sponsor_id, _ in sorted(users, key=lambda user: user[2], reverse=True):
+        if sponsor_id is None or sponsor_id not in stats:
+            continue
+        child, parent = stats[pk], stats[sponsor_id]
+        parent[0] += 1
+        parent[1] += 1 + child[1]
+        parent[2] += own_volume.get(pk, 0)
+        parent[3] += own_volume.get(pk, 0) + child[3]
+    return stats
+
+def credit_balances(credits):
+    credits = {user_id: amount for user_id, amount in credits.items() if amount}
+    updated = increment_columns(
+        User.objects.all(),
+        {user_id: {'total_earnings': amount, 'available_balance': amount} for user_id, amount in credits.items()},
+    )
+    balance_changed(credits)
+    return updated
+
+class CommissionPlan(models.Model):
+    name = models.CharField(max_length=255)
+    rates = models.JSONField(default=list, help_text="Percent of the purchase profit paid per upline level, nearest first, e.g. [\"30\", \"10\"].")
+    compression = models.BooleanField(default=False, help_text="Skip inactive uplines so the next active one takes their level.")
+
+    def __str__(self):
+        return self.name
+
+    def clean(self):
+        try:
+            rates = self.get_rates()
+        except (TypeError, ArithmeticError):
+            raise ValidationError("Rates must be a list of percentages.")
+        if any(rate < 0 for rate in rates) or sum(rates) > 1:
+            raise ValidationError("Rates must be non-negative and add up to at most 100%.")
+
+    def get_rates(self):
+        return [Decimal(str(rate)) / Decimal('100') for rate in self.rates]
+
+    @classmethod
+    def default(cls):
+        return cls(name='Default', rates=settings.MLM_COMMISSION_RATES)
+
+    def resolve_uplines(self, user_id):
+        # Whole upline chain (nearest first) from a fresh path read, since the
+        # in-memory buyer may predate a sponsor move
+        path = User.objects.values_list('path', flat=True).get(pk=user_id)
+        active_ids = None
+        if self.compression:
+            active_ids = set(User.objects.filter(pk__in=path_ids(path), is_active=True).values_list('id', flat=True))
+        return self.select_uplines(path, active_ids)
+
+    def select_uplines(self, path, active_ids=None):
+        uplines = path_ids(path)[::-1]
+        if self.compression:
+            uplines = [pk for pk in uplines if pk in active_ids]
+        return uplines[:len(self.rates)]
+
+    def compute_payouts(self, profit, uplines):
+        return [
+            (user_id, (profit * rate).quantize(CENT))
+            for user_id, rate in zip(uplines, self.get_rates())
+        ]
 
 class Package(models.Model):
     name = models.CharField(max_length=255)
     price = models.DecimalField(max_digits=10, decimal_places=2)
     profit_percentage = models.DecimalField(max_digits=5, decimal_places=2)  # e.g., 40.00 for 40%
+    commission_plan = models.ForeignKey(CommissionPlan, on_delete=models.SET_NULL, null=True, blank=True, related_name='packages')
 
     def __str__(self):
         return self.name
 
+    def get_profit(self):
+        return Decimal(str(self.price)) * Decimal(str(self.profit_percentage)) / Decimal('100')
+
+    def get_commission_plan(self):
+        return self.commission_plan or CommissionPlan.default()
+
+@receiver(post_save, sender=Package)
+@receiver(post_delete, sender=Package)
+def package_changed(sender, **kwargs):
+    invalidate(PACKAGES)
+
 class Purchase(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='purchases')
     package = models.ForeignKey(Package, on_delete=models.CASCADE)
     timestamp = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [models.Index(fields=['user', 'timestamp'], name='purchase_user_timestamp_idx')]
+
     def __str__(self):
         return f"{self.user.username} - {self.package.name}"
 
+    def build_earnings(self, plan, uplines):
+        profit = self.package.get_profit()
+        description = f"Profit from {self.user.username}'s purchase of {self.package.name}"
+        return [
+            Earning(user_id=user_id, amount=amount, description=description)
+            for user_id, amount in plan.compute_payouts(profit, uplines)
+        ]
+
     def distribute_profit(self):
-        profit = self.package.price * (self.package.profit_percentage / Decimal('100'))
-        sponsor = self.user.sponsor
-        if sponsor:
-            sponsor_earning = profit * Decimal('0.30')
-            Earning.objects.create(user=sponsor, amount=sponsor_earning, description=f"Profit from {self.user.username}'s purchase of {self.package.name}")
-            sponsor.total_earnings += sponsor_earning
-            sponsor.available_balance += sponsor_earning
-            sponsor.save()
-
-            grand_sponsor = sponsor.sponsor
-            if grand_sponsor:
-                grand_sponsor_earning = profit * Decimal('0.10')
-                Earning.objects.create(user=grand_sponsor, amount=grand_sponsor_earning, description=f"Profit from {self.user.username}'s purchase of {self.package.name}")
-                grand_sponsor.total_earnings += grand_sponsor_earning
-                grand_sponsor.available_balance += grand_sponsor_earning
-                grand_sponsor.save()
+        plan = self.package.get_commission_plan()
+        with transaction.atomic():
+            created = record_earnings(self.build_earnings(plan, plan.resolve_uplines(self.user_id)))
+        # Credited uplines show up in the team listings of everyone above them
+        invalidate_users(path_ids(self.user.path))
+        return created
+
+class CommissionJob(models.Model):
+    PENDING = 'pending'
+    PROCESSING = 'processing'
+    COMPLETED = 'completed'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(PENDING, 'Pending'), (PROCESSING, 'Processing'), (COMPLETED, 'Completed'), (FAILED, 'Failed')]
+
+    purchase = models.OneToOneField(Purchase, on_delete=models.CASCADE, related_name='commission_job')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=PENDING, db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+    claimed_by = models.CharField(max_length=64, blank=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Commission job for purchase {self.purchase_id} ({self.status})"
+
+    @classmethod
+    def claim(cls, batch_size):
+        # Requeue claims abandoned by a crashed worker, then claim with a conditional UPDATE so
+        # concurrent workers never get the same rows, on any database backend
+        stale = timezone.now() - timedelta(seconds=settings.MLM_COMMISSION_CLAIM_TIMEOUT)
+        cls.objects.filter(status=cls.PROCESSING, claimed_at__lt=stale).update(status=cls.PENDING)
+        token = uuid.uuid4().hex
+        ids = list(cls.objects.filter(status=cls.PENDING).order_by('id').values_list('id', flat=True)[:batch_size])
+        cls.objects.filter(id__in=ids, status=cls.PENDING).update(
+            status=cls.PROCESSING, claimed_by=token, claimed_at=timezone.now(), attempts=F('attempts') + 1,
+        )
+        return list(
+            cls.objects.filter(claimed_by=token, status=cls.PROCESSING)
+            .select_related('purchase__user', 'purchase__package__commission_plan')
+            .order_by('id')
+        )
+
+    @classmethod
+    def process_batch(cls, batch_size=100):
+        jobs = cls.claim(batch_size)
+        return len(jobs), sum(job.run() for job in jobs)
+
+    def run(self):
+        mine = CommissionJob.objects.filter(pk=self.pk, claimed_by=self.claimed_by, status=self.PROCESSING)
+        try:
+            with transaction.atomic():
+                # Flip the status first so a job requeued from under a slow worker is never paid twice
+                if not mine.update(status=self.COMPLETED, error='', completed_at=timezone.now()):
+                    return False
+                self.purchase.distribute_profit()
+        except Exception as e:
+            status = self.FAILED if self.attempts >= settings.MLM_COMMISSION_MAX_ATTEMPTS else self.PENDING
+            mine.update(status=status, error=str(e))
+            return False
+        return True
 
 class Earning(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='earnings')
@@ -107,8 +407,283 @@ class Earning(models.Model):
     description = models.CharField(max_length=255)
     timestamp = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [models.Index(fields=['user', 'timestamp'], name='earning_user_timestamp_idx')]
+
+class EarningDailyRollup(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='earning_rollups')
+    date = models.DateField()
+    amount = models.DecimalField(max_digits=10, decimal_places=2, default=Decimal('0.00'))
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['user', 'date'], name='earning_rollup_user_date_uniq')]
+
+    @classmethod
+    def add(cls, earnings):
+        by_date = defaultdict(lambda: defaultdict(lambda: {'amount': Decimal('0.00'), 'count': 0}))
+        for earning in earnings:
+            totals = by_date[timezone.localdate(earning.timestamp)][earning.user_id]
+            totals['amount'] += Decimal(str(earning.amount))
+            totals['count'] += 1
+        for date, totals in by_date.items():
+            # Make sure every row exists, then increment them all in place
+            cls.objects.bulk_create([cls(user_id=user_id, date=date) for user_id in totals], ignore_conflicts=True)
+            increment_columns(cls.objects.filter(date=date), totals, key='user_id')
+
+def record_earnings(earnings):
+    Earning.objects.bulk_create(earnings)
+    EarningDailyRollup.add(earnings)
+    LedgerEntry.objects.bulk_create([LedgerEntry.for_earning(earning) for earning in earnings])
+    credits = defaultdict(Decimal)
+    for earning in earnings:
+        credits[earning.user_id] += earning.amount
+    earnings_created(earnings)
+    credit_balances(credits)
+    return earnings
+
+@receiver(post_save, sender=Purchase)
+def purchase_post_save(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        path = User.objects.values_list('path', flat=True).get(pk=instance.user_id)
+        volume = Decimal(str(instance.package.price))
+        increment_columns(User.objects.all(), upline_increments(path, volume=volume, direct_volume=volume))
+
+@receiver(post_save, sender=Earning)
+def earning_post_save(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        # The single-row counterpart of record_earnings: rollup, ledger credit and balance together
+        EarningDailyRollup.add([instance])
+        LedgerEntry.for_earning(instance).save()
+        earnings_created([instance])
+        credit_balances({instance.user_id: instance.amount})
+    invalidate_users([instance.user_id])
+
 class Withdrawal(models.Model):
+    PENDING = 'pending'
+    COMPLETED = 'completed'
+    REJECTED = 'rejected'
+
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='withdrawals')
     amount = models.DecimalField(max_digits=10, decimal_places=2)
-    status = models.CharField(max_length=20, choices=[('pending', 'Pending'), ('completed', 'Completed'), ('rejected', 'Rejected')])
-    timestamp = models.DateTimeField(auto_now_add=True)
\ No newline at end of file
+    status = models.CharField(max_length=20, choices=[(PENDING, 'Pending'), (COMPLETED, 'Completed'), (REJECTED, 'Rejected')])
+    timestamp = models.DateTimeField(auto_now_add=True)
+    # Whether the amount was debited from available_balance; only then does rejecting it refund
+    reserved = models.BooleanField(default=True, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'timestamp'], name='withdrawal_user_timestamp_idx'),
+            models.Index(fields=['user', 'status'], name='withdrawal_user_status_idx'),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_status = instance.__dict__.get('status')
+        instance._loaded_user_id = instance.__dict__.get('user_id')
+        instance._loaded_amount = instance.__dict__.get('amount')
+        return instance
+
+    def reserved_funds(self):
+        # (user_id, amount) as last saved, which is what a reservation took and a refund gives back
+        user_id = getattr(self, '_loaded_user_id', None)
+        amount = getattr(self, '_loaded_amount', None)
+        return (self.user_id if user_id is None else user_id), (self.amount if amount is None else amount)
+
+    @classmethod
+    def holds_funds(cls, status):
+        return status is not None and status != cls.REJECTED
+
+    def save(self, *args, **kwargs):
+        # withdrawal_post_save debits the balance, and the row must not outlive a failed debit
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
+    @classmethod
+    def reserve(cls, user, amount):
+        # Creating the withdrawal debits it with a conditional UPDATE, which is the balance check:
+        # concurrent requests serialize on the user's row only, and whichever finds the funds gone
+        # rolls its insert back
+        amount = Decimal(str(amount))
+        if amount <= 0:
+            raise ValidationError("Withdrawal amount must be positive.")
+        return cls.objects.create(user=user, amount=amount, status=cls.PENDING)
+
+    @classmethod
+    def process_batch(cls, batch_size=1000, ids=None):
+        # Settles one chunk of pending withdrawals in one transaction: a crash rolls the chunk
+        # back to pending, and the status-guarded UPDATE keeps re-runs from settling twice.
+        # Returns (claimed, completed, rejected); a chunk claimed but rolled back settles nothing
+        # and should be retried, only claimed == 0 means the queue is empty
+        pending = cls.objects.filter(status=cls.PENDING)
+        if ids is not None:
+            pending = pending.filter(id__in=ids)
+        with transaction.atomic():
+            withdrawals = list(pending.select_for_update(skip_locked=True).order_by('id').only('id', 'user_id', 'amount', 'reserved')[:batch_size])
+            if not withdrawals:
+                return 0, 0, 0
+            # Funds of reserved withdrawals were taken when they were requested, so for those only the account is checked
+            payable = set(
+                User.objects.filter(pk__in={withdrawal.user_id for withdrawal in withdrawals}, is_active=True)
+                .exclude(wallet_address__isnull=True).exclude(wallet_address='')
+                .values_list('id', flat=True)
+            )
+            rejected = [withdrawal for withdrawal in withdrawals if withdrawal.user_id not in payable]
+            # Withdrawals requested before funds were reserved (see migration 0009) are paid only out of
+            # the balance there is now, oldest first, and debited together with the chunk
+            debits = defaultdict(Decimal)
+            unreserved = [withdrawal for withdrawal in withdrawals if not withdrawal.reserved and withdrawal.user_id in payable]
+            if unreserved:
+                balances = dict(
+                    User.objects.select_for_update().filter(pk__in={withdrawal.user_id for withdrawal in unreserved})
+                    .values_list('id', 'available_balance')
+                )
+                for withdrawal in unreserved:
+                    if balances[withdrawal.user_id] - debits[withdrawal.user_id] >= withdrawal.amount:
+                        debits[withdrawal.user_id] += withdrawal.amount
+                    else:
+                        rejected.append(withdrawal)
+            settled = cls.objects.filter(id__in=[withdrawal.id for withdrawal in withdrawals], status=cls.PENDING).update(
+                status=Case(When(id__in=[withdrawal.id for withdrawal in rejected], then=Value(cls.REJECTED)), default=Value(cls.COMPLETED)),
+            )
+            if settled != len(withdrawals):
+                # Another writer settled part of this chunk; what it left is picked up on retry
+                transaction.set_rollback(True)
+                return len(withdrawals), 0, 0
+            if debits:
+                increment_columns(User.objects.all(), {user_id: {'available_balance': -amount} for user_id, amount in debits.items()})
+                balance_changed(debits)
+            refunds = defaultdict(Decimal)
+            for withdrawal in rejected:
+                if withdrawal.reserved:
+                    refunds[withdrawal.user_id] += withdrawal.amount
+            if refunds:
+                increment_columns(User.objects.all(), {user_id: {'available_balance': amount} for user_id, amount in refunds.items()})
+                balance_changed(refunds)
+            if rejected:
+                LedgerEntry.objects.bulk_create([LedgerEntry.for_withdrawal(withdrawal, reversal=True) for withdrawal in rejected])
+        return len(withdrawals), len(withdrawals) - len(rejected), len(rejected)
+
+def debit_balance(user_id, amount):
+    debited = User.objects.filter(pk=user_id, available_balance__gte=amount).update(available_balance=F('available_balance') - amount)
+    invalidate_users([user_id])
+    if debited:
+        balance_changed([user_id])
+    return debited
+
+@receiver(post_save, sender=Withdrawal)
+def withdrawal_post_save(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    previous = None if created else getattr(instance, '_loaded_status', None)
+    if Withdrawal.holds_funds(previous) and instance.reserved_funds() != (instance.user_id, Decimal(str(instance.amount))):
+        raise ValidationError("The user and amount of a withdrawal holding funds can't be changed.")
+    if Withdrawal.holds_funds(instance.status) and not Withdrawal.holds_funds(previous):
+        # New withdrawals, however they are created, and rejected ones being reopened take their funds here
+        if not debit_balance(instance.user_id, instance.amount):
+            raise ValidationError("Insufficient balance.")
+        if not instance.reserved:
+            Withdrawal.objects.filter(pk=instance.pk).update(reserved=True)
+            instance.reserved = True
+        LedgerEntry.for_withdrawal(instance).save()
+    elif Withdrawal.holds_funds(previous) and not Withdrawal.holds_funds(instance.status):
+        user_id, amount = instance.reserved_funds()
+        if instance.reserved:
+            User.objects.filter(pk=user_id).update(available_balance=F('available_balance') + amount)
+            invalidate_users([user_id])
+            balance_changed([user_id])
+        LedgerEntry.for_withdrawal(instance, reversal=True).save()
+    instance._loaded_status = instance.status
+    instance._loaded_user_id = instance.user_id
+    instance._loaded_amount = Decimal(str(instance.amount))
+
+class LedgerEntry(models.Model):
+    EARNING = 'earning'
+    WITHDRAWAL = 'withdrawal'
+    WITHDRAWAL_REVERSAL = 'withdrawal_reversal'
+    KIND_CHOICES = [(EARNING, 'Earning'), (WITHDRAWAL, 'Withdrawal'), (WITHDRAWAL_REVERSAL, 'Withdrawal reversal')]
+
+    # Append-only: rows are only ever inserted, balances are derived from them
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='ledger_entries')
+    amount = models.DecimalField(max_digits=12, decimal_places=2)  # signed: credits positive, debits negative
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    earning = models.ForeignKey(Earning, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    withdrawal = models.ForeignKey(Withdrawal, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    timestamp = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'id'], name='ledger_user_id_idx'),
+            models.Index(fields=['user', 'timestamp'], name='ledger_user_timestamp_idx'),
+        ]
+
+    @classmethod
+    def for_earning(cls, earning):
+        return cls(user_id=earning.user_id, amount=earning.amount, kind=cls.EARNING, earning=earning, timestamp=earning.timestamp)
+
+    @classmethod
+    def for_withdrawal(cls, withdrawal, reversal=False):
+        user_id, amount = withdrawal.reserved_funds() if reversal else (withdrawal.user_id, withdrawal.amount)
+        amount = Decimal(str(amount))
+        return cls(
+            user_id=user_id,
+            amount=amount if reversal else -amount,
+            kind=cls.WITHDRAWAL_REVERSAL if reversal else cls.WITHDRAWAL,
+            withdrawal=withdrawal,
+        )
+
+class BalanceSnapshot(models.Model):
+    # Balance after every ledger entry of the user with id <= last_entry_id; timestamp is the
+    # latest timestamp among those entries
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='balance_snapshots')
+    balance = models.DecimalField(max_digits=12, decimal_places=2)
+    last_entry_id = models.BigIntegerField()
+    timestamp = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'last_entry_id'], name='snapshot_user_entry_idx'),
+            models.Index(fields=['user', 'timestamp'], name='snapshot_user_timestamp_idx'),
+        ]
+
+    @classmethod
+    def capture(cls, min_entries=1, chunk_size=1000):
+        # Roll every user's entries since their last snapshot into a new one; users with fewer
+        # than min_entries new entries keep their current snapshot
+        cutoff = LedgerEntry.objects.aggregate(last=Max('id'))['last']
+        if cutoff is None:
+            return 0
+        latest = cls.objects.filter(user=OuterRef('pk')).order_by('-last_entry_id')
+        users = User.objects.order_by('id').annotate(
+            snapshot_entry_id=Subquery(latest.values('last_entry_id')[:1]),
+            snapshot_balance=Subquery(latest.values('balance')[:1]),
+            snapshot_timestamp=Subquery(latest.values('timestamp')[:1]),
+        ).values_list('id', 'snapshot_entry_id', 'snapshot_balance', 'snapshot_timestamp')
+
+        created = 0
+        last_user_id = 0
+        while chunk := list(users.filter(id__gt=last_user_id)[:chunk_size]):
+            last_user_id = chunk[-1][0]
+            previous = {user_id: (entry_id or 0, balance or Decimal('0.00'), timestamp) for user_id, entry_id, balance, timestamp in chunk}
+            pending = defaultdict(list)
+            for user_id, entry_id, amount, timestamp in LedgerEntry.objects.filter(
+                user_id__in=previous, id__gt=min(entry_id for entry_id, _, _ in previous.values()), id__lte=cutoff,
+            ).values_list('user_id', 'id', 'amount', 'timestamp'):
+                if entry_id > previous[user_id][0]:
+                    pending[user_id].append((entry_id, amount, timestamp))
+
+            snapshots = []
+            for user_id, entries in pending.items():
+                if len(entries) < min_entries:
+                    continue
+                _, balance, timestamp = previous[user_id]
+                latest_timestamp = max(entry[2] for entry in entries)
+                snapshots.append(cls(
+                    user_id=user_id,
+                    balance=balance + sum(entry[1] for entry in entries),
+                    last_entry_id=max(entry[0] for entry in entries),
+                    timestamp=max(timestamp, latest_timestamp) if timestamp else latest_timestamp,
+                ))
+            created += len(cls.objects.bulk_create(snapshots))
+        return created
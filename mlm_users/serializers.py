@@ -1,13 +1,17 @@
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
-from .models import User, Earning, Withdrawal, Package, Purchase
+from .models import User, Earning, Withdrawal, Package, Purchase, CommissionJob
 from django.db import models
+from django.conf import settings
+from django.utils import timezone
+from datetime import timedelta
+from decimal import Decimal
 
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
-        fields = ('id', 'username', 'email', 'sponsor', 'sponsor_address', 'level', 'total_earnings', 'available_balance', 'wallet_address')
-        read_only_fields = ('level', 'total_earnings', 'available_balance')
+        fields = ('id', 'username', 'email', 'sponsor', 'sponsor_address', 'level', 'total_earnings', 'available_balance', 'wallet_address', 'direct_team_size', 'team_size', 'direct_team_volume', 'team_volume')
+        read_only_fields = ('level', 'total_earnings', 'available_balance', 'direct_team_size', 'team_size', 'direct_team_volume', 'team_volume')
 
 class UserRegistrationSerializer(serializers.ModelSerializer):
     sponsor_address = serializers.CharField(write_only=True)
@@ -35,10 +39,46 @@ class WithdrawalSerializer(serializers.ModelSerializer):
         model = Withdrawal
         fields = '__all__'
 
+class WithdrawalRequestSerializer(serializers.Serializer):
+    amount = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=Decimal('0.01'))
+
 class TeamMemberSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
-        fields = ('id', 'username', 'email', 'level', 'total_earnings')
+        fields = ('id', 'username', 'email', 'level', 'total_earnings', 'direct_team_size', 'team_size', 'team_volume')
+
+class SponsorMoveSerializer(serializers.Serializer):
+    sponsor = serializers.PrimaryKeyRelatedField(queryset=User.objects.all(), allow_null=True)
+
+class TeamQuerySerializer(serializers.Serializer):
+    depth = serializers.IntegerField(min_value=1, max_value=settings.MLM_TEAM_MAX_DEPTH, default=2)
+
+class EarningsSummaryQuerySerializer(serializers.Serializer):
+    PERIOD_DEFAULT_DAYS = {'day': 30, 'week': 7 * 12, 'month': 365}
+
+    period = serializers.ChoiceField(choices=list(PERIOD_DEFAULT_DAYS), default='day')
+    start = serializers.DateField(required=False)
+    end = serializers.DateField(required=False)
+
+    def validate(self, attrs):
+        attrs.setdefault('end', timezone.localdate())
+        attrs.setdefault('start', attrs['end'] - timedelta(days=self.PERIOD_DEFAULT_DAYS[attrs['period']] - 1))
+        if attrs['start'] > attrs['end']:
+            raise serializers.ValidationError("start must not be after end.")
+        return attrs
+
+class ExportQuerySerializer(serializers.Serializer):
+    start = serializers.DateField(required=False)
+    end = serializers.DateField(required=False)
+    user = serializers.IntegerField(required=False, help_text="Staff only: export another user's history.")
+
+    def validate(self, attrs):
+        if attrs.get('start') and attrs.get('end') and attrs['start'] > attrs['end']:
+            raise serializers.ValidationError("start must not be after end.")
+        return attrs
+
+class BalanceQuerySerializer(serializers.Serializer):
+    at = serializers.DateTimeField(required=False)
 
 class PackageSerializer(serializers.ModelSerializer):
     class Meta:
@@ -53,4 +93,9 @@ class PurchaseSerializer(serializers.ModelSerializer):
 
     def create(self, validated_data):
         # The user will be set in the view, so we don't need it here
-        return Purchase.objects.create(**validated_data)
\ No newline at end of file
+        return Purchase.objects.create(**validated_data)
+
+class CommissionJobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = CommissionJob
+        fields = ['id', 'purchase', 'status', 'attempts', 'error', 'created_at', 'completed_at']
@@ -1,9 +1,41 @@
 # tests.py
 
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
+from django.db import connection, connections, OperationalError
+from django.db.models import Sum
+from django.test.utils import CaptureQueriesContext
+import unittest
+from unittest.mock import patch
+from contextlib import ExitStack
+import threading
+import time
+from django.core.management import call_command, CommandError
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+from io import StringIO
+from django.core.files.uploadedfile import SimpleUploadedFile
+import tempfile
 from django.core.exceptions import ValidationError
 from decimal import Decimal
-from .models import User, Package, Purchase, Earning, Withdrawal
+from datetime import timedelta
+from django.utils import timezone
+from django.core.cache import cache
+from .caching import stats as cache_counters
+from .authentication import CachedJWTAuthentication
+from .checks import check_shared_cache
+from django.contrib.auth.hashers import make_password
+from .benchmarks import DEFAULT_BUDGETS, build_network, run_benchmarks, run_concurrency_benchmark
+from .imports import chunked, import_network, import_purchases
+from .middleware import LatencyHistogram, histogram
+from django.test import override_settings
+import json
+import csv
+from asgiref.sync import async_to_sync, sync_to_async
+import asyncio
+from .async_views import balance_event
+from .events import EventBackend, LocalBackend, user_channel
+from .models import record_earnings
+from .models import User, Package, Purchase, Earning, EarningDailyRollup, Withdrawal, CommissionPlan, CommissionJob, LedgerEntry, BalanceSnapshot
 
 class UserModelTests(TestCase):
     def setUp(self):
@@ -52,6 +84,69 @@ class UserModelTests(TestCase):
         self.assertEqual(user2.level, 2)
         self.assertEqual(user3.level, 3)
 
+    def test_tree_path(self):
+        user1 = User.objects.create_user(username='user1', email='user1@example.com', password='password', sponsor=self.root_user)
+        user2 = User.objects.create_user(username='user2', email='user2@example.com', password='password', sponsor=user1)
+
+        self.assertEqual(self.root_user.path, '/')
+        self.assertEqual(user1.path, f'/{self.root_user.pk}/')
+        self.assertEqual(user2.path, f'/{self.root_user.pk}/{user1.pk}/')
+        with self.assertNumQueries(1):
+            self.assertEqual(set(self.root_user.get_descendants()), {user1, user2})
+        with self.assertNumQueries(1):
+            self.assertEqual(set(user2.get_ancestors()), {self.root_user, user1})
+        with self.assertNumQueries(0):
+            self.assertTrue(self.root_user.is_ancestor(user2))
+            self.assertFalse(user2.is_ancestor(user1))
+
+    def test_sponsor_change_rewrites_subtree(self):
+        other_root = User.objects.create_user(username='other', email='other@example.com', password='password')
+        user1 = User.objects.create_user(username='user1', email='user1@example.com', password='password', sponsor=self.root_user)
+        user2 = User.objects.create_user(username='user2', email='user2@example.com', password='password', sponsor=user1)
+        user3 = User.objects.create_user(username='user3', email='user3@example.com', password='password', sponsor=user2)
+
+        user1.sponsor = other_root
+        user1.save()
+        user3.refresh_from_db()
+
+        self.assertEqual(user3.path, f'/{other_root.pk}/{user1.pk}/{user2.pk}/')
+        self.assertEqual(user3.level, 3)
+        self.assertIn(user3, other_root.get_descendants())
+        self.assertNotIn(user3, self.root_user.get_descendants())
+
+    def test_move_to(self):
+        other_root = User.objects.create_user(username='other', email='other@example.com', password='password')
+        user1 = User.objects.create_user(username='user1', email='user1@example.com', password='password', sponsor=self.root_user)
+        user2 = User.objects.create_user(username='user2', email='user2@example.com', password='password', sponsor=user1)
+
+        rows_changed = user1.move_to(other_root)
+        user2.refresh_from_db()
+
+        self.assertEqual(rows_changed, 2)
+        self.assertEqual(user1.level, 1)
+        self.assertEqual(user2.path, f'/{other_root.pk}/{user1.pk}/')
+        with self.assertRaises(ValidationError):
+            user1.move_to(user2)
+        self.assertEqual(user1.move_to(None), 2)
+        user2.refresh_from_db()
+        self.assertEqual(user2.level, 1)
+
+    def test_move_deep_chain(self):
+        chain = [self.root_user]
+        for i in range(1100):
+            chain.append(User.objects.create(username=f'chain{i}', email=f'chain{i}@example.com', sponsor=chain[-1]))
+        other_root = User.objects.create(username='other', email='other@example.com')
+
+        with self.assertNumQueries(8):  # including the own-volume read, team counter update and savepoint pair
+            rows_changed = chain[1].move_to(other_root)
+        self.assertEqual(rows_changed, 1100)
+        self.assertEqual(User.objects.get(pk=chain[-1].pk).level, 1100)
+
+        other_root.sponsor = chain[-1]
+        other_root.save()
+        other_root.refresh_from_db()
+        self.assertIsNone(other_root.sponsor)
+
 class PackageModelTests(TestCase):
     def test_package_creation(self):
         package = Package.objects.create(name='Test Package', price=100.00, profit_percentage=40.00)
@@ -84,6 +179,66 @@ class PurchaseModelTests(TestCase):
         self.assertEqual(sponsor.total_earnings, Decimal('12.00'))  # 30% of 40% of 100
         self.assertEqual(grand_sponsor.total_earnings, Decimal('4.00'))  # 10% of 40% of 100
 
+    def test_profit_distribution_is_set_based(self):
+        sponsor = User.objects.create_user(username='sponsor', email='sponsor@example.com', password='sponsorpassword')
+        buyer = User.objects.create_user(username='buyer', email='buyer@example.com', password='password', sponsor=sponsor)
+        stale_sponsor = User.objects.get(pk=sponsor.pk)
+
+        purchase = Purchase.objects.create(user=buyer, package=self.package)
+        with self.assertNumQueries(8):  # path read, earnings insert, rollup upsert (2), ledger insert, balance update and the savepoint pair
+            purchase.distribute_profit()
+        Purchase.objects.create(user=buyer, package=self.package).distribute_profit()
+
+        # A stale copy of the sponsor saved in between must not clobber the credited balances
+        stale_sponsor.first_name = 'Sponsor'
+        stale_sponsor.save()
+        sponsor.refresh_from_db()
+        self.assertEqual(sponsor.first_name, 'Sponsor')
+        self.assertEqual(sponsor.total_earnings, Decimal('24.00'))
+        self.assertEqual(sponsor.available_balance, Decimal('24.00'))
+        self.assertEqual(Earning.objects.filter(user=sponsor).count(), 2)
+
+class CommissionPlanTests(TestCase):
+    def setUp(self):
+        self.chain = [User.objects.create(username='upline0', email='upline0@example.com')]
+        for i in range(1, 8):
+            self.chain.append(User.objects.create(username=f'upline{i}', email=f'upline{i}@example.com', sponsor=self.chain[-1]))
+        self.buyer = self.chain[-1]
+        self.plan = CommissionPlan.objects.create(name='Five levels', rates=['20', '10', '5', '3', '2'])
+        self.package = Package.objects.create(name='Planned Package', price=Decimal('100.00'), profit_percentage=Decimal('50.00'), commission_plan=self.plan)
+
+    def test_n_level_payout(self):
+        purchase = Purchase.objects.create(user=self.buyer, package=self.package)
+        with self.assertNumQueries(8):  # upline path, earnings insert, rollup upsert (2), ledger insert, balance update and the savepoint pair
+            purchase.distribute_profit()
+
+        earned = dict(Earning.objects.values_list('user__username', 'amount'))
+        self.assertEqual(earned, {
+            'upline6': Decimal('10.00'),
+            'upline5': Decimal('5.00'),
+            'upline4': Decimal('2.50'),
+            'upline3': Decimal('1.50'),
+            'upline2': Decimal('1.00'),
+        })
+
+    def test_compression_skips_inactive_uplines(self):
+        self.plan.compression = True
+        self.plan.save()
+        User.objects.filter(username__in=['upline6', 'upline4']).update(is_active=False)
+
+        Purchase.objects.create(user=self.buyer, package=self.package).distribute_profit()
+
+        self.assertEqual(
+            set(Earning.objects.values_list('user__username', flat=True)),
+            {'upline5', 'upline3', 'upline2', 'upline1', 'upline0'},
+        )
+
+    def test_invalid_rates(self):
+        with self.assertRaises(ValidationError):
+            CommissionPlan(name='Too much', rates=['80', '30']).clean()
+        with self.assertRaises(ValidationError):
+            CommissionPlan(name='Garbage', rates=['abc']).clean()
+
 class EarningModelTests(TestCase):
     def setUp(self):
         self.user = User.objects.create_user(username='testuser', email='test@example.com', password='testpassword')
@@ -95,10 +250,1342 @@ class EarningModelTests(TestCase):
 
 class WithdrawalModelTests(TestCase):
     def setUp(self):
-        self.user = User.objects.create_user(username='testuser', email='test@example.com', password='testpassword')
+        self.user = User.objects.create_user(username='testuser', email='test@example.com', password='testpassword', available_balance=Decimal('30.00'))
 
     def test_withdrawal_creation(self):
         withdrawal = Withdrawal.objects.create(user=self.user, amount=25.00, status='pending')
         self.assertEqual(withdrawal.user, self.user)
         self.assertEqual(withdrawal.amount, Decimal('25.00'))
-        self.assertEqual(withdrawal.status, 'pending')
\ No newline at end of file
+        self.assertEqual(withdrawal.status, 'pending')
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.available_balance, Decimal('5.00'))
+
+    def test_creation_without_funds_writes_nothing(self):
+        with self.assertRaises(ValidationError):
+            Withdrawal.objects.create(user=self.user, amount=Decimal('40.00'), status='pending')
+        self.assertFalse(Withdrawal.objects.exists())
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.available_balance, Decimal('30.00'))
+
+    def test_unreserved_withdrawal_is_not_refunded(self):
+        # As left by migration 0009 for withdrawals requested before funds were reserved
+        withdrawal = Withdrawal.objects.create(user=self.user, amount=Decimal('10.00'), status='pending')
+        Withdrawal.objects.filter(pk=withdrawal.pk).update(reserved=False)
+        User.objects.filter(pk=self.user.pk).update(available_balance=Decimal('30.00'))
+
+        self.assertEqual(Withdrawal.process_batch(10), (1, 0, 1))
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.available_balance, Decimal('30.00'))
+
+    def test_unreserved_withdrawals_are_paid_only_from_the_balance(self):
+        self.user.wallet_address = 'bc1testuser'
+        self.user.save()
+        User.objects.filter(pk=self.user.pk).update(available_balance=Decimal('120.00'))
+        withdrawals = [Withdrawal.objects.create(user=self.user, amount=Decimal(amount), status='pending') for amount in ('20.00', '100.00')]
+        Withdrawal.objects.update(reserved=False)
+        User.objects.filter(pk=self.user.pk).update(available_balance=Decimal('30.00'))
+
+        self.assertEqual(Withdrawal.process_batch(10), (2, 1, 1))
+        self.assertEqual([Withdrawal.objects.get(pk=withdrawal.pk).status for withdrawal in withdrawals], ['completed', 'rejected'])
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.available_balance, Decimal('10.00'))
+
+class TeamEndpointTests(TestCase):
+    def setUp(self):
+        self.root_user = User.objects.create_user(username='root', email='root@example.com', password='rootpassword')
+        self.user1 = User.objects.create_user(username='user1', email='user1@example.com', password='password', sponsor=self.root_user)
+        self.user2 = User.objects.create_user(username='user2', email='user2@example.com', password='password', sponsor=self.root_user)
+        self.user1_1 = User.objects.create_user(username='user1_1', email='user1_1@example.com', password='password', sponsor=self.user1)
+        self.user1_1_1 = User.objects.create_user(username='user1_1_1', email='user1_1_1@example.com', password='password', sponsor=self.user1_1)
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.root_user)
+
+    def test_team_default_depth(self):
+        response = self.client.get('/api/users/team/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['depth'], 2)
+        self.assertEqual(response.data['level_counts'], {1: 2, 2: 1})
+        self.assertEqual([m['username'] for m in response.data['members']], ['user1', 'user2', 'user1_1'])
+
+    def test_team_custom_depth(self):
+        response = self.client.get('/api/users/team/', {'depth': 3})
+        self.assertEqual(response.data['total'], 4)
+        self.assertEqual(response.data['level_counts'], {1: 2, 2: 1, 3: 1})
+
+    def test_team_invalid_depth(self):
+        for depth in ('0', 'abc', '1000'):
+            response = self.client.get('/api/users/team/', {'depth': depth})
+            self.assertEqual(response.status_code, 400)
+
+    def test_team_query_count_independent_of_size(self):
+        for i in range(10):
+            User.objects.create_user(username=f'extra{i}', email=f'extra{i}@example.com', password='password', sponsor=self.user2)
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/users/team/')
+        self.assertEqual(response.data['level_counts'], {1: 2, 2: 11})
+
+class SponsorMoveEndpointTests(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create_user(username='admin', email='admin@example.com', password='password', is_staff=True)
+        self.root_user = User.objects.create_user(username='root', email='root@example.com', password='rootpassword')
+        self.user1 = User.objects.create_user(username='user1', email='user1@example.com', password='password', sponsor=self.root_user)
+        self.client = APIClient()
+
+    def test_move_requires_staff(self):
+        self.client.force_authenticate(user=self.root_user)
+        response = self.client.post(f'/api/users/{self.user1.pk}/move/', {'sponsor': self.admin.pk})
+        self.assertEqual(response.status_code, 403)
+
+    def test_move(self):
+        self.client.force_authenticate(user=self.admin)
+        response = self.client.post(f'/api/users/{self.user1.pk}/move/', {'sponsor': self.admin.pk})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['rows_changed'], 1)
+        self.assertEqual(response.data['sponsor'], self.admin.pk)
+
+    def test_moved_users_see_their_new_place(self):
+        cache.clear()
+        member = User.objects.create_user(username='member', email='member@example.com', password='password', sponsor=self.user1)
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user1)}')
+        self.assertEqual(client.get('/api/users/profile/').data['sponsor'], self.root_user.pk)
+
+        self.client.force_authenticate(user=self.admin)
+        self.client.post(f'/api/users/{self.user1.pk}/move/', {'sponsor': self.admin.pk})
+
+        profile = client.get('/api/users/profile/').data
+        self.assertEqual((profile['sponsor'], profile['level']), (self.admin.pk, 1))
+        team = client.get('/api/users/team/', {'depth': 1}).data
+        self.assertEqual([row['id'] for row in team['members']], [member.pk])
+
+    def test_move_rejects_cycle(self):
+        self.client.force_authenticate(user=self.admin)
+        response = self.client.post(f'/api/users/{self.root_user.pk}/move/', {'sponsor': self.user1.pk})
+        self.assertEqual(response.status_code, 400)
+
+class CommissionQueueTests(TestCase):
+    def setUp(self):
+        self.sponsor = User.objects.create_user(username='sponsor', email='sponsor@example.com', password='password')
+        self.buyer = User.objects.create_user(username='buyer', email='buyer@example.com', password='password', sponsor=self.sponsor)
+        self.package = Package.objects.create(name='Test Package', price=Decimal('100.00'), profit_percentage=Decimal('40.00'))
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.buyer)
+
+    def test_purchase_enqueues_job(self):
+        response = self.client.post('/api/purchases/', {'package': self.package.pk})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['commission_job']['status'], CommissionJob.PENDING)
+        self.sponsor.refresh_from_db()
+        self.assertEqual(self.sponsor.total_earnings, Decimal('0.00'))
+
+        call_command('process_commissions', '--once', stdout=StringIO())
+
+        self.sponsor.refresh_from_db()
+        self.assertEqual(self.sponsor.total_earnings, Decimal('12.00'))
+        response = self.client.get(f"/api/commission-jobs/{response.data['commission_job']['id']}/")
+        self.assertEqual(response.data['status'], CommissionJob.COMPLETED)
+
+    def test_claims_are_exclusive(self):
+        for _ in range(3):
+            CommissionJob.objects.create(purchase=Purchase.objects.create(user=self.buyer, package=self.package))
+        first = CommissionJob.claim(2)
+        second = CommissionJob.claim(2)
+        self.assertEqual(len(first), 2)
+        self.assertEqual(len(second), 1)
+        self.assertFalse({job.pk for job in first} & {job.pk for job in second})
+        self.assertEqual(CommissionJob.claim(2), [])
+
+    def test_job_never_pays_twice(self):
+        job = CommissionJob.objects.create(purchase=Purchase.objects.create(user=self.buyer, package=self.package))
+        claimed = CommissionJob.claim(1)[0]
+        self.assertTrue(claimed.run())
+        self.assertFalse(claimed.run())
+        self.assertEqual(Earning.objects.filter(user=self.sponsor).count(), 1)
+        job.refresh_from_db()
+        self.assertEqual(job.status, CommissionJob.COMPLETED)
+
+    def test_failed_job_is_retried_then_failed(self):
+        job = CommissionJob.objects.create(purchase=Purchase.objects.create(user=self.buyer, package=self.package))
+        User.objects.filter(pk=self.buyer.pk).update(path='/not-a-user-id/')
+
+        call_command('process_commissions', '--once', stdout=StringIO())
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, CommissionJob.FAILED)
+        self.assertEqual(job.attempts, 3)
+        self.assertTrue(job.error)
+
+    def test_job_status_is_private(self):
+        job = CommissionJob.objects.create(purchase=Purchase.objects.create(user=self.buyer, package=self.package))
+        self.client.force_authenticate(user=self.sponsor)
+        response = self.client.get(f'/api/commission-jobs/{job.pk}/')
+        self.assertEqual(response.status_code, 404)
+
+class PurchaseImportTests(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create_user(username='admin', email='admin@example.com', password='password', is_staff=True)
+        self.sponsor = User.objects.create_user(username='sponsor', email='sponsor@example.com', password='password')
+        self.buyer = User.objects.create_user(username='buyer', email='buyer@example.com', password='password', sponsor=self.sponsor, wallet_address='0xbuyer')
+        self.package = Package.objects.create(name='Gold', price=Decimal('100.00'), profit_percentage=Decimal('40.00'))
+        self.client = APIClient()
+
+    def test_import_command(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as f:
+            f.write('user,package\nbuyer,Gold\nbuyer@example.com,Gold\n0xbuyer,%d\nnobody,Gold\n' % self.package.pk)
+        out, err = StringIO(), StringIO()
+        call_command('import_purchases', f.name, '--chunk-size', '2', stdout=out, stderr=err)
+
+        self.assertIn('Imported 3 of 4 purchases', out.getvalue())
+        self.assertIn('Row 4: Unknown user', err.getvalue())
+        self.assertEqual(Purchase.objects.filter(user=self.buyer).count(), 3)
+        self.sponsor.refresh_from_db()
+        self.assertEqual(self.sponsor.total_earnings, Decimal('36.00'))
+        self.assertEqual(self.sponsor.available_balance, Decimal('36.00'))
+
+    def test_import_queries_per_chunk(self):
+        rows = [{'user': 'buyer', 'package': 'Gold'}] * 50
+        with self.assertNumQueries(11):  # packages, then per chunk: users, purchases, team counters, earnings, rollup upsert (2), ledger, balances, savepoint pair
+            stats = import_purchases(rows, chunk_size=100)
+        self.assertEqual(stats['earnings'], 50)
+
+    def test_bulk_endpoint(self):
+        self.client.force_authenticate(user=self.admin)
+        upload = SimpleUploadedFile('purchases.ndjson', b'{"user": "buyer", "package": "Gold"}\n{"user": "buyer", "package": "Silver"}\n')
+        response = self.client.post('/api/purchases/bulk/', {'file': upload}, format='multipart')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['imported'], 1)
+        self.assertEqual(response.data['errors'], [{'row': 2, 'error': 'Unknown package'}])
+
+    def test_bulk_endpoint_rejects_malformed_lines_before_importing(self):
+        self.client.force_authenticate(user=self.admin)
+        upload = SimpleUploadedFile('purchases.ndjson', b'{"user": "buyer", "package": "Gold"}\n["buyer", "Gold"]\n')
+        response = self.client.post('/api/purchases/bulk/', {'file': upload}, format='multipart')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['details'], 'Line 2: expected a JSON object')
+        self.assertFalse(Purchase.objects.exists())
+
+    def test_bulk_endpoint_reports_committed_chunks_on_failure(self):
+        self.client.force_authenticate(user=self.admin)
+        upload = SimpleUploadedFile('purchases.ndjson', b'{"user": "buyer", "package": "Gold"}\n' * 3)
+        calls = []
+
+        def fail_second_chunk(*args, **kwargs):
+            calls.append(args)
+            if len(calls) == 2:
+                raise RuntimeError('database went away')
+            return record_earnings(*args, **kwargs)
+
+        with patch('mlm_users.imports.chunked', lambda rows, size: chunked(rows, 2)), \
+                patch('mlm_users.imports.record_earnings', fail_second_chunk):
+            response = self.client.post('/api/purchases/bulk/', {'file': upload}, format='multipart')
+
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(response.data['details'], 'database went away')
+        self.assertEqual(response.data['committed'], {'rows': 2, 'imported': 2, 'earnings': 2, 'errors': []})
+        self.assertEqual(Purchase.objects.count(), 2)
+
+    def test_bulk_endpoint_requires_staff(self):
+        self.client.force_authenticate(user=self.buyer)
+        response = self.client.post('/api/purchases/bulk/', {})
+        self.assertEqual(response.status_code, 403)
+
+class HistoryPaginationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', email='test@example.com', password='testpassword')
+        Earning.objects.bulk_create(Earning(user=self.user, amount=Decimal(i), description=f'Earning {i}') for i in range(7))
+        # Ties on timestamp must still page deterministically by id
+        Earning.objects.filter(amount__lt=4).update(timestamp=Earning.objects.get(amount=4).timestamp)
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def collect(self, url):
+        ids = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(response.data['results']), 3)
+            ids.extend(item['id'] for item in response.data['results'])
+            url = response.data['next']
+        return ids
+
+    def test_pages_cover_history_once(self):
+        expected = list(Earning.objects.order_by('-timestamp', '-id').values_list('id', flat=True))
+        self.assertEqual(self.collect('/api/earnings/?page_size=3'), expected)
+        self.assertEqual(self.collect('/api/users/earnings/?page_size=3'), expected)
+
+    def test_page_query_count_is_constant(self):
+        first = self.client.get('/api/earnings/?page_size=2')
+        with self.assertNumQueries(1):
+            self.client.get(first.data['next'])
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/api/earnings/', {'cursor': 'garbage'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_other_listings_are_paginated(self):
+        for url in ('/api/withdrawals/', '/api/users/withdrawals/', '/api/purchases/'):
+            response = self.client.get(url)
+            self.assertEqual(response.data, {'next': None, 'results': []})
+
+@unittest.skipUnless(connection.vendor == 'sqlite', 'Query plans are checked against SQLite')
+class HistoryIndexPlanTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', email='test@example.com', password='testpassword')
+        package = Package.objects.create(name='Test Package', price=Decimal('100.00'), profit_percentage=Decimal('40.00'))
+        for i in range(3):
+            Earning.objects.create(user=self.user, amount=Decimal(i), description='Test earning')
+            Withdrawal.objects.create(user=self.user, amount=Decimal(i), status='pending')
+            Purchase.objects.create(user=self.user, package=package)
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def query_plan(self, url, table):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        sql = next(q['sql'] for q in queries if q['sql'].startswith('SELECT') and f'FROM "{table}"' in q['sql'])
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+            return ' '.join(row[-1] for row in cursor.fetchall())
+
+    def test_list_endpoints_use_user_timestamp_indexes(self):
+        cases = [
+            ('/api/earnings/', 'mlm_users_earning', 'earning_user_timestamp_idx'),
+            ('/api/users/earnings/', 'mlm_users_earning', 'earning_user_timestamp_idx'),
+            ('/api/withdrawals/', 'mlm_users_withdrawal', 'withdrawal_user_timestamp_idx'),
+            ('/api/users/withdrawals/', 'mlm_users_withdrawal', 'withdrawal_user_timestamp_idx'),
+            ('/api/purchases/', 'mlm_users_purchase', 'purchase_user_timestamp_idx'),
+        ]
+        for url, table, index in cases:
+            for page_url in (f'{url}?page_size=1', self.client.get(f'{url}?page_size=1').data['next']):
+                with self.subTest(url=page_url):
+                    plan = self.query_plan(page_url, table)
+                    self.assertIn(index, plan)
+                    self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_pending_withdrawals_use_user_status_index(self):
+        with CaptureQueriesContext(connection) as queries:
+            list(Withdrawal.objects.filter(user=self.user, status='pending'))
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN QUERY PLAN {queries[0]['sql']}")
+            self.assertIn('withdrawal_user_status_idx', ' '.join(row[-1] for row in cursor.fetchall()))
+
+    def test_level_filter_uses_index(self):
+        with CaptureQueriesContext(connection) as queries:
+            list(User.objects.filter(level=1))
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN QUERY PLAN {queries[0]['sql']}")
+            self.assertRegex(' '.join(row[-1] for row in cursor.fetchall()), r'USING (COVERING )?INDEX \w*level\w* \(level=\?\)')
+
+    def test_descendants_use_path_index(self):
+        with CaptureQueriesContext(connection) as queries:
+            list(self.user.get_descendants())
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN QUERY PLAN {queries[0]['sql']}")
+            plan = ' '.join(row[-1] for row in cursor.fetchall())
+        self.assertRegex(plan, r'USING (COVERING )?INDEX \w*path\w* \(path>\? AND path<\?\)')
+        self.assertNotIn('SCAN', plan)
+
+class EarningRollupTests(TestCase):
+    def setUp(self):
+        self.sponsor = User.objects.create_user(username='sponsor', email='sponsor@example.com', password='password')
+        self.buyer = User.objects.create_user(username='buyer', email='buyer@example.com', password='password', sponsor=self.sponsor)
+        self.package = Package.objects.create(name='Test Package', price=Decimal('100.00'), profit_percentage=Decimal('40.00'))
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.sponsor)
+
+    def test_rollup_maintained_on_write(self):
+        for _ in range(3):
+            Purchase.objects.create(user=self.buyer, package=self.package).distribute_profit()
+        Earning.objects.create(user=self.sponsor, amount=Decimal('1.50'), description='Bonus')
+
+        rollup = EarningDailyRollup.objects.get(user=self.sponsor)
+        self.assertEqual(rollup.amount, Decimal('37.50'))
+        self.assertEqual(rollup.count, 4)
+
+    def test_rebuild_command(self):
+        Purchase.objects.create(user=self.buyer, package=self.package).distribute_profit()
+        today = Earning.objects.get().timestamp
+        Earning.objects.create(user=self.sponsor, amount=Decimal('5.00'), description='Old bonus')
+        Earning.objects.filter(description='Old bonus').update(timestamp=today - timedelta(days=3))
+        EarningDailyRollup.objects.all().delete()
+
+        call_command('rebuild_earning_rollups', stdout=StringIO())
+
+        self.assertEqual(
+            sorted(EarningDailyRollup.objects.values_list('amount', 'count')),
+            [(Decimal('5.00'), 1), (Decimal('12.00'), 1)],
+        )
+
+    def test_summary_reads_rollup_only(self):
+        Purchase.objects.create(user=self.buyer, package=self.package).distribute_profit()
+        Purchase.objects.create(user=self.buyer, package=self.package).distribute_profit()
+        today = timezone.localdate()
+        EarningDailyRollup.objects.create(user=self.sponsor, date=today - timedelta(days=40), amount=Decimal('7.00'), count=1)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/users/earnings-summary/')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse([q for q in queries if 'mlm_users_earning"' in q['sql']])
+        self.assertEqual(response.data['results'], [{'period': today, 'amount': '24.00', 'count': 2}])
+
+        response = self.client.get('/api/users/earnings-summary/', {'period': 'month', 'start': today - timedelta(days=60)})
+        self.assertEqual(response.data['total_amount'], '31.00')
+        self.assertEqual(response.data['total_count'], 3)
+
+    def test_summary_validation(self):
+        response = self.client.get('/api/users/earnings-summary/', {'period': 'year'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get('/api/users/earnings-summary/', {'start': '2024-02-01', 'end': '2024-01-01'})
+        self.assertEqual(response.status_code, 400)
+
+class TeamStatsTests(TestCase):
+    def setUp(self):
+        self.root_user = User.objects.create(username='root', email='root@example.com')
+        self.user1 = User.objects.create(username='user1', email='user1@example.com', sponsor=self.root_user)
+        self.user2 = User.objects.create(username='user2', email='user2@example.com', sponsor=self.user1)
+        self.other = User.objects.create(username='other', email='other@example.com')
+        self.package = Package.objects.create(name='Test Package', price=Decimal('100.00'), profit_percentage=Decimal('40.00'))
+
+    def stats(self, user):
+        return User.objects.values_list('direct_team_size', 'team_size', 'direct_team_volume', 'team_volume').get(pk=user.pk)
+
+    def test_registration_and_purchase(self):
+        self.assertEqual(self.stats(self.root_user), (1, 2, Decimal('0.00'), Decimal('0.00')))
+        with self.assertNumQueries(3):  # insert, upline path read and one counter UPDATE
+            Purchase.objects.create(user=self.user2, package=self.package)
+        self.assertEqual(self.stats(self.root_user), (1, 2, Decimal('0.00'), Decimal('100.00')))
+        self.assertEqual(self.stats(self.user1), (1, 1, Decimal('100.00'), Decimal('100.00')))
+
+    def test_move_transfers_counters(self):
+        Purchase.objects.create(user=self.user1, package=self.package)
+        Purchase.objects.create(user=self.user2, package=self.package)
+
+        self.user1.move_to(self.other)
+
+        self.assertEqual(self.stats(self.root_user), (0, 0, Decimal('0.00'), Decimal('0.00')))
+        self.assertEqual(self.stats(self.other), (1, 2, Decimal('100.00'), Decimal('200.00')))
+
+    def test_delete_removes_user_from_upline(self):
+        Purchase.objects.create(user=self.user1, package=self.package)
+        self.user1.delete()
+        self.assertEqual(self.stats(self.root_user), (0, 0, Decimal('0.00'), Decimal('0.00')))
+
+    def test_reconcile(self):
+        Purchase.objects.create(user=self.user2, package=self.package)
+        expected = [self.stats(user) for user in (self.root_user, self.user1, self.user2, self.other)]
+        User.objects.update(direct_team_size=7, team_size=7, direct_team_volume=0, team_volume=0)
+
+        out = StringIO()
+        call_command('reconcile_team_stats', stdout=out)
+
+        self.assertEqual([self.stats(user) for user in (self.root_user, self.user1, self.user2, self.other)], expected)
+        self.assertIn('4 corrected', out.getvalue())
+
+    def test_serializers_expose_counters(self):
+        client = APIClient()
+        client.force_authenticate(user=User.objects.get(pk=self.root_user.pk))
+        with self.assertNumQueries(0):
+            response = client.get('/api/users/profile/')
+        self.assertEqual(response.data['team_size'], 2)
+        response = client.get('/api/users/team/')
+        self.assertEqual(response.data['members'][0]['team_size'], 1)
+
+class BalanceLedgerTests(TestCase):
+    def setUp(self):
+        self.sponsor = User.objects.create_user(username='sponsor', email='sponsor@example.com', password='password')
+        self.buyer = User.objects.create_user(username='buyer', email='buyer@example.com', password='password', sponsor=self.sponsor)
+        self.package = Package.objects.create(name='Test Package', price=Decimal('100.00'), profit_percentage=Decimal('40.00'))
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.sponsor)
+
+    def test_entries_written_for_earnings_and_withdrawals(self):
+        Purchase.objects.create(user=self.buyer, package=self.package).distribute_profit()
+        withdrawal = Withdrawal.objects.create(user=self.sponsor, amount=Decimal('5.00'), status=Withdrawal.PENDING)
+        withdrawal.status = Withdrawal.REJECTED
+        withdrawal.save()
+        withdrawal.save()
+
+        self.assertEqual(
+            list(LedgerEntry.objects.filter(user=self.sponsor).order_by('id').values_list('kind', 'amount')),
+            [('earning', Decimal('12.00')), ('withdrawal', Decimal('-5.00')), ('withdrawal_reversal', Decimal('5.00'))],
+        )
+        self.assertEqual(self.sponsor.get_balance(), Decimal('12.00'))
+
+    def test_single_earning_credits_balance_like_the_ledger(self):
+        Earning.objects.create(user=self.sponsor, amount=Decimal('7.50'), description='Bonus')
+        Purchase.objects.create(user=self.buyer, package=self.package).distribute_profit()
+
+        self.sponsor.refresh_from_db()
+        ledger = LedgerEntry.objects.filter(user=self.sponsor).aggregate(total=Sum('amount'))['total']
+        self.assertEqual(ledger, Decimal('19.50'))
+        self.assertEqual(self.sponsor.total_earnings, ledger)
+        self.assertEqual(self.sponsor.available_balance, ledger)
+
+    def test_earnings_cannot_be_created_through_the_api(self):
+        response = self.client.post('/api/earnings/', {'user': self.sponsor.pk, 'amount': '5000.00', 'description': 'Bonus'})
+        self.assertEqual(response.status_code, 405)
+        self.assertFalse(Earning.objects.exists())
+        self.sponsor.refresh_from_db()
+        self.assertEqual(self.sponsor.available_balance, Decimal('0.00'))
+
+    def test_balance_at_point_in_time_with_snapshots(self):
+        start = timezone.now()
+        for days_ago, amount in ((10, '1.00'), (8, '2.00'), (6, '4.00'), (4, '8.00')):
+            Earning.objects.create(user=self.sponsor, amount=Decimal(amount), description='Bonus')
+            LedgerEntry.objects.filter(pk=LedgerEntry.objects.latest('id').pk).update(timestamp=start - timedelta(days=days_ago))
+            if days_ago == 8:
+                call_command('snapshot_balances', stdout=StringIO())
+        call_command('snapshot_balances', '--min-entries', '2', stdout=StringIO())
+        self.assertEqual(BalanceSnapshot.objects.filter(user=self.sponsor).count(), 2)
+        self.assertEqual(BalanceSnapshot.objects.filter(user=self.sponsor).latest('last_entry_id').balance, Decimal('15.00'))
+        Earning.objects.create(user=self.sponsor, amount=Decimal('16.00'), description='Bonus')
+
+        self.assertEqual(self.sponsor.get_balance(), Decimal('31.00'))
+        self.assertEqual(self.sponsor.get_balance(start - timedelta(days=9)), Decimal('1.00'))
+        self.assertEqual(self.sponsor.get_balance(start - timedelta(days=5)), Decimal('7.00'))
+        self.assertEqual(self.sponsor.get_balance(start - timedelta(days=11)), Decimal('0.00'))
+
+        with CaptureQueriesContext(connection) as queries:
+            self.sponsor.get_balance()
+        self.assertEqual(len(queries), 2)
+
+    def test_balance_endpoint(self):
+        Purchase.objects.create(user=self.buyer, package=self.package).distribute_profit()
+        response = self.client.get('/api/users/balance/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['balance'], '12.00')
+
+        response = self.client.get('/api/users/balance/', {'at': (timezone.now() - timedelta(days=1)).isoformat()})
+        self.assertEqual(response.data['balance'], '0.00')
+        self.assertEqual(self.client.get('/api/users/balance/', {'at': 'yesterday'}).status_code, 400)
+
+class WithdrawalReservationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', email='test@example.com', password='testpassword', available_balance=Decimal('100.00'))
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def test_create_debits_balance(self):
+        response = self.client.post('/api/withdrawals/', {'amount': '40.10'})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['status'], 'pending')
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.available_balance, Decimal('59.90'))
+
+    def test_insufficient_or_invalid_amount(self):
+        for amount in ('100.01', '0', '-5', 'ten'):
+            response = self.client.post('/api/withdrawals/', {'amount': amount})
+            self.assertEqual(response.status_code, 400)
+        self.assertFalse(Withdrawal.objects.exists())
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.available_balance, Decimal('100.00'))
+
+    def test_withdrawals_cannot_be_edited_through_the_api(self):
+        withdrawal = Withdrawal.reserve(self.user, Decimal('10.00'))
+        response = self.client.patch(f'/api/withdrawals/{withdrawal.pk}/', {'amount': '90000.00', 'status': 'rejected'})
+        self.assertEqual(response.status_code, 405)
+        self.assertEqual(self.client.delete(f'/api/withdrawals/{withdrawal.pk}/').status_code, 405)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.available_balance, Decimal('90.00'))
+
+    def test_rejection_refunds_the_reserved_amount(self):
+        withdrawal = Withdrawal.reserve(self.user, Decimal('10.00'))
+        withdrawal.amount = Decimal('90000.00')
+        withdrawal.status = Withdrawal.REJECTED
+        with self.assertRaises(ValidationError):
+            withdrawal.save()
+        withdrawal = Withdrawal.objects.get(pk=withdrawal.pk)
+        self.assertEqual(withdrawal.status, Withdrawal.PENDING)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.available_balance, Decimal('90.00'))
+
+    def test_rejection_releases_funds(self):
+        withdrawal = Withdrawal.reserve(self.user, Decimal('30.00'))
+        withdrawal.status = Withdrawal.REJECTED
+        withdrawal.save()
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.available_balance, Decimal('100.00'))
+
+        withdrawal.status = Withdrawal.PENDING
+        withdrawal.save()
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.available_balance, Decimal('70.00'))
+
+class WithdrawalConcurrencyTests(TransactionTestCase):
+    def test_concurrent_withdrawals_never_overdraw(self):
+        user = User.objects.create_user(username='testuser', email='test@example.com', password='testpassword', available_balance=Decimal('100.00'))
+        barrier = threading.Barrier(8)
+        outcomes = []
+
+        def withdraw():
+            barrier.wait()
+            try:
+                for _ in range(5):
+                    for _ in range(500):
+                        try:
+                            Withdrawal.reserve(user, Decimal('7.00'))
+                            outcomes.append(True)
+                        except ValidationError:
+                            outcomes.append(False)
+                        except OperationalError:  # SQLite lock contention, retried
+                            time.sleep(0.001)
+                            continue
+                        break
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=withdraw) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        user.refresh_from_db()
+        self.assertEqual(len(outcomes), 40)
+        self.assertEqual(outcomes.count(True), 14)
+        self.assertEqual(Withdrawal.objects.count(), 14)
+        self.assertEqual(user.available_balance, Decimal('2.00'))
+
+class WithdrawalProcessingTests(TestCase):
+    def setUp(self):
+        self.payable = User.objects.create_user(username='payable', email='payable@example.com', password='password', wallet_address='bc1payable', available_balance=Decimal('100.00'))
+        self.no_wallet = User.objects.create_user(username='nowallet', email='nowallet@example.com', password='password', available_balance=Decimal('100.00'))
+        for amount in ('10.00', '20.00', '30.00'):
+            Withdrawal.reserve(self.payable, Decimal(amount))
+            Withdrawal.reserve(self.no_wallet, Decimal(amount))
+
+    def test_command_settles_in_chunks(self):
+        with self.assertNumQueries(10):  # per chunk: select, users, status UPDATE, refunds, ledger reversals, savepoint pair; then an empty chunk
+            claimed, completed, rejected = Withdrawal.process_batch(10)
+            Withdrawal.process_batch(10)
+        self.assertEqual((claimed, completed, rejected), (6, 3, 3))
+
+        self.assertEqual(set(self.payable.withdrawals.values_list('status', flat=True)), {'completed'})
+        self.assertEqual(set(self.no_wallet.withdrawals.values_list('status', flat=True)), {'rejected'})
+        self.no_wallet.refresh_from_db()
+        self.payable.refresh_from_db()
+        self.assertEqual(self.no_wallet.available_balance, Decimal('100.00'))
+        self.assertEqual(self.payable.available_balance, Decimal('40.00'))
+        self.assertEqual(self.no_wallet.get_balance(), Decimal('0.00'))
+
+    def test_command_is_idempotent(self):
+        out = StringIO()
+        call_command('process_withdrawals', '--batch-size', '2', stdout=out)
+        self.assertIn('Processed 6 withdrawals (3 completed, 3 rejected)', out.getvalue())
+        out = StringIO()
+        call_command('process_withdrawals', stdout=out)
+        self.assertIn('Processed 0 withdrawals', out.getvalue())
+        self.no_wallet.refresh_from_db()
+        self.assertEqual(self.no_wallet.available_balance, Decimal('100.00'))
+
+    def test_command_retries_rolled_back_chunk(self):
+        process_batch = Withdrawal.process_batch
+        calls = []
+
+        def contended_once(batch_size, ids=None):
+            calls.append(batch_size)
+            if len(calls) == 1:
+                return batch_size, 0, 0  # claimed, then rolled back because another writer got there
+            return process_batch(batch_size, ids)
+
+        out = StringIO()
+        with patch.object(Withdrawal, 'process_batch', contended_once):
+            call_command('process_withdrawals', '--batch-size', '2', stdout=out)
+        self.assertIn('Processed 6 withdrawals (3 completed, 3 rejected)', out.getvalue())
+        self.assertFalse(Withdrawal.objects.filter(status=Withdrawal.PENDING).exists())
+
+    def test_admin_bulk_action(self):
+        admin_user = User.objects.create_superuser(username='admin', email='admin@example.com', password='password')
+        self.client.force_login(admin_user)
+        selected = list(self.payable.withdrawals.values_list('id', flat=True)[:2])
+        response = self.client.post('/admin/mlm_users/withdrawal/', {'action': 'process_withdrawals', '_selected_action': selected})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Withdrawal.objects.filter(status='completed').count(), 2)
+        self.assertEqual(Withdrawal.objects.filter(status='pending').count(), 4)
+
+class ResponseCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        cache_counters.clear()
+        self.sponsor = User.objects.create_user(username='sponsor', email='sponsor@example.com', password='password')
+        self.buyer = User.objects.create_user(username='buyer', email='buyer@example.com', password='password', sponsor=self.sponsor)
+        self.package = Package.objects.create(name='Test Package', price=Decimal('100.00'), profit_percentage=Decimal('40.00'))
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.sponsor)
+
+    def test_package_list_cached_until_package_changes(self):
+        self.client.get('/api/packages/')
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/packages/')
+        self.assertEqual([package['name'] for package in response.data], ['Test Package'])
+
+        Package.objects.create(name='Second Package', price=Decimal('50.00'), profit_percentage=Decimal('10.00'))
+        response = self.client.get('/api/packages/')
+        self.assertEqual(len(response.data), 2)
+        self.assertEqual(cache_counters['packages_hits'], 1)
+        self.assertEqual(cache_counters['packages_misses'], 2)
+
+    def profile(self, user):
+        # Authenticate with a freshly loaded row, as JWT authentication does per request
+        self.client.force_authenticate(user=User.objects.get(pk=user.pk))
+        return self.client.get('/api/users/profile/').data
+
+    def test_profile_invalidated_by_balance_changes(self):
+        self.assertEqual(self.profile(self.sponsor)['total_earnings'], '0.00')
+        self.assertEqual(self.profile(self.sponsor)['total_earnings'], '0.00')
+
+        Purchase.objects.create(user=self.buyer, package=self.package).distribute_profit()
+        self.assertEqual(self.profile(self.sponsor)['total_earnings'], '12.00')
+        self.assertEqual(self.profile(self.sponsor)['team_volume'], '100.00')
+
+        Withdrawal.reserve(self.sponsor, Decimal('2.00'))
+        self.assertEqual(self.profile(self.sponsor)['available_balance'], '10.00')
+        self.assertEqual(cache_counters['profile_hits'], 2)
+        self.assertEqual(cache_counters['profile_misses'], 3)
+
+    def test_profiles_are_per_user_and_follow_moves(self):
+        self.assertEqual(self.profile(self.sponsor)['username'], 'sponsor')
+        self.assertEqual(self.profile(self.buyer)['level'], 1)
+
+        self.buyer.move_to(None)
+        self.assertEqual(self.profile(self.buyer)['level'], 0)
+
+    def test_stats_endpoint_is_staff_only(self):
+        self.client.get('/api/packages/')
+        self.assertEqual(self.client.get('/api/users/cache-stats/').status_code, 403)
+        self.client.force_authenticate(user=User.objects.create_user(username='admin', email='admin@example.com', password='password', is_staff=True))
+        self.assertEqual(self.client.get('/api/users/cache-stats/').data, {'packages_misses': 1})
+
+    def test_process_local_cache_is_flagged(self):
+        self.assertEqual([warning.id for warning in check_shared_cache(None)], ['mlm_users.W001'])
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache', 'LOCATION': 'mlm_cache'}}):
+            self.assertEqual(check_shared_cache(None), [])
+
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.sponsor = User.objects.create_user(username='sponsor', email='sponsor@example.com', password='password')
+        self.buyer = User.objects.create_user(username='buyer', email='buyer@example.com', password='password', sponsor=self.sponsor)
+        self.package = Package.objects.create(name='Test Package', price=Decimal('100.00'), profit_percentage=Decimal('40.00'))
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.sponsor)
+
+    def test_matching_etag_returns_304_without_queries(self):
+        for url in ('/api/packages/', '/api/users/profile/', '/api/users/team/'):
+            etag = self.client.get(url)['ETag']
+            with self.assertNumQueries(0):
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response['ETag'], etag)
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH='"stale"').status_code, 200)
+
+    def test_etag_changes_with_data(self):
+        packages = self.client.get('/api/packages/')['ETag']
+        team = self.client.get('/api/users/team/')['ETag']
+        self.assertNotEqual(self.client.get('/api/users/team/', {'depth': 1})['ETag'], team)
+
+        self.buyer.email = 'renamed@example.com'
+        self.buyer.save()
+        self.assertEqual(self.client.get('/api/users/team/', HTTP_IF_NONE_MATCH=team).status_code, 200)
+
+        self.package.price = Decimal('120.00')
+        self.package.save()
+        self.assertEqual(self.client.get('/api/packages/', HTTP_IF_NONE_MATCH=packages).status_code, 200)
+
+    def test_team_etag_follows_downline_earnings(self):
+        downline = User.objects.create_user(username='downline', email='downline@example.com', password='password', sponsor=self.buyer)
+        leaf = User.objects.create_user(username='leaf', email='leaf@example.com', password='password', sponsor=downline)
+        team = self.client.get('/api/users/team/', {'depth': 3})['ETag']
+        purchase = Purchase.objects.create(user=leaf, package=self.package)
+        team_after_purchase = self.client.get('/api/users/team/', {'depth': 3})['ETag']
+        self.assertNotEqual(team_after_purchase, team)
+
+        purchase.distribute_profit()
+        self.assertEqual(self.client.get('/api/users/team/', {'depth': 3}, HTTP_IF_NONE_MATCH=team_after_purchase).status_code, 200)
+
+class CachedAuthenticationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        cache_counters.clear()
+        self.user = User.objects.create_user(username='testuser', email='test@example.com', password='testpassword')
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user)}')
+
+    def test_user_resolved_from_cache(self):
+        with self.assertNumQueries(2):  # user row, then earnings
+            self.assertEqual(self.client.get('/api/users/earnings/').status_code, 200)
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/users/profile/')
+        self.assertEqual(response.data['username'], 'testuser')
+        self.assertEqual((cache_counters['auth_misses'], cache_counters['auth_hits']), (1, 1))
+
+    def test_saving_user_invalidates_entry(self):
+        self.client.get('/api/users/profile/')
+        User.objects.filter(pk=self.user.pk).update(available_balance=Decimal('9.00'))
+        self.assertEqual(self.client.get('/api/users/profile/').data['available_balance'], '0.00')
+
+        user = User.objects.get(pk=self.user.pk)
+        user.first_name = 'Renamed'
+        user.save()
+        response = self.client.get('/api/users/profile/')
+        self.assertEqual(response.data['available_balance'], '9.00')
+        self.assertEqual(cache_counters['auth_misses'], 2)
+
+        user.is_active = False
+        user.save()
+        self.assertEqual(self.client.get('/api/users/profile/').status_code, 401)
+
+    def test_updates_start_from_current_row(self):
+        self.client.get('/api/users/profile/')
+        Earning.objects.create(user=self.user, amount=Decimal('1.00'), description='Bonus')
+        User.objects.filter(pk=self.user.pk).update(available_balance=Decimal('5.00'))
+        response = self.client.patch(f'/api/users/{self.user.pk}/', {'wallet_address': 'bc1new'})
+        self.assertEqual(response.status_code, 200)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.available_balance, Decimal('5.00'))
+
+class NetworkImportTests(TestCase):
+    def setUp(self):
+        self.existing = User.objects.create_user(username='existing', email='existing@example.com', password='password')
+        self.hashed = make_password('secret')
+
+    def test_import_command(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as f:
+            f.write('username,email,password,sponsor,wallet_address\n')
+            f.write(f'alice,alice@example.com,{self.hashed},existing,0xalice\n')
+            f.write('bob,bob@example.com,,alice,\n')
+            f.write('carol,carol@example.com,,bob,\n')
+            f.write('dave,dave@example.com,plaintext,alice,\n')
+            f.write('erin,erin@example.com,,nobody,\n')
+            f.write('frank,alice@example.com,,,\n')
+        out, err = StringIO(), StringIO()
+        call_command('import_network', f.name, '--chunk-size', '2', stdout=out, stderr=err)
+
+        self.assertIn('Imported 3 of 6 users', out.getvalue())
+        self.assertIn('Row 4: Password is not a recognised hash', err.getvalue())
+        self.assertIn('Row 5: Unknown sponsor', err.getvalue())
+        self.assertIn('Row 6: Duplicate username, email or wallet address', err.getvalue())
+
+        alice, bob, carol = (User.objects.get(username=name) for name in ('alice', 'bob', 'carol'))
+        self.assertTrue(alice.check_password('secret'))
+        self.assertFalse(bob.has_usable_password())
+        self.assertEqual(carol.path, f'/{self.existing.pk}/{alice.pk}/{bob.pk}/')
+        self.assertEqual(carol.level, 3)
+        self.assertEqual(carol.sponsor, bob)
+        self.existing.refresh_from_db()
+        self.assertEqual((self.existing.direct_team_size, self.existing.team_size), (1, 3))
+        self.assertEqual((alice.direct_team_size, alice.team_size), (1, 2))
+
+    def test_same_chunk_sponsors_and_query_count(self):
+        rows = [{'username': 'root0', 'email': 'root0@example.com'}] + [
+            {'username': f'user{i}', 'email': f'user{i}@example.com', 'sponsor': f'user{i - 1}' if i else 'root0'}
+            for i in range(20)
+        ]
+        with self.assertNumQueries(4 + 21 + 1):  # sponsors, taken keys, savepoint pair, one insert per generation, counters
+            stats = import_network(rows, chunk_size=100)
+        self.assertEqual(stats['imported'], 21)
+        self.assertEqual(User.objects.get(username='user19').level, 20)
+        self.assertEqual(User.objects.get(username='root0').team_size, 20)
+
+    def test_later_chunks_resolve_sponsors_and_duplicates_from_the_database(self):
+        rows = [
+            {'username': 'alice', 'email': 'alice@example.com', 'sponsor': 'existing'},
+            {'username': 'bob', 'email': 'bob@example.com', 'sponsor': 'alice'},
+            {'username': 'alice', 'email': 'alice2@example.com'},
+            {'username': 'carol', 'email': 'carol@example.com', 'sponsor': 'bob'},
+        ]
+        stats = import_network(rows, chunk_size=1)
+        self.assertEqual((stats['imported'], stats['errors']), (3, [{'row': 3, 'error': 'Duplicate username, email or wallet address'}]))
+        bob = User.objects.get(username='bob')
+        self.assertEqual(User.objects.get(username='carol').path, f'{bob.path}{bob.pk}/')
+
+    def test_depth_first_file_inserts_one_generation_at_a_time(self):
+        rows = []
+        for i in range(3):
+            rows.append({'username': f'child{i}', 'email': f'child{i}@example.com', 'sponsor': 'existing'})
+            rows.extend(
+                {'username': f'grandchild{i}{j}', 'email': f'grandchild{i}{j}@example.com', 'sponsor': f'child{i}'}
+                for j in range(3)
+            )
+        with self.assertNumQueries(4 + 2 + 1):  # sponsors, taken keys, savepoint pair, children, grandchildren, counters
+            stats = import_network(rows, chunk_size=100)
+        self.assertEqual(stats['imported'], 12)
+        child = User.objects.get(username='child2')
+        self.assertEqual(User.objects.get(username='grandchild21').path, f'/{self.existing.pk}/{child.pk}/')
+        self.existing.refresh_from_db()
+        self.assertEqual((self.existing.direct_team_size, self.existing.team_size), (3, 12))
+
+class GenerateNetworkTests(TestCase):
+    def network(self, prefix):
+        return [
+            (username.removeprefix(prefix), (sponsor or '').removeprefix(prefix), level, team_size, str(team_volume), str(total_earnings))
+            for username, sponsor, level, team_size, team_volume, total_earnings in User.objects.filter(username__startswith=prefix)
+            .order_by('id').values_list('username', 'sponsor__username', 'level', 'team_size', 'team_volume', 'total_earnings')
+        ]
+
+    def test_generates_deterministic_consistent_network(self):
+        out = StringIO()
+        args = ['--users', '60', '--branching', '2-4', '--depth', '4', '--purchase-rate', '1.5', '--chunk-size', '7']
+        call_command('generate_network', '--seed', '7', '--prefix', 'a', *args, stdout=out)
+        call_command('generate_network', '--seed', '7', '--prefix', 'b', *args, stdout=StringIO())
+        self.assertIn('Generated 60 users over', out.getvalue())
+
+        self.assertEqual(self.network('a-'), self.network('b-'))
+        self.assertLessEqual(max(level for _, _, level, *_ in self.network('a-')), 4)
+        self.assertEqual(Package.objects.count(), 5)
+        self.assertTrue(User.objects.get(username='a-5').check_password('password123'))
+
+        reconcile = StringIO()
+        call_command('reconcile_team_stats', stdout=reconcile)
+        self.assertIn('(0 corrected)', reconcile.getvalue())
+        # Balances and rollups are precomputed, so they must agree with the earning rows user by user
+        earned = dict(Earning.objects.values('user_id').annotate(total=Sum('amount')).values_list('user_id', 'total').order_by())
+        self.assertEqual(dict(User.objects.filter(total_earnings__gt=0).values_list('id', 'total_earnings')), earned)
+        self.assertEqual(dict(User.objects.filter(available_balance__gt=0).values_list('id', 'available_balance')), earned)
+        self.assertEqual(dict(EarningDailyRollup.objects.values_list('user_id', 'amount')), earned)
+        self.assertEqual(
+            sum(EarningDailyRollup.objects.values_list('count', flat=True)), Earning.objects.count(),
+        )
+        ledger = LedgerEntry.objects.values('user_id').annotate(total=Sum('amount')).values_list('user_id', 'total').order_by()
+        self.assertEqual(dict(ledger), earned)
+
+    def test_rejects_existing_prefix(self):
+        User.objects.create_user(username='user-0', email='user0@example.com', password='password')
+        with self.assertRaises(CommandError):
+            call_command('generate_network', '--users', '5', stdout=StringIO())
+
+class BenchmarkSuiteTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        build_network(users=40, branching='2-3', depth=4)
+
+    def test_report_within_default_query_budgets(self):
+        # Wall time and memory depend on the machine running the suite, so only query counts are held to budget here
+        names = ['team', 'earnings_list', 'purchase_create']
+        budgets = {name: {'queries': DEFAULT_BUDGETS[name]['queries']} for name in names}
+        report = run_benchmarks(iterations=1, budgets=budgets, only=names)
+        self.assertEqual(set(report['results']), set(names))
+        team = report['results']['team']
+        self.assertEqual(team['statuses'], [200])
+        self.assertLessEqual(team['queries'], team['budget']['queries'])
+        self.assertIn('max', team['wall_ms'])
+        self.assertIn('peak_kb', team)
+        self.assertTrue(report['passed'], report)
+
+    def test_budget_overrun_fails(self):
+        report = run_benchmarks(iterations=1, budgets={'earnings_list': {'queries': 0}}, only=['earnings_list'])
+        self.assertFalse(report['passed'])
+        self.assertEqual(report['results']['earnings_list']['over_budget'], ['queries'])
+
+class RequestMetricsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        histogram.slots.clear()
+        self.user = User.objects.create_user(username='testuser', email='test@example.com', password='testpassword')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    @override_settings(DEBUG=True)
+    def test_debug_headers(self):
+        response = self.client.get('/api/users/earnings/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Query-Count'], '1')
+        self.assertGreater(float(response['X-Request-Time-ms']), 0)
+        self.assertIn('X-SQL-Time-ms', response)
+        self.assertIn('X-Slowest-Query-ms', response)
+
+    @override_settings(DEBUG=True)
+    def test_query_count_under_asgi(self):
+        # Queries run on sync_to_async threads, and concurrent requests must not count each other's
+        headers = {'Authorization': f'Bearer {AccessToken.for_user(self.user)}'}
+        cache.set(CachedJWTAuthentication().cache_key(self.user.pk), self.user)
+
+        async def run():
+            return await asyncio.gather(*(
+                self.async_client.get(path, headers=headers)
+                for path in ['/api/users/earnings/', '/api/async/users/earnings/'] * 2
+            ))
+
+        for response in async_to_sync(run)():
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['X-Query-Count'], '1')
+
+    def test_log_line_in_production(self):
+        with self.assertLogs('mlm_users.requests', 'INFO') as logs:
+            response = self.client.get('/api/users/earnings/')
+        self.assertNotIn('X-Query-Count', response)
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual(line['endpoint'], 'GET user-earnings')
+        self.assertEqual((line['status'], line['queries']), (200, 1))
+        self.assertEqual(len(line['slowest']), 1)
+        self.assertIn('mlm_users_earning', line['slowest'][0]['sql'])
+
+    def test_histogram_window(self):
+        latency = LatencyHistogram(window=60, slot=10)
+        for ms in [3, 3, 3, 40, 40, 40, 40, 40, 40, 700]:
+            latency.record('GET team', ms, 2, now=1000)
+        latency.record('GET profile', 1, 0, now=905)
+        stats = latency.snapshot(now=1005)['endpoints']
+        self.assertEqual(set(stats), {'GET team'})
+        team = stats['GET team']
+        self.assertEqual((team['count'], team['mean_queries']), (10, 2))
+        self.assertEqual((team['p50_ms'], team['p95_ms']), (50, 1000))
+        self.assertEqual((team['buckets']['5'], team['buckets']['50'], team['buckets']['+Inf']), (3, 6, 0))
+        latency.record('GET team', 9000, 2, now=1010)
+        self.assertIsNone(latency.snapshot(now=1010)['endpoints']['GET team']['p99_ms'])
+        self.assertEqual(latency.snapshot(now=1080)['endpoints'], {})
+
+    def test_metrics_endpoint_is_staff_only(self):
+        self.client.get('/api/users/earnings/')
+        self.assertEqual(self.client.get('/api/metrics/').status_code, 403)
+        self.user.is_staff = True
+        self.user.save()
+        self.client.force_authenticate(user=User.objects.get(pk=self.user.pk))
+        response = self.client.get('/api/metrics/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['endpoints']['GET user-earnings']['count'], 1)
+
+@override_settings(MLM_READ_REPLICA='replica')
+class ReplicaRoutingTests(TransactionTestCase):
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        cache.clear()
+        cache_counters.clear()
+        self.user = User.objects.create_user(username='testuser', email='test@example.com', password='testpassword')
+        Earning.objects.create(user=self.user, amount=Decimal('1.00'), description='Bonus')
+        Package.objects.create(name='Starter', price=Decimal('100.00'), profit_percentage=Decimal('10.00'))
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def queries_by_alias(self, request):
+        with CaptureQueriesContext(connections['default']) as primary, CaptureQueriesContext(connections['replica']) as replica:
+            response = request()
+        self.assertLess(response.status_code, 400)
+        return response, len(primary), len(replica)
+
+    def test_safe_actions_read_from_replica(self):
+        response, primary, replica = self.queries_by_alias(lambda: self.client.get('/api/earnings/'))
+        self.assertEqual((primary, replica), (0, 1))
+        self.assertEqual(len(response.data['results']), 1)
+        _, primary, replica = self.queries_by_alias(lambda: self.client.get('/api/users/team/'))
+        self.assertEqual((primary, replica), (0, 1))
+        _, primary, replica = self.queries_by_alias(lambda: self.client.get('/api/users/balance/'))
+        self.assertEqual(replica, 0)
+
+    def test_reads_stick_to_primary_after_write(self):
+        self.client.patch(f'/api/users/{self.user.pk}/', {'wallet_address': 'bc1new'})
+        _, primary, replica = self.queries_by_alias(lambda: self.client.get('/api/users/earnings/'))
+        self.assertEqual((primary, replica), (1, 0))
+        cache.delete(f'mlm:sticky:{self.user.pk}')
+        _, primary, replica = self.queries_by_alias(lambda: self.client.get('/api/users/earnings/'))
+        self.assertEqual((primary, replica), (0, 1))
+
+    def test_replica_responses_not_cached_or_tagged(self):
+        for _ in range(2):
+            response, primary, replica = self.queries_by_alias(lambda: self.client.get('/api/packages/'))
+            self.assertEqual((primary, replica), (0, 1))
+            self.assertNotIn('ETag', response)
+        self.assertEqual(cache_counters['packages_misses'], 2)
+
+    @override_settings(MLM_READ_REPLICA=None)
+    def test_disabled_without_replica(self):
+        _, primary, replica = self.queries_by_alias(lambda: self.client.get('/api/earnings/'))
+        self.assertEqual((primary, replica), (1, 0))
+
+class AsyncReadEndpointTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.package = Package.objects.create(name='Starter', price=Decimal('100.00'), profit_percentage=Decimal('10.00'))
+        self.user = User.objects.create_user(username='sponsor', email='sponsor@example.com', password='testpassword')
+        User.objects.create_user(username='member', email='member@example.com', password='testpassword', sponsor=self.user)
+        for amount in ['1.00', '2.00', '3.00']:
+            Earning.objects.create(user=self.user, amount=Decimal(amount), description='Bonus')
+        Withdrawal.objects.create(user=self.user, amount=Decimal('1.00'))
+        self.token = f'Bearer {AccessToken.for_user(self.user)}'
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=self.token)
+
+    def aget(self, path, data=None, **headers):
+        headers.setdefault('Authorization', self.token)
+        return async_to_sync(self.async_client.get)(path, data, headers=headers)
+
+    def test_payloads_match_sync_endpoints(self):
+        for sync_path, async_path in [
+            ('/api/users/profile/', '/api/async/users/profile/'),
+            ('/api/users/team/', '/api/async/users/team/'),
+            ('/api/users/earnings/', '/api/async/users/earnings/'),
+            ('/api/users/withdrawals/', '/api/async/users/withdrawals/'),
+            ('/api/packages/', '/api/async/packages/'),
+        ]:
+            expected = self.client.get(sync_path)
+            response = self.aget(async_path)
+            self.assertEqual(response.status_code, 200, async_path)
+            self.assertEqual(response.json(), json.loads(expected.content), async_path)
+            self.assertEqual(response.get('ETag'), expected.get('ETag'), async_path)
+
+    def test_cursor_pagination(self):
+        first = self.aget('/api/async/users/earnings/', {'page_size': 2}).json()
+        self.assertEqual([row['amount'] for row in first['results']], ['3.00', '2.00'])
+        rest = self.aget(first['next']).json()
+        self.assertEqual(([row['amount'] for row in rest['results']], rest['next']), (['1.00'], None))
+
+    def test_not_modified_and_validation(self):
+        etag = self.aget('/api/async/users/team/')['ETag']
+        self.assertEqual(self.aget('/api/async/users/team/', **{'If-None-Match': etag}).status_code, 304)
+        response = self.aget('/api/async/users/team/', {'depth': 0})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['error'], 'Validation Error')
+
+    def test_cache_is_not_called_on_the_event_loop(self):
+        def off_loop(method):
+            def call(*args, **kwargs):
+                with self.assertRaises(RuntimeError):
+                    asyncio.get_running_loop()
+                return method(*args, **kwargs)
+            return call
+
+        names = ['get', 'get_many', 'add', 'set']
+        with ExitStack() as stack:
+            for name in names:
+                stack.enter_context(patch.object(cache, name, side_effect=off_loop(getattr(cache, name))))
+            for path in ['/api/async/users/profile/', '/api/async/users/team/', '/api/async/packages/']:
+                self.assertEqual(self.aget(path).status_code, 200, path)
+                self.assertEqual(self.aget(path).status_code, 200, path)
+
+    def test_authentication_required(self):
+        self.assertEqual(self.aget('/api/async/users/profile/', Authorization='').status_code, 401)
+        response = self.aget('/api/async/users/profile/', Authorization='Bearer nonsense')
+        self.assertEqual(response.status_code, 401)
+        self.assertIn('WWW-Authenticate', response)
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.aget('/api/async/packages/').status_code, 401)
+        self.assertEqual(async_to_sync(self.async_client.post)('/api/async/packages/').status_code, 405)
+
+class AsgiConcurrencyBenchmarkTests(TransactionTestCase):
+    # Requests run on ASGI worker threads with their own connections, so the data has to be committed
+    def setUp(self):
+        cache.clear()
+        build_network(users=3, branching='1-2', depth=2)
+
+    def test_compares_sync_and_async_paths(self):
+        # A smoke check of the report; real throughput numbers come from the benchmark command
+        report = run_concurrency_benchmark(concurrency=1, total=1, only=['profile'])
+        self.assertEqual((report['concurrency'], report['requests']), (1, 1))
+        result = report['results']['profile']
+        self.assertEqual((result['sync']['statuses'], result['async']['statuses']), ([200], [200]))
+        self.assertGreater(result['speedup'], 0)
+
+class RecordingBackend(EventBackend):
+    published = []
+
+    def publish(self, channel, message):
+        self.published.append((channel, message))
+
+@override_settings(MLM_EVENTS_BACKEND='mlm_users.tests.RecordingBackend')
+class EventPublishingTests(TestCase):
+    def setUp(self):
+        RecordingBackend.published.clear()
+        self.user = User.objects.create_user(username='testuser', email='test@example.com', password='testpassword')
+
+    def test_earnings_and_balance_published_after_commit(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            record_earnings([Earning(user=self.user, amount=Decimal('4.50'), description='Level 1 commission')])
+            self.assertEqual(RecordingBackend.published, [])
+        for callback in callbacks:
+            callback()
+        channel = user_channel(self.user.pk)
+        self.assertEqual(RecordingBackend.published, [(channel, {'event': 'earning'}), (channel, {'event': 'balance'})])
+
+    def test_withdrawal_reservation_and_refund(self):
+        User.objects.filter(pk=self.user.pk).update(available_balance=Decimal('10.00'))
+        with self.captureOnCommitCallbacks(execute=True):
+            withdrawal = Withdrawal.reserve(self.user, Decimal('5.00'))
+        with self.captureOnCommitCallbacks(execute=True):
+            withdrawal.status = Withdrawal.REJECTED
+            withdrawal.save()
+        self.assertEqual([message for _, message in RecordingBackend.published], [{'event': 'balance'}] * 2)
+
+    def test_local_backend_delivers_across_threads(self):
+        backend = LocalBackend()
+
+        async def receive():
+            subscription = backend.subscribe('user:1')
+            other = backend.subscribe('user:2')
+            await sync_to_async(backend.publish, thread_sensitive=False)('user:1', {'event': 'balance'})
+            message = await asyncio.wait_for(subscription.get(), 1)
+            self.assertEqual((message, other.pending()), ({'event': 'balance'}, []))
+            subscription.close()
+            other.close()
+
+        async_to_sync(receive)()
+        self.assertEqual(dict(backend.subscribers), {})
+
+class EventStreamTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='testuser', email='test@example.com', password='testpassword')
+        self.token = str(AccessToken.for_user(self.user))
+
+    def earn(self, amount):
+        with self.captureOnCommitCallbacks(execute=True):
+            return record_earnings([Earning(user=self.user, amount=Decimal(amount), description='Bonus')])[0]
+
+    async def read_events(self, stream, count):
+        events = []
+        while len(events) < count:
+            chunk = (await asyncio.wait_for(anext(stream), 2)).decode()
+            if chunk.startswith('event:'):
+                fields = dict(line.split(': ', 1) for line in chunk.strip().split('\n'))
+                events.append((fields['event'], json.loads(fields['data'])))
+        return events
+
+    def test_pushes_earnings_and_balance(self):
+        async def run():
+            response = await self.async_client.get('/api/users/events/', headers={'Authorization': f'Bearer {self.token}'})
+            self.assertEqual((response.status_code, response['Content-Type']), (200, 'text/event-stream'))
+            stream = aiter(response)
+            try:
+                self.assertEqual(await self.read_events(stream, 1), [('balance', {'available_balance': '0.00', 'total_earnings': '0.00'})])
+                await sync_to_async(self.earn)('2.50')
+                (kind, earning), balance = await self.read_events(stream, 2)
+                self.assertEqual((kind, earning['amount']), ('earning', '2.50'))
+                self.assertEqual(balance, ('balance', {'available_balance': '2.50', 'total_earnings': '2.50'}))
+            finally:
+                await stream.aclose()
+
+        async_to_sync(run)()
+
+    @override_settings(MLM_EVENTS_POLL_SECONDS=0.05)
+    def test_delivers_earnings_written_by_another_process(self):
+        async def run():
+            response = await self.async_client.get('/api/users/events/', headers={'Authorization': f'Bearer {self.token}'})
+            stream = aiter(response)
+            try:
+                await self.read_events(stream, 1)
+                # Never published to this process's hub, like a commission credited by a worker
+                earning, = await sync_to_async(record_earnings)([Earning(user=self.user, amount=Decimal('4.00'), description='Bonus')])
+                (kind, data), balance = await self.read_events(stream, 2)
+                self.assertEqual((kind, data['id']), ('earning', earning.pk))
+                self.assertEqual(balance, ('balance', {'available_balance': '4.00', 'total_earnings': '4.00'}))
+            finally:
+                await stream.aclose()
+
+        async_to_sync(run)()
+
+    @override_settings(MLM_EVENTS_POLL_SECONDS=0.05, MLM_EVENTS_KEEPALIVE=0.5)
+    def test_idle_stream_reads_only_when_the_version_changes(self):
+        async def run():
+            with patch('mlm_users.async_views.balance_event', wraps=balance_event) as reads:
+                response = await self.async_client.get('/api/users/events/', headers={'Authorization': f'Bearer {self.token}'})
+                stream = aiter(response)
+                try:
+                    await self.read_events(stream, 1)
+                    # Polled several times before the keepalive, without reading anything
+                    self.assertEqual((await asyncio.wait_for(anext(stream), 2)).decode(), ': keepalive\n\n')
+                    self.assertEqual(reads.call_count, 1)
+                    await sync_to_async(record_earnings)([Earning(user=self.user, amount=Decimal('1.00'), description='Bonus')])
+                    await self.read_events(stream, 2)
+                    self.assertEqual(reads.call_count, 2)
+                finally:
+                    await stream.aclose()
+
+        async_to_sync(run)()
+
+    def test_replays_missed_earnings_with_query_token(self):
+        first, second = self.earn('1.00'), self.earn('2.00')
+
+        async def run():
+            response = await self.async_client.get(
+                '/api/users/events/', {'token': self.token}, headers={'Last-Event-ID': str(first.pk)},
+            )
+            stream = aiter(response)
+            try:
+                (kind, earning), (_, balance) = await self.read_events(stream, 2)
+                self.assertEqual((kind, earning['id']), ('earning', second.pk))
+                self.assertEqual(balance['available_balance'], '3.00')
+            finally:
+                await stream.aclose()
+
+        async_to_sync(run)()
+
+    def test_requires_token_and_asgi(self):
+        self.assertEqual(async_to_sync(self.async_client.get)('/api/users/events/').status_code, 401)
+        response = self.client.get('/api/users/events/', {'token': self.token})
+        self.assertEqual(response.status_code, 501)
+
+class HistoryExportTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', email='test@example.com', password='testpassword')
+        self.other = User.objects.create_user(username='other', email='other@example.com', password='testpassword')
+        self.package = Package.objects.create(name='Starter', price=Decimal('100.00'), profit_percentage=Decimal('10.00'))
+        now = timezone.now()
+        for days, amount in [(10, '1.00'), (5, '2.50'), (0, '3.00')]:
+            earning = Earning.objects.create(user=self.user, amount=Decimal(amount), description=f'Bonus, day -{days}')
+            Earning.objects.filter(pk=earning.pk).update(timestamp=now - timedelta(days=days))
+        Earning.objects.create(user=self.other, amount=Decimal('9.00'), description='Not mine')
+        Purchase.objects.create(user=self.user, package=self.package)
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def content(self, response):
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content).decode()
+
+    def test_csv_export(self):
+        response = self.client.get('/api/users/earnings/export/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        self.assertIn('attachment; filename="earnings-', response['Content-Disposition'])
+        rows = list(csv.reader(StringIO(self.content(response))))
+        self.assertEqual(rows[0], ['id', 'amount', 'description', 'timestamp'])
+        self.assertEqual([row[1:3] for row in rows[1:]], [['1.00', 'Bonus, day -10'], ['2.50', 'Bonus, day -5'], ['3.00', 'Bonus, day -0']])
+        # Timestamps match the JSON API's, whose oldest row comes last
+        self.assertEqual(rows[1][3], self.client.get('/api/earnings/').data['results'][-1]['timestamp'])
+
+    def test_ndjson_export_with_date_range(self):
+        today = timezone.localdate()
+        params = {'format': 'ndjson', 'start': today - timedelta(days=6), 'end': today - timedelta(days=1)}
+        response = self.client.get('/api/users/earnings/export/', params)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson; charset=utf-8')
+        lines = [json.loads(line) for line in self.content(response).splitlines()]
+        self.assertEqual([line['amount'] for line in lines], ['2.50'])
+
+        response = self.client.get('/api/purchases/export/', HTTP_ACCEPT='application/x-ndjson')
+        purchase, = [json.loads(line) for line in self.content(response).splitlines()]
+        self.assertEqual((purchase['package'], purchase['package_name'], purchase['price']), (self.package.pk, 'Starter', '100.00'))
+
+    @override_settings(MLM_EXPORT_CHUNK_SIZE=2)
+    def test_streamed_in_chunks(self):
+        with self.assertNumQueries(1):
+            chunks = list(self.client.get('/api/users/earnings/export/').streaming_content)
+        self.assertEqual(len(chunks), 2)
+
+    def test_other_users_history_is_staff_only(self):
+        response = self.client.get('/api/users/earnings/export/', {'user': self.other.pk})
+        self.assertEqual(response.status_code, 403)
+        self.user.is_staff = True
+        self.user.save()
+        self.client.force_authenticate(user=User.objects.get(pk=self.user.pk))
+        content = self.content(self.client.get('/api/users/earnings/export/', {'user': self.other.pk}))
+        self.assertIn('Not mine', content)
+        self.assertNotIn('Bonus', content)
+
+    def test_invalid_range(self):
+        response = self.client.get('/api/users/earnings/export/', {'start': '2024-02-01', 'end': '2024-01-01'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['error'], 'Validation Error')
+
+    def test_async_iterator_under_asgi(self):
+        token = f'Bearer {AccessToken.for_user(self.user)}'
+
+        async def read():
+            response = await self.async_client.get('/api/users/earnings/export/', {'format': 'ndjson'}, headers={'Authorization': token})
+            self.assertTrue(response.is_async)
+            return b''.join([chunk async for chunk in response]).decode()
+
+        self.assertEqual(len(async_to_sync(read)().splitlines()), 3)
@@ -1,6 +1,7 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import UserViewSet, EarningViewSet, WithdrawalViewSet, PackageViewSet, PurchaseViewSet
+from .views import UserViewSet, EarningViewSet, WithdrawalViewSet, PackageViewSet, PurchaseViewSet, CommissionJobViewSet, MetricsView
+from . import async_views
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 
 router = DefaultRouter()
@@ -9,9 +10,18 @@ router.register(r'earnings', EarningViewSet)
 router.register(r'withdrawals', WithdrawalViewSet)
 router.register(r'packages', PackageViewSet)
 router.register(r'purchases', PurchaseViewSet)
+router.register(r'commission-jobs', CommissionJobViewSet)
 
 urlpatterns = [
+    # Ahead of the router, which would otherwise take "events" for a user pk
+    path('users/events/', async_views.events, name='user-events'),
     path('', include(router.urls)),
+    path('metrics/', MetricsView.as_view(), name='metrics'),
+    path('async/users/profile/', async_views.profile, name='async-profile'),
+    path('async/users/team/', async_views.team, name='async-team'),
+    path('async/users/earnings/', async_views.earnings, name='async-earnings'),
+    path('async/users/withdrawals/', async_views.withdrawals, name='async-withdrawals'),
+    path('async/packages/', async_views.packages, name='async-packages'),
     path('token/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
     path('token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
 ]
\ No newline at end of file
@@ -1,14 +1,71 @@
-from rest_framework import viewsets, permissions, status, serializers
+import codecs
+import csv
+from collections import Counter
+from decimal import Decimal
+from rest_framework import mixins, viewsets, permissions, status, serializers
 from rest_framework.decorators import action
+from rest_framework.exceptions import PermissionDenied
+from rest_framework.views import APIView
 from rest_framework.response import Response
-from django.core.exceptions import ObjectDoesNotExist
-from .models import User, Earning, Withdrawal, Package, Purchase
-from .serializers import UserSerializer, UserRegistrationSerializer, EarningSerializer, WithdrawalSerializer, TeamMemberSerializer, PackageSerializer, PurchaseSerializer
+from django.core.exceptions import ObjectDoesNotExist, ValidationError as DjangoValidationError
+from django.conf import settings
+from django.http import Http404
+from django.db import transaction
+from django.db.models import F, Sum
+from django.db.models.functions import TruncMonth, TruncWeek
+from django.utils import timezone
+from .caching import PACKAGES, TREE, cache_stats, cached_response, get_versions, make_etag, not_modified, user_scope
+from .db_routers import mark_write, recently_wrote, replica_alias, reset_reads, route_reads
+from .exports import EARNING_COLUMNS, EXPORT_RENDERERS, PURCHASE_COLUMNS, export_response, filter_dates
+from .imports import ImportInterrupted, detect_format, import_purchases, read_rows
+from .middleware import histogram
+from .pagination import HistoryCursorPagination
+from .models import User, Earning, EarningDailyRollup, Withdrawal, Package, Purchase, CommissionJob
+from .serializers import UserSerializer, UserRegistrationSerializer, EarningSerializer, WithdrawalSerializer, WithdrawalRequestSerializer, TeamMemberSerializer, TeamQuerySerializer, SponsorMoveSerializer, BalanceQuerySerializer, EarningsSummaryQuerySerializer, ExportQuerySerializer, PackageSerializer, PurchaseSerializer, CommissionJobSerializer
 
-class UserViewSet(viewsets.ModelViewSet):
+def history_export(request, queryset, columns, name):
+    query = ExportQuerySerializer(data=request.query_params)
+    query.is_valid(raise_exception=True)
+    user_id = query.validated_data.get('user', request.user.pk)
+    if user_id != request.user.pk and not request.user.is_staff:
+        raise PermissionDenied("Only staff can export another user's history.")
+    queryset = filter_dates(queryset.filter(user_id=user_id), query.validated_data.get('start'), query.validated_data.get('end'))
+    return export_response(request, queryset, columns, name, request.accepted_renderer.format)
+
+class ReplicaReadMixin:
+    # Safe actions named in replica_actions read from the replica, unless the user wrote something
+    # within the sticky window and has to see it; any successful write starts that window
+    replica_actions = ()
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        alias = replica_alias()
+        if (
+            alias and request.method in permissions.SAFE_METHODS and self.action in self.replica_actions
+            and not recently_wrote(request.user.pk)
+        ):
+            self._replica_token = route_reads(alias)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        token = getattr(self, '_replica_token', None)
+        if token is not None:
+            reset_reads(token)
+            self._replica_token = None
+            # The body may lag the versions the tag is built from, so it must not be revalidated later
+            if 'ETag' in response:
+                del response['ETag']
+        elif (
+            replica_alias() and request.method not in permissions.SAFE_METHODS
+            and request.user.is_authenticated and response.status_code < 400
+        ):
+            mark_write(request.user.pk)
+        return super().finalize_response(request, response, *args, **kwargs)
+
+class UserViewSet(ReplicaReadMixin, viewsets.ModelViewSet):
     queryset = User.objects.all()
     serializer_class = UserSerializer
     permission_classes = [permissions.IsAuthenticated]
+    replica_actions = ('earnings', 'earnings_export', 'withdrawals', 'team')
 
     def get_permissions(self):
         if self.action == 'create':
@@ -33,89 +90,209 @@ class UserViewSet(viewsets.ModelViewSet):
             return Response({'error': 'Registration failed', 'details': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
     def get_object(self):
+        # request.user may come from the auth cache; writes start from the current row
+        if self.request.method not in permissions.SAFE_METHODS:
+            return User.objects.get(pk=self.request.user.pk)
         return self.request.user
 
     @action(detail=False, methods=['get'])
     def profile(self, request):
         try:
-            serializer = self.get_serializer(request.user)
-            return Response(serializer.data)
+            versions = get_versions(user_scope(request.user.pk), TREE)
+            etag = make_etag(request, 'profile', versions)
+            if not_modified(request, etag):
+                return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+            data = cached_response('profile', versions, lambda: self.get_serializer(request.user).data)
+            return Response(data, headers={'ETag': etag})
         except Exception as e:
             return Response({'error': 'Failed to retrieve profile', 'details': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+    @action(detail=False, methods=['get'], url_path='cache-stats', permission_classes=[permissions.IsAdminUser])
+    def response_cache_stats(self, request):
+        return Response(cache_stats())
+
     @action(detail=False, methods=['get'])
     def earnings(self, request):
         try:
-            earnings = request.user.earnings.all()
+            paginator = HistoryCursorPagination()
+            earnings = paginator.paginate_queryset(request.user.earnings.all(), request, view=self)
             serializer = EarningSerializer(earnings, many=True)
-            return Response(serializer.data)
+            return paginator.get_paginated_response(serializer.data)
+        except serializers.ValidationError as e:
+            return Response({'error': 'Validation Error', 'details': e.detail}, status=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
             return Response({'error': 'Failed to retrieve earnings', 'details': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+    @action(detail=False, methods=['get'], url_path='earnings/export', renderer_classes=EXPORT_RENDERERS)
+    def earnings_export(self, request):
+        try:
+            return history_export(request, Earning.objects.all(), EARNING_COLUMNS, 'earnings')
+        except serializers.ValidationError as e:
+            return Response({'error': 'Validation Error', 'details': e.detail}, status=status.HTTP_400_BAD_REQUEST)
+        except PermissionDenied as e:
+            return Response({'error': 'Permission denied', 'details': e.detail}, status=status.HTTP_403_FORBIDDEN)
+        except Exception as e:
+            return Response({'error': 'Failed to export earnings', 'details': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    @action(detail=False, methods=['get'], url_path='earnings-summary')
+    def earnings_summary(self, request):
+        try:
+            query = EarningsSummaryQuerySerializer(data=request.query_params)
+            query.is_valid(raise_exception=True)
+            period, start, end = (query.validated_data[key] for key in ('period', 'start', 'end'))
+            # Reads only the daily rollup, so cost follows the number of days shown
+            rollups = EarningDailyRollup.objects.filter(user=request.user, date__range=(start, end))
+            if period != 'day':
+                bucket = TruncWeek('date') if period == 'week' else TruncMonth('date')
+                rollups = rollups.annotate(bucket=bucket).values('bucket').annotate(amount=Sum('amount'), count=Sum('count'))
+            else:
+                rollups = rollups.annotate(bucket=F('date')).values('bucket', 'amount', 'count')
+            results = [
+                {'period': row['bucket'], 'amount': str(row['amount']), 'count': row['count']}
+                for row in rollups.order_by('bucket')
+            ]
+            return Response({
+                'period': period,
+                'start': start,
+                'end': end,
+                'total_amount': str(sum((Decimal(row['amount']) for row in results), Decimal('0.00'))),
+                'total_count': sum(row['count'] for row in results),
+                'results': results,
+            })
+        except serializers.ValidationError as e:
+            return Response({'error': 'Validation Error', 'details': e.detail}, status=status.HTTP_400_BAD_REQUEST)
+        except Exception as e:
+            return Response({'error': 'Failed to retrieve earnings summary', 'details': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    @action(detail=False, methods=['get'])
+    def balance(self, request):
+        try:
+            query = BalanceQuerySerializer(data=request.query_params)
+            query.is_valid(raise_exception=True)
+            at = query.validated_data.get('at')
+            return Response({'at': at or timezone.now(), 'balance': str(request.user.get_balance(at))})
+        except serializers.ValidationError as e:
+            return Response({'error': 'Validation Error', 'details': e.detail}, status=status.HTTP_400_BAD_REQUEST)
+        except Exception as e:
+            return Response({'error': 'Failed to retrieve balance', 'details': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
     @action(detail=False, methods=['get'])
     def withdrawals(self, request):
         try:
-            withdrawals = request.user.withdrawals.all()
+            paginator = HistoryCursorPagination()
+            withdrawals = paginator.paginate_queryset(request.user.withdrawals.all(), request, view=self)
             serializer = WithdrawalSerializer(withdrawals, many=True)
-            return Response(serializer.data)
+            return paginator.get_paginated_response(serializer.data)
+        except serializers.ValidationError as e:
+            return Response({'error': 'Validation Error', 'details': e.detail}, status=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
             return Response({'error': 'Failed to retrieve withdrawals', 'details': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
     @action(detail=False, methods=['get'])
     def team(self, request):
         try:
-            team = request.user.get_team(levels=2)
+            etag = make_etag(request, 'team', get_versions(user_scope(request.user.pk), TREE))
+            if not_modified(request, etag):
+                return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+            query = TeamQuerySerializer(data=request.query_params)
+            query.is_valid(raise_exception=True)
+            depth = query.validated_data['depth']
+            team = list(request.user.get_team(levels=depth))
+            level_counts = Counter(member.level - request.user.level for member in team)
             serializer = TeamMemberSerializer(team, many=True)
-            return Response(serializer.data)
+            return Response({
+                'depth': depth,
+                'total': len(team),
+                'level_counts': {level: level_counts[level] for level in range(1, depth + 1)},
+                'members': serializer.data,
+            }, headers={'ETag': etag})
+        except serializers.ValidationError as e:
+            return Response({'error': 'Validation Error', 'details': e.detail}, status=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
             return Response({'error': 'Failed to retrieve team', 'details': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-class EarningViewSet(viewsets.ModelViewSet):
+    @action(detail=True, methods=['post'], permission_classes=[permissions.IsAdminUser])
+    def move(self, request, pk=None):
+        try:
+            user = User.objects.get(pk=pk)
+            serializer = SponsorMoveSerializer(data=request.data)
+            serializer.is_valid(raise_exception=True)
+            rows_changed = user.move_to(serializer.validated_data['sponsor'])
+            return Response({'id': user.id, 'sponsor': user.sponsor_id, 'level': user.level, 'rows_changed': rows_changed})
+        except ObjectDoesNotExist:
+            return Response({'error': 'User not found'}, status=status.HTTP_404_NOT_FOUND)
+        except serializers.ValidationError as e:
+            return Response({'error': 'Validation Error', 'details': e.detail}, status=status.HTTP_400_BAD_REQUEST)
+        except DjangoValidationError as e:
+            return Response({'error': 'Validation Error', 'details': e.messages}, status=status.HTTP_400_BAD_REQUEST)
+        except Exception as e:
+            return Response({'error': 'Failed to move user', 'details': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+class EarningViewSet(ReplicaReadMixin, viewsets.ReadOnlyModelViewSet):
+    # Read only: creating an earning credits the balance, so earnings only come from payouts
     queryset = Earning.objects.all()
     serializer_class = EarningSerializer
+    pagination_class = HistoryCursorPagination
     permission_classes = [permissions.IsAuthenticated]
+    replica_actions = ('list',)
 
     def list(self, request, *args, **kwargs):
         try:
-            queryset = self.get_queryset().filter(user=request.user)
-            serializer = self.get_serializer(queryset, many=True)
-            return Response(serializer.data)
+            page = self.paginate_queryset(self.get_queryset().filter(user=request.user))
+            serializer = self.get_serializer(page, many=True)
+            return self.get_paginated_response(serializer.data)
+        except serializers.ValidationError as e:
+            return Response({'error': 'Validation Error', 'details': e.detail}, status=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
             return Response({'error': 'Failed to retrieve earnings', 'details': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-class WithdrawalViewSet(viewsets.ModelViewSet):
+class WithdrawalViewSet(ReplicaReadMixin, mixins.CreateModelMixin, mixins.RetrieveModelMixin, mixins.ListModelMixin, viewsets.GenericViewSet):
+    # No update or destroy: a withdrawal's funds move only through reserve and processing
     queryset = Withdrawal.objects.all()
     serializer_class = WithdrawalSerializer
+    pagination_class = HistoryCursorPagination
     permission_classes = [permissions.IsAuthenticated]
+    replica_actions = ('list',)
 
     def create(self, request, *args, **kwargs):
         try:
-            user = request.user
-            amount = request.data.get('amount')
-            if user.available_balance < float(amount):
-                return Response({"error": "Insufficient balance"}, status=status.HTTP_400_BAD_REQUEST)
-            return super().create(request, *args, **kwargs)
-        except ValueError:
-            return Response({'error': 'Invalid amount'}, status=status.HTTP_400_BAD_REQUEST)
+            serializer = WithdrawalRequestSerializer(data=request.data)
+            serializer.is_valid(raise_exception=True)
+            withdrawal = Withdrawal.reserve(request.user, serializer.validated_data['amount'])
+            return Response(self.get_serializer(withdrawal).data, status=status.HTTP_201_CREATED)
+        except serializers.ValidationError as e:
+            return Response({'error': 'Invalid amount', 'details': e.detail}, status=status.HTTP_400_BAD_REQUEST)
+        except DjangoValidationError as e:
+            return Response({'error': 'Insufficient balance', 'details': e.messages}, status=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
             return Response({'error': 'Withdrawal request failed', 'details': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
     def list(self, request, *args, **kwargs):
         try:
-            queryset = self.get_queryset().filter(user=request.user)
-            serializer = self.get_serializer(queryset, many=True)
-            return Response(serializer.data)
+            page = self.paginate_queryset(self.get_queryset().filter(user=request.user))
+            serializer = self.get_serializer(page, many=True)
+            return self.get_paginated_response(serializer.data)
+        except serializers.ValidationError as e:
+            return Response({'error': 'Validation Error', 'details': e.detail}, status=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
             return Response({'error': 'Failed to retrieve withdrawals', 'details': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-class PackageViewSet(viewsets.ModelViewSet):
+class PackageViewSet(ReplicaReadMixin, viewsets.ModelViewSet):
     queryset = Package.objects.all()
     serializer_class = PackageSerializer
     permission_classes = [permissions.IsAuthenticated]
+    replica_actions = ('list',)
 
     def list(self, request, *args, **kwargs):
         try:
-            return super().list(request, *args, **kwargs)
+            versions = get_versions(PACKAGES)
+            etag = make_etag(request, 'packages', versions)
+            if not_modified(request, etag):
+                return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+            data = cached_response(
+                'packages', versions, lambda: self.get_serializer(self.filter_queryset(self.get_queryset()), many=True).data,
+            )
+            return Response(data, headers={'ETag': etag})
         except Exception as e:
             return Response({'error': 'Failed to retrieve packages', 'details': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -127,19 +304,27 @@ class PackageViewSet(viewsets.ModelViewSet):
         except Exception as e:
             return Response({'error': 'Failed to create package', 'details': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-class PurchaseViewSet(viewsets.ModelViewSet):
+class PurchaseViewSet(ReplicaReadMixin, viewsets.ModelViewSet):
     queryset = Purchase.objects.all()
     serializer_class = PurchaseSerializer
+    pagination_class = HistoryCursorPagination
     permission_classes = [permissions.IsAuthenticated]
+    replica_actions = ('export',)
 
     def create(self, request, *args, **kwargs):
         try:
             serializer = self.get_serializer(data=request.data)
             serializer.is_valid(raise_exception=True)
-            purchase = serializer.save(user=request.user)  # Set the user here
-            purchase.distribute_profit()
+            job = None
+            with transaction.atomic():
+                purchase = serializer.save(user=request.user)  # Set the user here
+                if settings.MLM_ASYNC_COMMISSIONS:
+                    job = CommissionJob.objects.create(purchase=purchase)
+                else:
+                    purchase.distribute_profit()
+            data = dict(serializer.data, commission_job=CommissionJobSerializer(job).data if job else None)
             headers = self.get_success_headers(serializer.data)
-            return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
+            return Response(data, status=status.HTTP_201_CREATED, headers=headers)
         except serializers.ValidationError as e:
             return Response({'error': 'Validation Error', 'details': str(e)}, status=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
@@ -147,8 +332,66 @@ class PurchaseViewSet(viewsets.ModelViewSet):
 
     def list(self, request, *args, **kwargs):
         try:
-            queryset = self.get_queryset().filter(user=request.user)
-            serializer = self.get_serializer(queryset, many=True)
-            return Response(serializer.data)
+            page = self.paginate_queryset(self.get_queryset().filter(user=request.user))
+            serializer = self.get_serializer(page, many=True)
+            return self.get_paginated_response(serializer.data)
+        except serializers.ValidationError as e:
+            return Response({'error': 'Validation Error', 'details': e.detail}, status=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
-            return Response({'error': 'Failed to retrieve purchases', 'details': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
\ No newline at end of file
+            return Response({'error': 'Failed to retrieve purchases', 'details': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    @action(detail=False, methods=['get'], renderer_classes=EXPORT_RENDERERS)
+    def export(self, request):
+        try:
+            return history_export(request, Purchase.objects.all(), PURCHASE_COLUMNS, 'purchases')
+        except serializers.ValidationError as e:
+            return Response({'error': 'Validation Error', 'details': e.detail}, status=status.HTTP_400_BAD_REQUEST)
+        except PermissionDenied as e:
+            return Response({'error': 'Permission denied', 'details': e.detail}, status=status.HTTP_403_FORBIDDEN)
+        except Exception as e:
+            return Response({'error': 'Failed to export purchases', 'details': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    @action(detail=False, methods=['post'], permission_classes=[permissions.IsAdminUser])
+    def bulk(self, request):
+        upload = request.FILES.get('file')
+        if upload is None:
+            return Response({'error': 'Validation Error', 'details': {'file': ['A CSV or NDJSON file is required.']}}, status=status.HTTP_400_BAD_REQUEST)
+        fmt = request.data.get('format') or detect_format(upload.name)
+        try:
+            # Every line is parsed before any is imported, so a malformed file is rejected whole
+            for _ in read_rows(codecs.iterdecode(upload, 'utf-8'), fmt):
+                pass
+            upload.seek(0)
+            stats = import_purchases(read_rows(codecs.iterdecode(upload, 'utf-8'), fmt))
+            return Response(stats)
+        except (ValueError, csv.Error) as e:
+            return Response({'error': 'Invalid import file', 'details': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except ImportInterrupted as e:
+            return Response(
+                {'error': 'Bulk import failed', 'details': str(e.__cause__), 'committed': e.stats},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            )
+        except Exception as e:
+            return Response({'error': 'Bulk import failed', 'details': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+class CommissionJobViewSet(viewsets.ReadOnlyModelViewSet):
+    queryset = CommissionJob.objects.all()
+    serializer_class = CommissionJobSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_queryset(self):
+        return super().get_queryset().filter(purchase__user=self.request.user)
+
+    def retrieve(self, request, *args, **kwargs):
+        try:
+            return super().retrieve(request, *args, **kwargs)
+        except Http404:
+            return Response({'error': 'Commission job not found'}, status=status.HTTP_404_NOT_FOUND)
+        except Exception as e:
+            return Response({'error': 'Failed to retrieve commission job', 'details': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+class MetricsView(APIView):
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request):
+        return Response(histogram.snapshot())